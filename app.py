@@ -1,13 +1,146 @@
 import streamlit as st
 from streamlit import session_state as sst
-from langchain_google_genai import ChatGoogleGenerativeAI
-from utils.chat import initialize_chat_history, show_chat, add_to_chat
-from utils.logs import initialize_log, display_log, add_to_log
-from utils.vectorstore import get_vectorstore
+from utils.chat import initialize_chat_history, show_chat, add_to_chat, cancel_answer, finish_answer, show_partial_answer, start_answer
+from utils.logs import LOG_LEVELS, initialize_log, display_log, add_to_log
+from utils.metrics import display_timings
+from utils.vectorstore import cancel_vectorstore_job, clear_session_index, finish_vectorstore_job, get_index_preview, get_index_settings, start_vectorstore_job
+from utils.query import astream_cached_answer, astream_preview_answer, get_answer_cache
+from utils.query_runner import run_in_background, run_query
+from utils.memory import history_budget
+from utils.clients import get_chat_model
+from utils.retrieval import FAN_OUT_MODES, RetrievalConfig, SEARCH_TYPES
+from utils.faiss_index import INDEX_TYPES, RECALL_LEVELS, VECTOR_CODECS
 from utils.ui import base_ui, promo
-from utils.utils import load_css, prepare_download_file
+from utils.utils import EXPORT_FORMATS, prepare_download_file
+from utils.assets import load_css
 
-GEMINI_API_KEY = st.secrets['GEMINI_API_KEY']
+# Seconds between progress updates of a background index build
+INDEX_POLL_SECONDS = 1.0
+# Seconds between redraws of an answer being generated
+ANSWER_POLL_SECONDS = 0.25
+
+
+def retrieval_controls():
+    """
+    Shows the chunking and retrieval settings and stores them in `sst.retrieval_config`.
+    """
+    config = sst.retrieval_config
+    st.markdown("### Retrieval:")
+    chunk_size = st.number_input(
+        "Chunk size (characters)", min_value=200, max_value=4000, value=config.chunk_size, step=100,
+        help="Changing chunking rebuilds the vectorstore."
+    )
+    chunk_overlap = st.number_input(
+        "Chunk overlap (characters)", min_value=0, max_value=chunk_size // 2,
+        value=min(config.chunk_overlap, chunk_size // 2), step=50
+    )
+    top_k = st.slider("Chunks per answer", min_value=1, max_value=20, value=config.top_k)
+    search_type = st.selectbox(
+        "Search type", options=SEARCH_TYPES, index=SEARCH_TYPES.index(config.search_type),
+        format_func=lambda option: {
+            "similarity": "Similarity",
+            "mmr": "Diverse (MMR)",
+            "similarity_score_threshold": "Similarity above threshold"
+        }[option]
+    )
+    score_threshold = config.score_threshold
+    if search_type == "similarity_score_threshold":
+        score_threshold = st.slider("Minimum relevance", min_value=0.0, max_value=1.0, value=config.score_threshold, step=0.05)
+    hybrid = st.checkbox(
+        "Hybrid keyword search", value=config.hybrid,
+        help="Also match exact terms like course codes or formula names with BM25."
+    )
+    fan_out = st.selectbox(
+        "Multi-document search", options=FAN_OUT_MODES, index=FAN_OUT_MODES.index(config.fan_out),
+        format_func=lambda option: {
+            "off": "Single search",
+            "files": "Search each PDF",
+            "sub_queries": "Split question into parts"
+        }[option],
+        help="Runs several searches in parallel so questions spanning several PDFs get chunks from each."
+    )
+    index_type = st.selectbox(
+        "Index type", options=INDEX_TYPES, index=INDEX_TYPES.index(config.index_type),
+        format_func=lambda option: {
+            "auto": "Automatic (by chunk count)",
+            "flat": "Exact (flat)",
+            "ivf": "Clustered (IVF)",
+            "hnsw": "Graph (HNSW)"
+        }[option],
+        help="Approximate indexes answer faster on very large document sets. Changing it rebuilds the vectorstore."
+    )
+    vector_codec = st.selectbox(
+        "Vector storage", options=VECTOR_CODECS, index=VECTOR_CODECS.index(config.vector_codec),
+        format_func=lambda option: {
+            "float32": "Full precision",
+            "float16": "Half precision",
+            "pq": "Compressed (PQ codes)"
+        }[option],
+        help="Smaller vectors use less memory at some cost in accuracy. Changing it rebuilds the vectorstore."
+    )
+    recall = st.select_slider(
+        "Search recall", options=RECALL_LEVELS, value=config.recall,
+        help="Higher recall searches more of an approximate index and takes longer."
+    )
+    context_tokens = st.number_input(
+        "Context token budget", min_value=250, max_value=100000, value=config.context_tokens, step=250,
+        help="Maximum tokens of PDF text sent to the LLM per question."
+    )
+    history_tokens = st.number_input(
+        "Conversation token budget", min_value=0, max_value=20000, value=config.history_tokens, step=250,
+        help="Maximum tokens of earlier messages sent with a question, so follow-ups work. 0 turns it off."
+    )
+    sst.retrieval_config = RetrievalConfig(
+        chunk_size=int(chunk_size),
+        chunk_overlap=int(chunk_overlap),
+        top_k=top_k,
+        search_type=search_type,
+        fetch_k=config.fetch_k,
+        score_threshold=score_threshold,
+        context_tokens=int(context_tokens),
+        history_tokens=int(history_tokens),
+        hybrid=hybrid,
+        fan_out=fan_out,
+        index_type=index_type,
+        vector_codec=vector_codec,
+        recall=recall
+    )
+
+
+@st.fragment(run_every=INDEX_POLL_SECONDS)
+def index_progress(searchable: bool):
+    """
+    Shows the progress of this session's background index job, polling it without
+    rerunning the whole page. Reruns the app once the job has finished, or once
+    its first batch can be searched.
+
+    Args:
+        searchable (bool): Whether the session could already ask questions.
+    """
+    job = sst.get("index_job")
+    if job is None:
+        return
+    if job.done or (not searchable and job.preview is not None):
+        st.rerun()
+    st.progress(
+        job.fraction,
+        text=f"{job.stage}... {job.files_parsed}/{job.files_total} PDFs parsed, "
+             f"{job.chunks_embedded}/{job.chunks_total} chunks embedded"
+    )
+
+
+@st.fragment(run_every=ANSWER_POLL_SECONDS)
+def answer_progress():
+    """
+    Shows the answer this session is waiting for while it is generated, polling
+    it without rerunning the whole page. Reruns the app once it is complete.
+    """
+    answer = sst.get("pending_answer")
+    if answer is None:
+        return
+    if answer.done:
+        st.rerun()
+    show_partial_answer()
 
 
 def main():
@@ -23,6 +156,9 @@ def main():
     if "show_bts" not in sst:
         sst.show_bts = False
     
+    if "retrieval_config" not in sst:
+        sst.retrieval_config = RetrievalConfig()
+
     llm_model = 'gemini-2.5-flash-lite'
     
     with st.sidebar:
@@ -51,6 +187,8 @@ def main():
                     ],
                     label_visibility='hidden'
                 )
+            with st.container(border=True):
+                retrieval_controls()
             with st.container(border=True):
                 if "chat_history" in sst:
                     st.markdown("### Refresh Chat:")
@@ -59,14 +197,16 @@ def main():
                 
                 if "vectorstore" in sst:
                     if st.button("Remake Vectorstore", use_container_width=True):
-                        sst.pop("vectorstore", None)
+                        clear_session_index()
 
             with st.container(border=True):
                 if "chat_history" in sst:
                     st.markdown("### Download Chat History:")
-                    format_type = st.selectbox("Choose format for download",options=["JSON", "TXT"],index=0,help="Select the format to download chat history.")
+                    format_type = st.selectbox("Choose format for download",options=list(EXPORT_FORMATS),index=0,help="Select the format to download chat history.")
 
-                    if format_type:
+                    # The file is only built once asked for, then kept up to date from the cache
+                    if sst.get("export_format") == format_type or st.button("Prepare file", use_container_width=True):
+                        sst.export_format = format_type
                         file_data, file_name, mime_type = prepare_download_file(format_type)
                         if file_data:
                             st.download_button(
@@ -81,7 +221,10 @@ def main():
             sst.show_bts = True
             with st.container():
                 st.markdown("### Program Logs:")
+                sst.log_levels = st.multiselect("Show levels", options=LOG_LEVELS, default=LOG_LEVELS, label_visibility="collapsed")
                 sst.container = st.container(height= 200)
+                st.markdown("### Timings:")
+                display_timings()
         else:
             sst.show_bts = False
         promo()
@@ -90,50 +233,101 @@ def main():
         if "log" not in sst:
             initialize_log()
         
-        display_log(sst.log)
+        display_log(sst.log, sst.log_levels)
 
     # Handle PDF processing and chat interface
     if pdf_files:
-        if "pdf_files" not in sst or pdf_files != sst.pdf_files:
+        index_settings = get_index_settings(sst.retrieval_config)
+        if "pdf_files" not in sst or pdf_files != sst.pdf_files or index_settings != sst.get("requested_index_settings"):
             sst.pdf_files = pdf_files
-            if "vectorstore" in sst:
-                del sst.vectorstore
-            get_vectorstore()
+            sst.requested_index_settings = index_settings
+            start_vectorstore_job()
+
+        # Indexing runs in the background; pick up its logs and result on every rerun
+        finished = finish_vectorstore_job()
+        # A fresh index can be queried after its first batch, before it is complete
+        preview = None if finished else get_index_preview()
+        if not finished:
+            index_progress("vectorstore" in sst or preview is not None)
         
         # Only proceed with chat if we have a valid vectorstore
-        if "vectorstore" in sst:
+        if "vectorstore" in sst or preview is not None:
             if "chat_history" not in sst:
                 initialize_chat_history()
+            # Background summaries cannot write to the session log themselves
+            for message, status in sst.conversation_memory.take_messages():
+                add_to_log(message, status)
             
             show_chat(sst.chat_history)
+            config = sst.retrieval_config
+            memory = sst.conversation_memory
+            # Query rewrites and summaries should be repeatable, not creative
+            rewrite_llm = get_chat_model(llm_model, temperature=0)
+
+            answered = finish_answer()
+            if answered is not None:
+                if answered.error is not None:
+                    st.toast("Error processing query. Please try again.", icon="⚠️")
+                    add_to_log(f"Error: {str(answered.error)}", "error")
+                    add_to_chat("ai", "I apologize, but I encountered an error processing your query. Please try again.")
+                # Messages leaving the recent window are summarised in the background
+                elif config.history_tokens:
+                    run_in_background(memory.asummarize(rewrite_llm, sst.chat_history[1:]))
             
-            # Capture User Prompt and Display AI Response
-            prompt = st.chat_input("Enter your question:", disabled=False)
-            if prompt:
+            # Capture User Prompt and start the AI Response
+            prompt = st.chat_input("Enter your question:", disabled="pending_answer" in sst)
+            if prompt and "pending_answer" in sst:
+                st.toast("Please wait for the current answer to finish.", icon="ℹ️")
+            elif prompt:
                 add_to_chat("user", prompt)
-
-                with st.spinner("Generating response..."):
-                    add_to_log("Processing query..")
-                    llm = ChatGoogleGenerativeAI(model=llm_model, temperature=0.9, google_api_key=GEMINI_API_KEY)
-                    try:
-                        response = sst.vectorstore.query(question=prompt, llm=llm)
-                    except Exception as query_error:
-                        st.toast("Error processing query. Please try again.", icon="⚠️")
-                        response = "I apologize, but I encountered an error processing your query. Please try again."
-
-                    add_to_chat("ai", response)
+                add_to_log("Processing query..")
+                llm = get_chat_model(llm_model, temperature=0.9)
+                sources = list(dict.fromkeys(pdf.name for pdf in sst.pdf_files))
+                # Earlier messages, without the greeting and the question just asked
+                conversation = memory.context(sst.chat_history[1:-1], history_budget(llm_model, config, prompt))
+                # Answers are computed on the shared query loop; the script only polls them
+                if preview is not None:
+                    start_answer(run_query(
+                        lambda log: astream_preview_answer(
+                            preview, prompt, llm, config, log=log, sources=sources,
+                            conversation=conversation, rewrite_llm=rewrite_llm
+                        )
+                    ))
+                else:
+                    vectorstore, index_hash, lexical = sst.vectorstore.vectorstore, sst.index_hash, sst.get("lexical_index")
+                    cache = get_answer_cache()
+                    start_answer(run_query(
+                        lambda log: astream_cached_answer(
+                            vectorstore, prompt, llm,
+                            namespace=(index_hash, llm_model),
+                            config=config,
+                            cache=cache,
+                            lexical=lexical,
+                            log=log,
+                            sources=sources,
+                            conversation=conversation,
+                            rewrite_llm=rewrite_llm
+                        )
+                    ))
+            if "pending_answer" in sst:
+                answer_progress()
+        elif "index_job" in sst:
+            st.chat_input("Enter your question:", disabled=True)
+            st.info("Indexing your PDFs. You can keep adjusting settings in the meantime.")
         else:
             # Show error state and disable chat input
             st.chat_input("Enter your question:", disabled=True)
             st.info("Please upload a PDF with readable text content to start chatting.")
     else:
         # Clear all states when no PDF is present
-        if "vectorstore" in sst:
-            del sst.vectorstore
+        cancel_vectorstore_job()
+        cancel_answer()
+        clear_session_index()
         if "pdf_files" in sst:
             del sst.pdf_files
         if "chat_history" in sst:
             del sst.chat_history
+            del sst.conversation_memory
         st.info("Attach a PDF to start chatting")
 
 if __name__ == '__main__':
@@ -0,0 +1,285 @@
+"""
+Offline benchmark of the PDF pipeline.
+
+Runs parsing, chunking, embedding, index building, retrieval and answering over
+generated PDFs of several sizes, with a deterministic local embedder and a stub
+LLM, so no API key or network is needed. Results are written as JSON and can be
+compared against an earlier run to catch slowdowns:
+
+    python benchmark.py --sizes 10 100 --output bench.json
+    python benchmark.py --sizes 10 100 --compare bench.json
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from dataclasses import asdict
+from datetime import datetime, timezone
+from io import BytesIO
+
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+from utils.answer_cache import AnswerCache
+from utils.embedding_cache import CachedEmbeddings, EmbeddingCache
+from utils.faiss_index import INDEX_TYPES, train_index
+from utils.lexical import BM25Index
+from utils.pdf import read_many_pdf_pages
+from utils.query import astream_cached_answer
+from utils.query_runner import QueryRunner
+from utils.retrieval import RetrievalConfig, get_text_splitter, retrieve, retrieve_many
+
+DEFAULT_SIZES = [10, 50]
+PAGES_PER_PDF = 10
+LINES_PER_PAGE = 40
+EMBEDDING_SIZE = 256
+QUERIES = 20
+# Build stages are timed this often and the fastest run is kept, to damp noise
+REPEATS = 3
+# Relative slowdown of a stage reported as a regression by `--compare`
+DEFAULT_TOLERANCE = 0.25
+
+WORDS = (
+    "matrix vector integral derivative theorem proof lemma entropy enzyme protein cell "
+    "market demand supply elasticity circuit voltage current resistor algorithm graph "
+    "tree sorting complexity recursion momentum energy force velocity acid base reaction"
+).split()
+
+
+def build_text_pdf(page_texts: list) -> bytes:
+    """
+    Builds a minimal PDF with Helvetica text, one line per newline of each page text.
+
+    Args:
+        page_texts (list): Text of each page; must not contain parentheses or backslashes.
+
+    Returns:
+        bytes: PDF file content.
+    """
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_refs = []
+    for text in page_texts:
+        lines = " T* ".join(f"({line}) Tj" for line in text.split("\n"))
+        stream = f"BT /F1 10 Tf 12 TL 72 750 Td {lines} ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        page_refs.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(page_refs), len(page_refs))
+
+    out = BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+def generate_corpus(num_pdfs: int, pages_per_pdf: int = PAGES_PER_PDF, seed: int = 0) -> list:
+    """
+    Generates synthetic lecture-note PDFs with random words and course codes.
+
+    Args:
+        num_pdfs (int): Number of PDFs.
+        pages_per_pdf (int, optional): Pages per PDF. Defaults to PAGES_PER_PDF.
+        seed (int, optional): Random seed, the same seed gives the same corpus. Defaults to 0.
+
+    Returns:
+        list: `(data, source)` tuples as taken by `read_many_pdf_pages`.
+    """
+    rng = random.Random(seed)
+    files = []
+    for number in range(num_pdfs):
+        pages = []
+        for _ in range(pages_per_pdf):
+            lines = [
+                f"CS{rng.randint(1000, 9999)} " + " ".join(rng.choices(WORDS, k=12))
+                for _ in range(LINES_PER_PAGE)
+            ]
+            pages.append("\n".join(lines))
+        files.append((build_text_pdf(pages), f"notes_{number}.pdf"))
+    return files
+
+
+def _timed(function, *args, repeats: int = 1):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def _ignore(*args):
+    # The benchmark has no session to pass log messages and timings on to
+    pass
+
+
+def _latencies(samples: list) -> dict:
+    samples = sorted(samples)
+    return {
+        "p50_ms": statistics.median(samples) * 1000,
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+def run_size(
+    num_pdfs: int,
+    config: RetrievalConfig,
+    workers: int = 1,
+    queries: int = QUERIES,
+    seed: int = 0,
+    repeats: int = REPEATS
+) -> dict:
+    """
+    Benchmarks every pipeline stage on one corpus size.
+
+    Args:
+        num_pdfs (int): Number of generated PDFs.
+        config (RetrievalConfig): Chunking, index and retrieval settings.
+        workers (int, optional): PDF parsing processes. Defaults to 1.
+        queries (int, optional): Questions used for the query stages. Defaults to QUERIES.
+        seed (int, optional): Corpus and question seed. Defaults to 0.
+        repeats (int, optional): Runs of each build stage, the fastest counts. Defaults to REPEATS.
+
+    Returns:
+        dict: Corpus counts and per-stage timings in seconds or milliseconds.
+    """
+    files = generate_corpus(num_pdfs, seed=seed)
+    stages = {}
+
+    parsed, stages["parse_s"] = _timed(read_many_pdf_pages, files, workers, repeats=repeats)
+    pages = [page for result in parsed for page in result]
+
+    splitter = get_text_splitter(config.chunk_size, config.chunk_overlap)
+    docs, stages["chunk_s"] = _timed(splitter.split_documents, pages, repeats=repeats)
+    texts = [doc.page_content for doc in docs]
+    ids = [str(number) for number in range(len(docs))]
+
+    embeddings = CachedEmbeddings(DeterministicFakeEmbedding(size=EMBEDDING_SIZE), "fake", EmbeddingCache(":memory:"))
+    vectors, stages["embed_cold_s"] = _timed(embeddings.embed_documents, texts)
+    _, stages["embed_cached_s"] = _timed(embeddings.embed_documents, texts, repeats=repeats)
+
+    def build_index():
+        vectorstore = FAISS(
+            embedding_function=embeddings,
+            index=train_index(vectors, config.index_type, config.vector_codec),
+            docstore=InMemoryDocstore(),
+            index_to_docstore_id={}
+        )
+        vectorstore.add_embeddings(zip(texts, vectors), metadatas=[doc.metadata for doc in docs], ids=ids)
+        return vectorstore
+
+    vectorstore, stages["index_build_s"] = _timed(build_index, repeats=repeats)
+    lexical, stages["lexical_build_s"] = _timed(BM25Index.from_documents, docs, ids, repeats=repeats)
+
+    rng = random.Random(seed)
+    questions = [f"What does CS{rng.randint(1000, 9999)} say about {rng.choice(WORDS)}?" for _ in range(queries)]
+    retrieval = [_timed(retrieve, vectorstore, question, config, None, lexical)[1] for question in questions]
+    stages["retrieve"] = _latencies(retrieval)
+    if num_pdfs > 1:
+        # One search per PDF in parallel, as the "files" fan-out does
+        sources = [source for _, source in files]
+        fan_out = [
+            _timed(retrieve_many, vectorstore, [(question, vector)], config, lexical, sources)[1]
+            for question, vector in zip(questions, embeddings.embed_documents(questions))
+        ]
+        stages["retrieve_files"] = _latencies(fan_out)
+
+    # Answers take the app's path: the cached async pipeline on the query loop
+    llm = FakeListChatModel(responses=["The notes cover this topic in detail."])
+    runner, cache = QueryRunner(), AnswerCache()
+    first_piece, total = [], []
+    for question in questions:
+        start = time.perf_counter()
+        pieces = runner.stream("benchmark", lambda log, question=question: astream_cached_answer(
+            vectorstore, question, llm, ("benchmark", "fake"), config, cache, lexical, log
+        ), log=_ignore, timing=_ignore)
+        for number, _ in enumerate(pieces):
+            if number == 0:
+                first_piece.append(time.perf_counter() - start)
+        total.append(time.perf_counter() - start)
+    stages["answer_first_piece"] = _latencies(first_piece)
+    stages["answer_total"] = _latencies(total)
+
+    return {"pdfs": num_pdfs, "pages": len(pages), "chunks": len(docs), "stages": stages}
+
+
+def compare(results: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list:
+    """
+    Finds stages that got slower than in a baseline run of the same sizes.
+
+    Args:
+        results (dict): Output of the current run.
+        baseline (dict): Output of an earlier run.
+        tolerance (float, optional): Allowed relative slowdown. Defaults to DEFAULT_TOLERANCE.
+
+    Returns:
+        list: Messages describing each regression, empty if there are none.
+    """
+    previous = {run["pdfs"]: run["stages"] for run in baseline["runs"]}
+    regressions = []
+    for run in results["runs"]:
+        for stage, value in run["stages"].items():
+            old = previous.get(run["pdfs"], {}).get(stage)
+            if old is None:
+                continue
+            # Latency stages are compared on their median
+            new_time, old_time = (value["p50_ms"], old["p50_ms"]) if isinstance(value, dict) else (value, old)
+            if old_time > 0 and new_time > old_time * (1 + tolerance):
+                regressions.append(f"{run['pdfs']} PDFs, {stage}: {old_time:.4g} -> {new_time:.4g} ({new_time / old_time - 1:+.0%})")
+    return regressions
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmark of PDF ingestion, indexing and querying.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Numbers of PDFs to benchmark.")
+    parser.add_argument("--workers", type=int, default=1, help="PDF parsing processes.")
+    parser.add_argument("--queries", type=int, default=QUERIES, help="Questions per size.")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default="auto")
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="Runs of each build stage, the fastest counts.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Baseline JSON file to check for regressions.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed relative slowdown.")
+    args = parser.parse_args(argv)
+
+    config = RetrievalConfig(index_type=args.index_type)
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {**asdict(config), "workers": args.workers, "queries": args.queries, "seed": args.seed},
+        "runs": [run_size(size, config, args.workers, args.queries, args.seed, args.repeats) for size in args.sizes],
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print(f"Regression: {message}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,5 @@
 import streamlit as st
-from app import load_css
+from utils.assets import load_css, read_asset
 from pathlib import Path
 from utils.ui import base_ui
 
@@ -24,8 +24,7 @@ else:
 
 
 # ---- README ----
-with open('README.md', 'r', encoding='utf-8') as f:
-    readme_text = f.read()
+readme_text = read_asset('README.md')
 
 st.title("README")
 st.markdown(readme_text)
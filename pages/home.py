@@ -1,5 +1,5 @@
 import streamlit as st
-from app import load_css
+from utils.assets import load_css
 from pathlib import Path
 from utils.ui import base_ui
 
@@ -1,12 +1,44 @@
 import unittest
+import json
 import tempfile
 import os
+import shutil
 from pathlib import Path
 from unittest.mock import MagicMock, patch
+from concurrent.futures import Future
 import streamlit as st
-from app import get_loader, get_vectorstore
-from io import BytesIO
-import app
+from utils.vectorstore import build_preview, finish_vectorstore_job, get_file_key, get_loader, get_vectorstore, start_vectorstore_job
+from utils.pdf import iter_many_pdf_pages, read_many_pdf_pages
+from utils.embedding_cache import EmbeddingCache, CachedEmbeddings
+from utils.shared_index import SharedIndexStore
+from utils.query import aretrieve, astream_answer, astream_cached_answer, astream_preview_answer, build_messages, parse_sub_queries, refers_back
+from utils.query_runner import FairLimiter, QueryRunner
+from utils.memory import ConversationMemory, history_budget
+import asyncio
+from utils.answer_cache import AnswerCache
+from utils.retrieval import RetrievalConfig, fit_to_budget, merge_results, reciprocal_rank_fusion, retrieve, retrieve_many
+from utils.lexical import BM25Index
+from utils.metrics import MetricsRegistry, flush_metrics, timed
+from utils.logs import LogBuffer
+from utils.utils import ChatExport, prepare_download_file
+from utils.assets import read_asset
+from utils.index_jobs import IndexJobManager, IndexPreview
+import threading
+import gc
+import time
+import subprocess
+import sys
+from utils.faiss_index import _recall_lock, get_index_type, resolve_index_type, search_rows, set_recall, train_index, vector_nbytes
+import faiss
+import numpy as np
+from utils.clients import get_chat_model, get_embedding_model
+from utils.chat import finish_answer, show_chat, show_earlier_messages, start_answer
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_community.vectorstores import FAISS
+from utils.embedding_scheduler import ScheduledEmbeddings, TokenBucket
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.documents import Document
+from benchmark import build_text_pdf, compare, run_size
 
 class MockUploadedFile:
     def __init__(self, name, content, type):
@@ -17,6 +49,32 @@ class MockUploadedFile:
     def read(self):
         return self.content
 
+    def getvalue(self):
+        return self.content
+
+class MockSessionState(dict):
+    """Dict with attribute access, standing in for `st.session_state`."""
+    __getattr__ = dict.__getitem__
+    __setattr__ = dict.__setitem__
+    __delattr__ = dict.__delitem__
+
+class CountingEmbeddings(DeterministicFakeEmbedding):
+    """Deterministic fake embedder that counts how many texts it embedded."""
+    calls: int = 0
+
+    def embed_documents(self, texts):
+        self.calls += len(texts)
+        return super().embed_documents(texts)
+
+def collect(answer) -> list:
+    """Runs an async answer stream to the end and returns its pieces."""
+    async def pieces():
+        return [piece async for piece in answer]
+    return asyncio.run(pieces())
+
+def no_log(message, status="info"):
+    pass
+
 class TestPDFProcessing(unittest.TestCase):
     def setUp(self):
         """Set up test environment before each test"""
@@ -49,14 +107,13 @@ class TestPDFProcessing(unittest.TestCase):
         return filepath
 
     @patch('streamlit.toast')
-    @patch('app.PyPDFLoader')
+    @patch('utils.pdf.read_pdf_pages')
     def test_valid_pdf_processing(self, mock_pdf_loader, mock_toast):
         """Test processing of a valid PDF with text content"""
         # Mock PDF loader behavior
         mock_page = MagicMock()
         mock_page.page_content = "Sample Text"
-        mock_loader_instance = mock_pdf_loader.return_value
-        mock_loader_instance.load.return_value = [mock_page]
+        mock_pdf_loader.return_value = [mock_page]
         
         # Create mock PDF file object
         mock_pdf = MagicMock()
@@ -65,7 +122,7 @@ class TestPDFProcessing(unittest.TestCase):
         
         # Test PDF loading
         with patch('streamlit.spinner'):
-            loader_list, temp_paths = get_loader([mock_pdf])
+            loader_list = get_loader([mock_pdf])
         
         # Assertions
         self.assertIsNotNone(loader_list)
@@ -73,14 +130,13 @@ class TestPDFProcessing(unittest.TestCase):
         self.assertFalse(mock_toast.called)
 
     @patch('streamlit.toast')
-    @patch('app.PyPDFLoader')
+    @patch('utils.pdf.read_pdf_pages')
     def test_image_only_pdf_processing(self, mock_pdf_loader, mock_toast):
         """Test processing of a PDF containing only images"""
         # Mock PDF loader behavior for image-only PDF
         mock_page = MagicMock()
         mock_page.page_content = ""  # Empty content to simulate image-only PDF
-        mock_loader_instance = mock_pdf_loader.return_value
-        mock_loader_instance.load.return_value = [mock_page]
+        mock_pdf_loader.return_value = [mock_page]
         
         # Create mock PDF file object
         mock_pdf = MagicMock()
@@ -89,7 +145,7 @@ class TestPDFProcessing(unittest.TestCase):
         
         # Test PDF loading
         with patch('streamlit.spinner'):
-            loader_list, temp_paths = get_loader([mock_pdf])
+            loader_list = get_loader([mock_pdf])
         
         # Assertions
         self.assertIsNone(loader_list)
@@ -99,9 +155,8 @@ class TestPDFProcessing(unittest.TestCase):
         )
 
     @patch('streamlit.toast')
-    @patch('app.PyPDFLoader')
-    @patch('tempfile.NamedTemporaryFile')
-    def test_multiple_pdfs_processing(self, mock_temp_file, mock_loader, mock_toast):
+    @patch('utils.pdf.read_pdf_pages')
+    def test_multiple_pdfs_processing(self, mock_loader, mock_toast):
         """Test processing multiple PDFs with mixed content"""
         # Create mock pages with proper content
         mock_page_valid = MagicMock()
@@ -109,16 +164,8 @@ class TestPDFProcessing(unittest.TestCase):
         mock_page_empty = MagicMock()
         mock_page_empty.page_content = ""
 
-        # Mock temporary file
-        mock_temp = MagicMock()
-        mock_temp.__enter__.return_value = mock_temp
-        mock_temp.name = "/tmp/test.pdf"
-        mock_temp_file.return_value = mock_temp
-
-        # Set up the mock loader to handle different files
-        mock_loader_instance = MagicMock()
-        mock_loader_instance.load.return_value = [mock_page_valid]
-        mock_loader.return_value = mock_loader_instance
+        # Set up the mock parser to handle different files
+        mock_loader.return_value = [mock_page_valid]
 
         # Create mock PDFs
         mock_pdf1 = MagicMock()
@@ -130,19 +177,18 @@ class TestPDFProcessing(unittest.TestCase):
         mock_pdf2.getvalue = lambda: b"content"
 
         # Test processing multiple PDFs
-        loader_list, temp_paths = app.get_loader([mock_pdf1, mock_pdf2])
+        loader_list = get_loader([mock_pdf1, mock_pdf2])
 
         self.assertIsNotNone(loader_list)
         self.assertEqual(len(loader_list), 2)  # Both PDFs should be included
         mock_toast.assert_not_called()
 
     @patch('streamlit.toast')
-    @patch('app.PyPDFLoader')
+    @patch('utils.pdf.read_pdf_pages')
     def test_corrupted_pdf_processing(self, mock_pdf_loader, mock_toast):
         """Test processing of a corrupted PDF file"""
         # Mock PDF loader to raise an exception
-        mock_loader_instance = mock_pdf_loader.return_value
-        mock_loader_instance.load.side_effect = Exception("Invalid PDF file")
+        mock_pdf_loader.side_effect = Exception("Invalid PDF file")
         
         # Create mock PDF file object
         mock_pdf = MagicMock()
@@ -151,7 +197,7 @@ class TestPDFProcessing(unittest.TestCase):
         
         # Test PDF loading
         with patch('streamlit.spinner'):
-            loader_list, temp_paths = get_loader([mock_pdf])
+            loader_list = get_loader([mock_pdf])
         
         # Assertions
         self.assertIsNone(loader_list)
@@ -176,30 +222,30 @@ class TestPDFHandling(unittest.TestCase):
         self.image_pdf.getvalue = MagicMock(return_value=b"Sample PDF with image")
 
     @patch('streamlit.toast')
-    @patch('app.PyPDFLoader')
+    @patch('utils.pdf.read_pdf_pages')
     def test_pdf_with_text(self, mock_loader, mock_toast):
         # Mock successful text extraction
         mock_page = MagicMock()
         mock_page.page_content = "Sample text content"
-        mock_loader.return_value.load.return_value = [mock_page]
+        mock_loader.return_value = [mock_page]
         
         # Test processing a PDF with text
-        loader_list, temp_paths = app.get_loader([self.text_pdf])
+        loader_list = get_loader([self.text_pdf])
         
         self.assertIsNotNone(loader_list)
         self.assertEqual(len(loader_list), 1)
         mock_toast.assert_not_called()
 
     @patch('streamlit.toast')
-    @patch('app.PyPDFLoader')
+    @patch('utils.pdf.read_pdf_pages')
     def test_pdf_without_text(self, mock_loader, mock_toast):
         # Mock PDF with no text content
         mock_page = MagicMock()
         mock_page.page_content = ""
-        mock_loader.return_value.load.return_value = [mock_page]
+        mock_loader.return_value = [mock_page]
         
         # Test processing a PDF without text
-        loader_list, temp_paths = app.get_loader([self.image_pdf])
+        loader_list = get_loader([self.image_pdf])
         
         self.assertIsNone(loader_list)
         mock_toast.assert_called_once_with(
@@ -208,22 +254,13 @@ class TestPDFHandling(unittest.TestCase):
         )
 
     @patch('streamlit.toast')
-    @patch('app.PyPDFLoader')
-    @patch('tempfile.NamedTemporaryFile')
-    def test_mixed_pdfs(self, mock_temp_file, mock_loader, mock_toast):
-        # Mock temporary file
-        mock_temp = MagicMock()
-        mock_temp.__enter__.return_value = mock_temp
-        mock_temp.name = "/tmp/test.pdf"
-        mock_temp_file.return_value = mock_temp
-
-        # Set up the mock loader to handle different files
-        mock_loader_instance = MagicMock()
-        mock_loader_instance.load.return_value = [MagicMock(page_content="Sample text content")]
-        mock_loader.return_value = mock_loader_instance
+    @patch('utils.pdf.read_pdf_pages')
+    def test_mixed_pdfs(self, mock_loader, mock_toast):
+        # Set up the mock parser to handle different files
+        mock_loader.return_value = [MagicMock(page_content="Sample text content")]
         
         # Test processing multiple PDFs
-        loader_list, temp_paths = app.get_loader([self.text_pdf, self.image_pdf])
+        loader_list = get_loader([self.text_pdf, self.image_pdf])
         
         self.assertIsNotNone(loader_list)
         self.assertEqual(len(loader_list), 2)  # Both PDFs should be processed
@@ -234,17 +271,1166 @@ class TestPDFHandling(unittest.TestCase):
         mock_files = [
             MockUploadedFile("sample_text.pdf", b"mock content", "application/pdf")
         ]
-        with patch("app.st.file_uploader", return_value=mock_files), \
-             patch("app.st.toast") as mock_toast, \
-             patch("app.st.info"), \
-             patch("app.st.session_state", self.mock_session_state), \
-             patch("app.PyPDFLoader", side_effect=Exception("Mock error")):
+        session_state = MockSessionState(pdf_files=mock_files)
+        embeddings = CachedEmbeddings(DeterministicFakeEmbedding(size=8), "fake-model", EmbeddingCache(":memory:"))
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, ignore_errors=True)
+        # Keeps the saved indexes, embedding client and job pool of the app out of the test
+        with patch("streamlit.toast") as mock_toast, \
+             patch("utils.vectorstore.sst", session_state), \
+             patch("utils.index_store.INDEX_DIR", Path(index_dir)), \
+             patch("utils.vectorstore.get_embeddings", return_value=embeddings), \
+             patch("utils.vectorstore.get_shared_index_store", return_value=SharedIndexStore()), \
+             patch("utils.vectorstore.get_index_job_manager", return_value=IndexJobManager(max_workers=1)), \
+             patch("utils.pdf.read_pdf_pages", side_effect=Exception("Mock error")):
             
-            result = app.get_vectorstore()
+            result = get_vectorstore()
             self.assertIsNone(result)
             mock_toast.assert_called_once_with(
                 "Please upload PDFs with readable text content.", icon="⚠️"
             )
 
+class TestInMemoryPDFParsing(unittest.TestCase):
+    @patch('streamlit.toast')
+    def test_pages_are_read_without_temp_files(self, mock_toast):
+        pdf = MockUploadedFile("notes.pdf", build_text_pdf(["First page", "Second page"]), "application/pdf")
+
+        with patch("tempfile.NamedTemporaryFile") as mock_temp_file:
+            pages = get_loader([pdf])
+
+        mock_temp_file.assert_not_called()
+        mock_toast.assert_not_called()
+        doc_pages = pages[get_file_key(pdf)]
+        self.assertEqual([page.page_content for page in doc_pages], ["First page", "Second page"])
+        self.assertEqual([page.metadata["page"] for page in doc_pages], [0, 1])
+        self.assertEqual(doc_pages[0].metadata["source"], "notes.pdf")
+
+    def test_process_pool_keeps_page_order_and_per_file_errors(self):
+        files = [
+            (build_text_pdf([f"Page {i}" for i in range(5)]), "long.pdf"),
+            (b"not a pdf", "broken.pdf"),
+            (build_text_pdf(["Only page"]), "short.pdf"),
+        ]
+
+        results = read_many_pdf_pages(files, workers=2, pages_per_task=2)
+
+        self.assertEqual([page.page_content for page in results[0]], [f"Page {i}" for i in range(5)])
+        self.assertEqual([page.metadata["page"] for page in results[0]], list(range(5)))
+        self.assertIsInstance(results[1], Exception)
+        self.assertEqual(results[2][0].metadata["source"], "short.pdf")
+
+    def test_all_files_are_submitted_before_the_first_is_reported(self):
+        files = [(build_text_pdf([f"{name} {i}" for i in range(3)]), f"{name}.pdf") for name in "abcd"]
+        started = threading.Event()
+        submitted = []
+
+        class HeldPool:
+            # Runs the first range and holds every other one back
+            def submit(self, fn, *args):
+                future = Future()
+                submitted.append(future)
+                if not started.is_set():
+                    started.set()
+                    future.set_result(fn(*args))
+                return future
+
+        with patch("utils.pdf.get_process_pool", return_value=HeldPool()):
+            results = iter_many_pdf_pages(files, workers=2, pages_per_task=3)
+            index, pages = next(results)
+            results.close()
+
+        self.assertEqual((index, pages[0].page_content), (0, "a 0"))
+        self.assertEqual(len(submitted), len(files))
+        self.assertTrue(all(future.cancelled() for future in submitted[1:]))
+
+class TestIncrementalVectorstore(unittest.TestCase):
+    def setUp(self):
+        self.fake = CountingEmbeddings(size=8)
+        self.embeddings = CachedEmbeddings(self.fake, "fake-model", EmbeddingCache(":memory:"))
+        self.session_state = MockSessionState()
+        self.index_dir = tempfile.mkdtemp()
+        self.index_dir_patcher = patch("utils.index_store.INDEX_DIR", Path(self.index_dir))
+        self.index_dir_patcher.start()
+        self.store = SharedIndexStore()
+        self.store_patcher = patch("utils.vectorstore.get_shared_index_store", return_value=self.store)
+        self.store_patcher.start()
+
+    def tearDown(self):
+        self.index_dir_patcher.stop()
+        self.store_patcher.stop()
+        shutil.rmtree(self.index_dir, ignore_errors=True)
+
+    def make_pdf(self, name):
+        return MockUploadedFile(name, name.encode(), "application/pdf")
+
+    def fake_parse_pdfs(self, files, log, job=None):
+        pages = {}
+        for key, name, _ in files:
+            pages[key] = [
+                Document(page_content=f"{name} page {i}", metadata={"source": name, "page": i})
+                for i in range(2)
+            ]
+        return pages, []
+
+    def build(self, pdf_files):
+        self.session_state.pdf_files = pdf_files
+        with patch("utils.vectorstore.sst", self.session_state), \
+             patch("utils.vectorstore.parse_pdfs", side_effect=self.fake_parse_pdfs), \
+             patch("utils.vectorstore.get_embeddings", return_value=self.embeddings):
+            return get_vectorstore()
+
+    def indexed_sources(self):
+        docstore = self.session_state.vectorstore.vectorstore.docstore._dict
+        return sorted({doc.metadata["source"] for doc in docstore.values()})
+
+    def test_only_new_pdfs_are_embedded(self):
+        a, b, c = self.make_pdf("a.pdf"), self.make_pdf("b.pdf"), self.make_pdf("c.pdf")
+        self.build([a, b])
+        self.assertEqual(self.fake.calls, 4)
+
+        self.build([a, b, c])
+        self.assertEqual(self.fake.calls, 6)
+        self.assertEqual(self.indexed_sources(), ["a.pdf", "b.pdf", "c.pdf"])
+
+    def test_changing_chunk_settings_rebuilds_the_index(self):
+        a = MockUploadedFile("a.pdf", b"a", "application/pdf")
+        self.build([a])
+        self.session_state.retrieval_config = RetrievalConfig(chunk_size=5, chunk_overlap=0)
+        self.build([a])
+
+        chunks = self.session_state.vectorstore.vectorstore.docstore._dict.values()
+        self.assertTrue(all(len(doc.page_content) <= 5 for doc in chunks))
+        self.assertGreater(self.session_state.vectorstore.vectorstore.index.ntotal, 2)
+
+    def test_removed_pdf_vectors_are_deleted(self):
+        a, b = self.make_pdf("a.pdf"), self.make_pdf("b.pdf")
+        self.build([a, b])
+        self.build([a])
+
+        self.assertEqual(self.indexed_sources(), ["a.pdf"])
+        self.assertEqual(self.session_state.vectorstore.vectorstore.index.ntotal, 2)
+        self.assertEqual(list(self.session_state.file_ids), [get_file_key(a)])
+        self.assertEqual(len(self.session_state.lexical_index), 2)
+        self.assertEqual(self.session_state.lexical_index.search("b"), [])
+
+    def test_saved_index_is_reused_by_a_new_session(self):
+        a, b = self.make_pdf("a.pdf"), self.make_pdf("b.pdf")
+        self.build([a, b])
+        self.assertEqual(len(os.listdir(self.index_dir)), 1)
+
+        self.session_state = MockSessionState()
+        self.build([b, a])
+
+        self.assertEqual(self.fake.calls, 4)
+        self.assertEqual(self.indexed_sources(), ["a.pdf", "b.pdf"])
+        self.assertEqual(sorted(self.session_state.file_ids), sorted([get_file_key(a), get_file_key(b)]))
+
+    def test_sessions_share_one_index_per_document_set(self):
+        a, b = self.make_pdf("a.pdf"), self.make_pdf("b.pdf")
+        self.build([a, b])
+        first_session = self.session_state
+
+        self.session_state = MockSessionState()
+        self.build([b, a])
+
+        self.assertIs(self.session_state.vectorstore.vectorstore, first_session.vectorstore.vectorstore)
+        self.assertEqual(self.store.stats()["references"], 2)
+        self.assertEqual(self.fake.calls, 4)
+
+    def test_updates_do_not_modify_a_shared_index(self):
+        a, b = self.make_pdf("a.pdf"), self.make_pdf("b.pdf")
+        self.build([a, b])
+        shared = self.session_state.vectorstore.vectorstore
+
+        self.build([a])
+
+        self.assertEqual(shared.index.ntotal, 4)
+        self.assertEqual(self.session_state.vectorstore.vectorstore.index.ntotal, 2)
+        stats = self.store.stats()
+        self.assertEqual((stats["indexes"], stats["references"]), (2, 1))
+
+    def test_unreferenced_indexes_are_evicted_over_budget(self):
+        self.store.memory_budget_bytes = 0
+        a, b = self.make_pdf("a.pdf"), self.make_pdf("b.pdf")
+        self.build([a])
+        self.build([b])
+
+        self.assertEqual(self.store.stats()["indexes"], 1)
+        self.assertIsNotNone(self.store.acquire(self.session_state.index_hash))
+
+    def test_hnsw_index_is_rebuilt_when_pdfs_are_removed(self):
+        self.session_state.retrieval_config = RetrievalConfig(index_type="hnsw", vector_codec="float16")
+        a, b = self.make_pdf("a.pdf"), self.make_pdf("b.pdf")
+        self.build([a, b])
+        self.assertEqual(get_index_type(self.session_state.vectorstore.vectorstore.index), "hnsw")
+
+        self.build([a])
+
+        self.assertEqual(self.indexed_sources(), ["a.pdf"])
+        self.assertEqual(self.session_state.vectorstore.vectorstore.index.ntotal, 2)
+        # Kept chunks come from the embedding cache instead of the API
+        self.assertEqual(self.fake.calls, 4)
+
+    def test_partial_index_is_searchable_between_batches(self):
+        previews = []
+
+        def record_preview(*args):
+            previews.append(build_preview(*args))
+            return previews[-1]
+
+        with patch("utils.vectorstore.INDEX_BATCH_SIZE", 2), \
+             patch("utils.vectorstore.build_preview", side_effect=record_preview):
+            self.build([self.make_pdf("a.pdf"), self.make_pdf("b.pdf"), self.make_pdf("c.pdf")])
+
+        self.assertEqual([preview.vectorstore.index.ntotal for preview in previews], [2, 4])
+        self.assertEqual([(preview.pages_indexed, preview.pages_total) for preview in previews], [(2, 6), (4, 6)])
+        # Pages are indexed in order, so the first batch holds the first PDF
+        first = previews[0].vectorstore.docstore._dict.values()
+        self.assertEqual({doc.metadata["source"] for doc in first}, {"a.pdf"})
+        self.assertEqual(self.session_state.vectorstore.vectorstore.index.ntotal, 6)
+
+    def test_index_is_built_in_the_background(self):
+        self.session_state.pdf_files = [self.make_pdf("a.pdf")]
+        release = threading.Event()
+
+        def slow_parse(files, log, job=None):
+            release.wait(5)
+            return self.fake_parse_pdfs(files, log, job)
+
+        with patch("utils.vectorstore.sst", self.session_state), \
+             patch("utils.vectorstore.parse_pdfs", side_effect=slow_parse), \
+             patch("utils.vectorstore.get_embeddings", return_value=self.embeddings):
+            job = start_vectorstore_job()
+            self.assertFalse(finish_vectorstore_job())
+            self.assertNotIn("vectorstore", self.session_state)
+
+            release.set()
+            job.wait(5)
+            self.assertTrue(finish_vectorstore_job())
+
+        self.assertEqual(job.status, "done")
+        self.assertEqual(self.indexed_sources(), ["a.pdf"])
+        self.assertNotIn("index_job", self.session_state)
+
+    def test_background_timings_reach_the_session(self):
+        with patch("utils.metrics.sst", self.session_state):
+            self.build([self.make_pdf("a.pdf")])
+
+        stages = {span.name for span in self.session_state.timings}
+        self.assertTrue({"vectorstore", "embed", "index_build"} <= stages)
+
+    def test_index_is_released_when_the_session_goes_away(self):
+        def get_embeddings(on_progress=None):
+            scheduled = ScheduledEmbeddings(self.fake, bucket=TokenBucket(1e6), on_progress=on_progress)
+            return CachedEmbeddings(scheduled, "fake-model", self.embeddings.cache)
+
+        a, b = self.make_pdf("a.pdf"), self.make_pdf("b.pdf")
+        with patch("utils.vectorstore.get_embeddings", side_effect=get_embeddings):
+            self.session_state.pdf_files = [a, b]
+            with patch("utils.vectorstore.sst", self.session_state), \
+                 patch("utils.vectorstore.parse_pdfs", side_effect=self.fake_parse_pdfs):
+                get_vectorstore()
+        self.assertEqual(self.store.stats()["references"], 1)
+
+        self.session_state = None
+        gc.collect()
+        self.assertEqual(self.store.stats()["references"], 0)
+
+    def test_collected_lease_does_not_deadlock_the_store(self):
+        kept = self.store.publish("a", FAISS.from_texts(["chunk"], self.fake), {}, None)
+        lease = self.store.acquire("a")
+        lease.cycle = lease
+        del lease
+
+        def collect_while_locked():
+            # A collection can run in a thread that holds the store's lock
+            with self.store._lock:
+                gc.collect()
+            self.store.acquire("a").release()
+
+        worker = threading.Thread(target=collect_while_locked, daemon=True)
+        worker.start()
+        worker.join(5)
+
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(self.store.stats()["references"], 1)
+
+    @patch('streamlit.toast')
+    @patch('utils.pdf.read_pdf_pages')
+    def test_each_pdf_is_parsed_once(self, mock_loader, mock_toast):
+        mock_loader.return_value = [
+            Document(page_content="Sample text content", metadata={"source": "a.pdf"})
+        ]
+        self.session_state.pdf_files = [self.make_pdf("a.pdf")]
+        with patch("utils.vectorstore.sst", self.session_state), \
+             patch("utils.vectorstore.get_embeddings", return_value=self.embeddings):
+            get_vectorstore()
+
+        mock_loader.assert_called_once()
+        self.assertEqual(self.indexed_sources(), ["a.pdf"])
+
+class TestEmbeddingCache(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.cache = EmbeddingCache(Path(self.test_dir) / "embeddings.sqlite3", max_entries=3)
+
+    def tearDown(self):
+        self.cache._conn.close()
+        for name in os.listdir(self.test_dir):
+            os.remove(os.path.join(self.test_dir, name))
+        os.rmdir(self.test_dir)
+
+    def test_repeated_chunks_are_not_re_embedded(self):
+        fake = CountingEmbeddings(size=8)
+        embeddings = CachedEmbeddings(fake, "fake-model", self.cache)
+
+        first = embeddings.embed_documents(["alpha", "beta", "alpha"])
+        second = embeddings.embed_documents(["beta", "alpha"])
+
+        self.assertEqual(fake.calls, 2)
+        self.assertEqual((embeddings.hits, embeddings.misses), (2, 3))
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(first[0]), 8)
+        self.assertAlmostEqual(second[1][0], first[0][0], places=5)
+
+    def test_cache_survives_reopening(self):
+        CachedEmbeddings(CountingEmbeddings(size=8), "fake-model", self.cache).embed_documents(["alpha"])
+        reopened = EmbeddingCache(self.cache.path, max_entries=3)
+        fake = CountingEmbeddings(size=8)
+        CachedEmbeddings(fake, "fake-model", reopened).embed_documents(["alpha"])
+        reopened._conn.close()
+
+        self.assertEqual(fake.calls, 0)
+
+    def test_model_name_is_part_of_the_key(self):
+        CachedEmbeddings(CountingEmbeddings(size=8), "model-a", self.cache).embed_documents(["alpha"])
+        fake = CountingEmbeddings(size=8)
+        CachedEmbeddings(fake, "model-b", self.cache).embed_documents(["alpha"])
+
+        self.assertEqual(fake.calls, 1)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        embeddings = CachedEmbeddings(CountingEmbeddings(size=8), "fake-model", self.cache)
+        for text in ["a", "b", "c", "a", "d"]:
+            embeddings.embed_documents([text])
+
+        self.assertEqual(len(self.cache), 3)
+        fake = CountingEmbeddings(size=8)
+        CachedEmbeddings(fake, "fake-model", self.cache).embed_documents(["a", "b"])
+        self.assertEqual(fake.calls, 1)
+
+class TestStreamingAnswers(unittest.TestCase):
+    def setUp(self):
+        self.vectorstore = FAISS.from_texts(
+            ["Photosynthesis happens in chloroplasts.", "Mitochondria make ATP."],
+            DeterministicFakeEmbedding(size=8)
+        )
+
+    def test_answer_is_streamed_in_pieces(self):
+        llm = FakeListChatModel(responses=["In chloroplasts."])
+
+        chunks = collect(astream_answer(self.vectorstore, "Where does photosynthesis happen?", llm))
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("".join(chunks), "In chloroplasts.")
+
+    def test_finished_answer_is_added_to_chat_history(self):
+        runner = QueryRunner(limit=1)
+        release = threading.Event()
+
+        async def answer(log):
+            log("started")
+            yield "In "
+            await asyncio.to_thread(release.wait, 5)
+            yield "chloroplasts."
+
+        session_state = MockSessionState(chat_history=[])
+        with patch("utils.chat.sst", session_state), \
+             patch("utils.chat.message") as mock_message, \
+             patch("utils.chat.add_to_log") as mock_log, \
+             patch("utils.chat.add_timing"):
+            start_answer(runner.start("session", answer))
+            # The script returns while the answer is generated and polls it later
+            session_state.pending_answer.wait(1)
+            self.assertIsNone(finish_answer())
+            self.assertEqual(session_state.chat_history, [])
+            release.set()
+            while not session_state.pending_answer.done:
+                session_state.pending_answer.wait(1, timeout=1)
+            finished = finish_answer()
+
+        self.assertEqual(finished.text, "In chloroplasts.")
+        self.assertNotIn("pending_answer", session_state)
+        self.assertEqual(session_state.chat_history, [{"role": "ai", "content": "In chloroplasts."}])
+        mock_log.assert_any_call("started", "info")
+        mock_message.assert_called_once_with(message="In chloroplasts.", is_user=False, key="0")
+
+class TestChatWindow(unittest.TestCase):
+    def setUp(self):
+        history = [{"role": "user" if i % 2 else "ai", "content": f"message {i}"} for i in range(50)]
+        self.session_state = MockSessionState(chat_history=history, chat_window=20)
+
+    def show(self):
+        with patch("utils.chat.sst", self.session_state), \
+             patch("utils.chat.message") as mock_message, \
+             patch("utils.chat.st.button") as mock_button:
+            show_chat(self.session_state.chat_history)
+        return mock_message, mock_button
+
+    def test_only_recent_messages_are_drawn(self):
+        mock_message, mock_button = self.show()
+
+        keys = [call.kwargs["key"] for call in mock_message.call_args_list]
+        self.assertEqual(keys, [str(i) for i in range(30, 50)])
+        self.assertIn("30 hidden", mock_button.call_args.args[0])
+
+    def test_earlier_messages_are_loaded_a_page_at_a_time(self):
+        with patch("utils.chat.sst", self.session_state):
+            show_earlier_messages()
+            show_earlier_messages()
+        mock_message, mock_button = self.show()
+
+        self.assertEqual(mock_message.call_count, 50)
+        mock_button.assert_not_called()
+
+class TestRetrievalPipeline(unittest.TestCase):
+    def setUp(self):
+        self.vectorstore = FAISS.from_texts(
+            [f"Chapter {i} covers topic {i}." for i in range(10)],
+            DeterministicFakeEmbedding(size=8)
+        )
+
+    def test_top_k_and_search_types(self):
+        for search_type in ["similarity", "mmr"]:
+            docs = retrieve(self.vectorstore, "topic 3", RetrievalConfig(top_k=3, search_type=search_type))
+            self.assertEqual(len(docs), 3)
+
+        strict = RetrievalConfig(top_k=5, search_type="similarity_score_threshold", score_threshold=1.0)
+        self.assertEqual(retrieve(self.vectorstore, "nothing alike", strict), [])
+
+    def test_context_is_cut_to_token_budget(self):
+        docs = [Document(page_content="a" * 40), Document(page_content="b" * 40), Document(page_content="c" * 40)]
+
+        kept = fit_to_budget(docs, max_tokens=15)
+
+        self.assertEqual([doc.page_content for doc in kept], ["a" * 40, "b" * 20])
+        self.assertEqual(docs[1].page_content, "b" * 40)
+
+class TestHybridRetrieval(unittest.TestCase):
+    def setUp(self):
+        texts = [f"Chapter {i} covers general topic {i}." for i in range(20)]
+        texts[13] = "Prerequisite for CS4120 is linear algebra."
+        self.ids = [f"chunk-{i}" for i in range(len(texts))]
+        self.docs = [Document(page_content=text) for text in texts]
+        self.vectorstore = FAISS.from_documents(self.docs, DeterministicFakeEmbedding(size=8), ids=self.ids)
+        self.lexical = BM25Index.from_documents(self.docs, self.ids)
+
+    def test_exact_term_ranks_first_in_keyword_search(self):
+        self.assertEqual(self.lexical.search("what does cs4120 require", k=1)[0][0], "chunk-13")
+
+    def test_removed_chunks_are_not_found(self):
+        lexical = self.lexical.copy()
+        lexical.remove(["chunk-13"])
+
+        self.assertEqual(lexical.search("CS4120"), [])
+        self.assertEqual(len(lexical), 19)
+        self.assertEqual(self.lexical.search("CS4120", k=1)[0][0], "chunk-13")
+
+    def test_rankings_are_fused(self):
+        self.assertEqual(reciprocal_rank_fusion([["a", "b", "c"], ["b", "c"]]), ["b", "c", "a"])
+
+    def test_hybrid_search_finds_keyword_matches(self):
+        config = RetrievalConfig(top_k=3, fetch_k=5)
+
+        hybrid = retrieve(self.vectorstore, "CS4120", config, lexical=self.lexical)
+        dense = retrieve(self.vectorstore, "CS4120", RetrievalConfig(top_k=3, hybrid=False), lexical=self.lexical)
+
+        self.assertEqual(len(hybrid), 3)
+        self.assertIn("chunk-13", [doc.id for doc in hybrid])
+        self.assertEqual([doc.id for doc in dense], [doc.id for doc in retrieve(self.vectorstore, "CS4120", config)])
+
+class TestScalableIndexes(unittest.TestCase):
+    def setUp(self):
+        self.vectors = np.random.default_rng(0).random((2000, 32), dtype=np.float32)
+
+    def test_index_type_follows_chunk_count(self):
+        self.assertEqual(resolve_index_type("auto", 100), "flat")
+        self.assertEqual(resolve_index_type("auto", 50000), "ivf")
+        self.assertEqual(resolve_index_type("hnsw", 100), "hnsw")
+
+    def test_compressed_vectors_use_less_memory(self):
+        sizes = {}
+        for codec in ["float32", "float16", "pq"]:
+            index = train_index(self.vectors, "ivf", codec)
+            index.add(self.vectors)
+            self.assertEqual(get_index_type(index), "ivf")
+            sizes[codec] = vector_nbytes(index)
+        self.assertGreater(sizes["float32"], sizes["float16"])
+        self.assertGreater(sizes["float16"], sizes["pq"])
+
+    def test_recall_level_sets_search_effort(self):
+        ivf = train_index(self.vectors, "ivf")
+        set_recall(ivf, "fast")
+        fast = faiss.extract_index_ivf(ivf).nprobe
+        set_recall(ivf, "accurate")
+        accurate = faiss.extract_index_ivf(ivf).nprobe
+        self.assertLess(fast, accurate)
+
+        hnsw = train_index(self.vectors, "hnsw")
+        set_recall(hnsw, "accurate")
+        self.assertEqual(faiss.downcast_index(hnsw).hnsw.efSearch, 256)
+
+    def test_recall_is_only_locked_when_it_changes(self):
+        ivf = train_index(self.vectors, "ivf")
+        other = train_index(self.vectors, "ivf")
+        set_recall(ivf, "accurate")
+
+        with _recall_lock(ivf):
+            # Neither the same level on this index nor another index waits for the lock
+            set_recall(ivf, "accurate")
+            set_recall(other, "fast")
+        self.assertIsNot(_recall_lock(ivf), _recall_lock(other))
+
+    def test_approximate_search_finds_stored_vectors(self):
+        index = train_index(self.vectors, "hnsw")
+        index.add(self.vectors)
+        set_recall(index, "accurate")
+        _, found = index.search(self.vectors[:10], 1)
+        self.assertEqual(found[:, 0].tolist(), list(range(10)))
+
+class TestBenchmark(unittest.TestCase):
+    def test_every_stage_is_measured(self):
+        run = run_size(2, RetrievalConfig(), queries=3, repeats=1)
+
+        self.assertEqual((run["pdfs"], run["pages"]), (2, 20))
+        self.assertGreater(run["chunks"], run["pages"])
+        for stage in ["parse_s", "chunk_s", "embed_cold_s", "index_build_s", "retrieve", "answer_total"]:
+            self.assertIn(stage, run["stages"])
+
+    def test_slower_stages_are_reported(self):
+        baseline = {"runs": [{"pdfs": 10, "stages": {"parse_s": 1.0, "retrieve": {"p50_ms": 2.0}}}]}
+        results = {"runs": [{"pdfs": 10, "stages": {"parse_s": 1.1, "retrieve": {"p50_ms": 3.0}}}]}
+
+        regressions = compare(results, baseline, tolerance=0.25)
+
+        self.assertEqual(len(regressions), 1)
+        self.assertIn("retrieve", regressions[0])
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.patcher = patch("utils.metrics.get_metrics", return_value=self.registry)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_spans_record_counts_and_errors(self):
+        with timed("parse") as span:
+            span.count("pages", 3)
+        with self.assertRaises(ValueError):
+            with timed("parse"):
+                raise ValueError("broken PDF")
+
+        summary = self.registry.summary()[0]
+        self.assertEqual((summary["calls"], summary["errors"], summary["pages"]), (2, 1, 3))
+        self.assertEqual(self.registry.recent[-1].error, "ValueError: broken PDF")
+
+    def test_decorated_calls_get_their_own_span(self):
+        @timed("retrieve")
+        def search():
+            return "done"
+
+        self.assertEqual(search(), "done")
+        search()
+        self.assertEqual(len(self.registry.recent), 2)
+        self.assertIsNot(self.registry.recent[0], self.registry.recent[1])
+
+    def test_pipeline_stages_are_timed(self):
+        vectorstore = FAISS.from_texts(["alpha", "beta"], DeterministicFakeEmbedding(size=8))
+        llm = FakeListChatModel(responses=["An answer."])
+        collect(astream_answer(vectorstore, "alpha?", llm))
+
+        stages = {row["stage"]: row for row in self.registry.summary()}
+        self.assertEqual(stages["retrieve"]["chunks"], 2)
+        self.assertGreater(stages["generate"]["answer_tokens"], 0)
+
+    def test_prometheus_and_file_export(self):
+        with tempfile.TemporaryDirectory() as directory:
+            jsonl, prom = os.path.join(directory, "spans.jsonl"), os.path.join(directory, "metrics.prom")
+            with patch("utils.metrics.METRICS_FILE", jsonl), patch("utils.metrics.METRICS_PROMETHEUS_FILE", prom):
+                with timed("embed") as span:
+                    span.count("chunks", 5)
+                # Spans are only written in batches
+                self.assertFalse(os.path.exists(jsonl))
+                flush_metrics()
+
+            with open(jsonl) as f:
+                self.assertEqual(json.loads(f.readline())["counts"], {"chunks": 5})
+            with open(prom) as f:
+                text = f.read()
+        self.assertIn('asknotes_stage_duration_seconds_count{stage="embed"} 1', text)
+        self.assertIn('asknotes_stage_items_total{stage="embed",item="chunks"} 5', text)
+
+class TestLogBuffer(unittest.TestCase):
+    def test_oldest_entries_are_dropped_at_capacity(self):
+        logs = LogBuffer(capacity=3)
+        for number in range(5):
+            logs.append({"time": "", "status": "info", "message": str(number)})
+
+        self.assertEqual([entry["message"] for entry in logs], ["4", "3", "2"])
+        self.assertEqual(logs.dropped, 2)
+
+    def test_newest_entries_by_level(self):
+        logs = LogBuffer()
+        for number in range(10):
+            logs.append({"time": "", "status": "error" if number % 3 == 0 else "info", "message": str(number)})
+
+        errors = logs.newest(limit=2, levels=["error"])
+
+        self.assertEqual([entry["message"] for entry in errors], ["9", "6"])
+        self.assertEqual(len(logs.newest(limit=4)), 4)
+
+class TestChatExport(unittest.TestCase):
+    def setUp(self):
+        self.history = [{"role": "ai", "content": "Hi!"}, {"role": "user", "content": "What is \"ATP\"?"}]
+        self.session_state = MockSessionState(chat_history=self.history, show_bts=False)
+
+    def test_json_matches_a_full_dump(self):
+        with patch("utils.utils.sst", self.session_state):
+            data, file_name, mime_type = prepare_download_file("JSON")
+
+        self.assertEqual(data, json.dumps(self.history, indent=4).encode("utf-8"))
+        self.assertEqual((file_name, mime_type), ("chat_history.json", "application/json"))
+
+    def test_unchanged_history_reuses_the_file(self):
+        with patch("utils.utils.sst", self.session_state):
+            first = prepare_download_file("Markdown")[0]
+            second = prepare_download_file("Markdown")[0]
+            self.history.append({"role": "ai", "content": "Adenosine triphosphate."})
+            third = prepare_download_file("Markdown")[0]
+
+        self.assertIs(first, second)
+        self.assertIn(b"Adenosine triphosphate.", third)
+
+    def test_only_new_messages_are_rendered(self):
+        export = ChatExport(self.history)
+        export.render("JSONL")
+        self.history.append({"role": "ai", "content": "Adenosine triphosphate."})
+
+        with patch("utils.utils._render_message", return_value="x\n") as render:
+            export.render("JSONL")
+
+        render.assert_called_once()
+        self.assertEqual(len(export.parts["JSONL"]), 3)
+
+class TestAssets(unittest.TestCase):
+    def test_files_are_read_again_only_after_changing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "styles.css"
+            path.write_text("body {}")
+            self.assertEqual(read_asset(path), "body {}")
+
+            with patch.object(Path, "read_text") as mock_read:
+                self.assertEqual(read_asset(path), "body {}")
+            mock_read.assert_not_called()
+
+            path.write_text("body { color: red; }")
+            os.utime(path, ns=(0, 0))
+            self.assertEqual(read_asset(path), "body { color: red; }")
+
+    def test_pages_do_not_import_the_llm_stack(self):
+        code = "import sys, utils.assets, utils.ui; print(any(m.startswith('langchain') for m in sys.modules))"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), "False")
+
+class TestIndexJobs(unittest.TestCase):
+    def setUp(self):
+        self.manager = IndexJobManager(max_workers=2)
+        self.release = threading.Event()
+        self.builds = 0
+
+    def build(self, job):
+        self.builds += 1
+        job.log("started")
+        while not self.release.wait(0.01):
+            job.raise_if_cancelled()
+        return "index"
+
+    def test_identical_jobs_are_shared(self):
+        first = self.manager.submit("set", self.build)
+        second = self.manager.submit("set", self.build)
+        self.release.set()
+        first.wait(5)
+
+        self.assertIs(first, second)
+        self.assertEqual(self.builds, 1)
+        self.assertEqual(first.take_result(lambda key: "acquired"), "index")
+        self.assertEqual(second.take_result(lambda key: "acquired"), "acquired")
+
+    def test_job_stops_when_the_last_session_cancels(self):
+        job = self.manager.submit("set", self.build)
+        self.manager.submit("set", self.build)
+
+        job.cancel()
+        self.assertFalse(job.wait(0.1))
+        job.cancel()
+        job.wait(5)
+
+        self.assertEqual(job.status, "cancelled")
+        self.assertEqual(self.manager.running(), 0)
+
+    def test_progress_and_messages_are_polled(self):
+        job = self.manager.submit("set", self.build)
+        job.files_total, job.files_parsed = 2, 1
+        job.chunks_total, job.chunks_indexed = 10, 2
+        job.embedded(3, 8)
+        self.release.set()
+        job.wait(5)
+
+        self.assertAlmostEqual(job.fraction, 0.5)
+        messages, cursor = job.messages_since(0)
+        self.assertEqual((messages, cursor), ([("started", "info")], 1))
+        self.assertEqual(job.messages_since(cursor), ([], 1))
+
+class TestPreviewAnswer(unittest.TestCase):
+    def test_answer_notes_the_searched_share_of_pages(self):
+        docs = [Document(page_content=f"chapter {i}", metadata={"source": "a.pdf", "page": i}) for i in range(3)]
+        embeddings = DeterministicFakeEmbedding(size=8)
+        vectorstore = FAISS.from_documents(docs, embeddings)
+        preview = IndexPreview(vectorstore, BM25Index.from_documents(docs, list(vectorstore.index_to_docstore_id.values())), 3, 12)
+        llm = FakeListChatModel(responses=["Chapter one is about sets."])
+
+        answer = "".join(collect(astream_preview_answer(preview, "What is chapter 1 about?", llm, log=no_log)))
+
+        self.assertTrue(answer.startswith("Chapter one is about sets."))
+        self.assertIn("Searched 3 of 12 pages (25%)", answer)
+
+class TestFanOut(unittest.TestCase):
+    def setUp(self):
+        # a.pdf has many chunks about entropy, b.pdf a single one about voltage
+        self.docs = [Document(page_content=f"entropy disorder heat {i}", metadata={"source": "a.pdf"}) for i in range(12)]
+        self.docs.append(Document(page_content="voltage current resistor", metadata={"source": "b.pdf"}))
+        self.vectorstore = FAISS.from_documents(self.docs, DeterministicFakeEmbedding(size=16))
+        self.ids = list(self.vectorstore.index_to_docstore_id.values())
+        self.lexical = BM25Index.from_documents(self.docs, self.ids)
+        self.config = RetrievalConfig(top_k=3, fan_out="files")
+
+    def sources(self, docs):
+        return {doc.metadata["source"] for doc in docs}
+
+    def test_every_file_is_searched(self):
+        question = "entropy heat"
+        vector = self.vectorstore.embedding_function.embed_query(question)
+        single = retrieve(self.vectorstore, question, self.config, vector, self.lexical)
+        fanned = retrieve_many(self.vectorstore, [(question, vector)], self.config, self.lexical, ["a.pdf", "b.pdf"])
+
+        self.assertEqual(self.sources(single), {"a.pdf"})
+        self.assertEqual(self.sources(fanned), {"a.pdf", "b.pdf"})
+        self.assertEqual(len(fanned), len({doc.id for doc in fanned}))
+
+    def test_every_file_is_searched_with_mmr(self):
+        config = RetrievalConfig(top_k=2, search_type="mmr", hybrid=False)
+        vector = self.vectorstore.embedding_function.embed_query("entropy heat")
+        fanned = retrieve_many(self.vectorstore, [("entropy heat", vector)], config, None, ["a.pdf", "b.pdf"])
+
+        self.assertEqual(self.sources(fanned), {"a.pdf", "b.pdf"})
+        self.assertEqual(len(fanned), 3)
+
+    def test_a_file_far_from_the_question_is_still_searched(self):
+        # a.pdf fills far more than the widest search with chunks near the question
+        rng = np.random.default_rng(0)
+        question = np.zeros(8, dtype=np.float32)
+        near = [(f"a {i}", (question + rng.normal(0, 0.01, 8)).tolist()) for i in range(30)]
+        far = [(f"b {i}", (question + 5 + rng.normal(0, 0.01, 8)).tolist()) for i in range(5)]
+        metadatas = [{"source": "a.pdf"}] * 30 + [{"source": "b.pdf"}] * 5
+        vectorstore = FAISS.from_embeddings(near + far, DeterministicFakeEmbedding(size=8), metadatas=metadatas)
+
+        for search_type in ["similarity", "mmr"]:
+            config = RetrievalConfig(top_k=2, fetch_k=4, search_type=search_type, hybrid=False, fan_out="files")
+            fanned = retrieve_many(vectorstore, [("q", question.tolist())], config, None, ["a.pdf", "b.pdf"])
+            self.assertEqual(sorted(doc.metadata["source"] for doc in fanned), ["a.pdf", "a.pdf", "b.pdf", "b.pdf"])
+
+    def test_rows_of_a_product_quantizer_index_are_searched(self):
+        vectors = np.random.default_rng(0).random((300, 16), dtype=np.float32)
+        index = train_index(vectors, "flat", "pq")
+        index.add(vectors)
+
+        distances, rows = search_rows(index, vectors[:1], 3, np.array([5, 7], dtype=np.int64))
+
+        self.assertEqual(sorted(rows[0][:2]), [5, 7])
+        self.assertEqual(rows[0][2], -1)
+
+    def test_merged_results_take_turns_and_drop_duplicates(self):
+        a, b, c = (Document(page_content=name, id=name) for name in "abc")
+        self.assertEqual([doc.id for doc in merge_results([[a, b], [c, a]], 5)], ["a", "c", "b"])
+        self.assertEqual(len(merge_results([[a, b], [c]], 2)), 2)
+
+    def test_sub_queries_are_parsed(self):
+        text = "1. entropy of gases\n- Voltage drop\n\nentropy of gases\n2nd law\nmore"
+        self.assertEqual(
+            parse_sub_queries(text, "Q?", limit=3),
+            ["Q?", "entropy of gases", "Voltage drop", "2nd law"]
+        )
+
+    def test_question_is_split_into_parallel_searches(self):
+        llm = FakeListChatModel(responses=["entropy disorder\nvoltage resistor"])
+        config = RetrievalConfig(top_k=2, fan_out="sub_queries")
+        with patch("utils.query.retrieve_many", wraps=retrieve_many) as searched:
+            docs = asyncio.run(aretrieve(self.vectorstore, "entropy and voltage?", llm, config, lexical=self.lexical))
+
+        self.assertEqual([query for query, _ in searched.call_args.args[1]], ["entropy and voltage?", "entropy disorder", "voltage resistor"])
+        self.assertEqual(self.sources(docs), {"a.pdf", "b.pdf"})
+
+class TestConversationMemory(unittest.TestCase):
+    def setUp(self):
+        self.history = []
+        for turn in range(5):
+            self.history.append({"role": "user", "content": f"question {turn}"})
+            self.history.append({"role": "ai", "content": f"answer {turn}"})
+
+    def test_recent_messages_are_kept_within_budget(self):
+        memory = ConversationMemory(recent_turns=2)
+        full = memory.context(self.history, 1000)
+        self.assertTrue(full.startswith("User: question 0"))
+        self.assertTrue(full.endswith("Assistant: answer 4"))
+
+        # "Assistant: answer 4" and "User: question 4" take 5 tokens each
+        self.assertEqual(memory.context(self.history, 10), "User: question 4\nAssistant: answer 4")
+        self.assertEqual(memory.context(self.history, 0), "")
+
+    def test_older_turns_are_folded_into_the_summary(self):
+        memory = ConversationMemory(recent_turns=2)
+        self.assertEqual(len(memory.pending(self.history)), 6)
+        llm = FakeListChatModel(responses=["Asked questions 0 to 2."])
+
+        asyncio.run(memory.asummarize(llm, self.history))
+
+        self.assertEqual((memory.summary, memory.summarized), ("Asked questions 0 to 2.", 6))
+        self.assertEqual(memory.pending(self.history), [])
+        context = memory.context(self.history, 1000)
+        self.assertTrue(context.startswith("Summary of the earlier conversation: Asked questions 0 to 2.\nUser: question 3"))
+        self.assertNotIn("question 2", context)
+
+    def test_failed_summary_keeps_the_messages(self):
+        memory = ConversationMemory(recent_turns=2)
+        llm = MagicMock()
+        llm.ainvoke.side_effect = RuntimeError("quota")
+
+        asyncio.run(memory.asummarize(llm, self.history))
+
+        self.assertEqual((memory.summary, memory.summarized), ("", 0))
+        self.assertIn("question 0", memory.context(self.history, 1000))
+        # The error waits for the session's script thread to log it
+        self.assertEqual(memory.take_messages(), [("Unable to summarize conversation - quota", "error")])
+        self.assertEqual(memory.take_messages(), [])
+
+    def test_budget_is_capped_by_the_model_window(self):
+        config = RetrievalConfig(context_tokens=4000, history_tokens=2000)
+        self.assertEqual(history_budget("gemini-2.0-flash", config, "question"), 2000)
+        config = RetrievalConfig(context_tokens=30000, history_tokens=2000)
+        self.assertEqual(history_budget("unknown-model", config, ""), 0)
+
+    def test_follow_ups_are_answered_with_the_conversation(self):
+        llm = FakeListChatModel(responses=["ok"])
+        messages = build_messages(llm, "Explain that again", [], conversation="User: What is entropy?")
+        self.assertIn("User: What is entropy?", messages[-1].content)
+        self.assertIn("Follow-up question: Explain that again", messages[-1].content)
+
+    def test_follow_up_answers_are_cached_by_standalone_query(self):
+        vectorstore = FAISS.from_documents([Document(page_content="Entropy measures disorder.")], DeterministicFakeEmbedding(size=8))
+        cache = AnswerCache()
+
+        def ask(llm, conversation):
+            answer = astream_cached_answer(
+                vectorstore, "Explain that again", llm, ("set", "model"),
+                cache=cache, log=lambda *args: None, conversation=conversation
+            )
+
+            async def collect():
+                return "".join([piece async for piece in answer])
+
+            return asyncio.run(collect())
+
+        # Each follow-up is rewritten as a standalone query, which the answer is cached under
+        self.assertEqual(ask(FakeListChatModel(responses=["entropy", "first"]), "User: What is entropy?"), "first")
+        self.assertEqual(ask(FakeListChatModel(responses=["voltage", "second"]), "User: What is voltage?"), "second")
+        self.assertEqual(ask(FakeListChatModel(responses=["entropy", "third"]), "User: Define entropy."), "first")
+
+    def test_follow_ups_are_searched_as_standalone_questions(self):
+        docs = [
+            Document(page_content="Entropy measures disorder.", metadata={"source": "a.pdf"}),
+            Document(page_content="Voltage drives current.", metadata={"source": "a.pdf"}),
+        ]
+        vectorstore = FAISS.from_documents(docs, DeterministicFakeEmbedding(size=8))
+        llm = FakeListChatModel(responses=["It drives current."])
+        rewrite_llm = FakeListChatModel(responses=["Voltage drives current."])
+        conversation = "User: What is voltage?\nAssistant: A potential difference."
+
+        with patch("utils.query.aretrieve", wraps=aretrieve) as searched:
+            answer = collect(astream_answer(
+                vectorstore, "What does it do?", llm, RetrievalConfig(top_k=1, hybrid=False),
+                conversation=conversation, rewrite_llm=rewrite_llm
+            ))
+
+        self.assertEqual(searched.call_args.args[1], "Voltage drives current.")
+        self.assertEqual("".join(answer), "It drives current.")
+
+    def test_standalone_questions_are_not_condensed(self):
+        vectorstore = FAISS.from_documents([Document(page_content="Entropy measures disorder.")], DeterministicFakeEmbedding(size=8))
+        llm = FakeListChatModel(responses=["Disorder."])
+
+        with patch("utils.query.acondense_question") as condense:
+            answer = collect(astream_answer(
+                vectorstore, "What is entropy in thermodynamics?", llm, RetrievalConfig(top_k=1, hybrid=False),
+                conversation="User: What is voltage?"
+            ))
+
+        condense.assert_not_called()
+        self.assertEqual("".join(answer), "Disorder.")
+        self.assertTrue(refers_back("Why is that?"))
+        self.assertTrue(refers_back("And the second?"))
+
+class TestQueryRunner(unittest.TestCase):
+    def test_waiting_sessions_take_turns(self):
+        async def scenario():
+            limiter = FairLimiter(limit=1, per_session=1)
+            order = []
+
+            async def ask(session_id, name):
+                async with limiter.slot(session_id):
+                    order.append(name)
+                    await asyncio.sleep(0)
+
+            await asyncio.gather(ask("a", "a1"), ask("a", "a2"), ask("a", "a3"), ask("b", "b1"))
+            return order, limiter.active
+
+        order, active = asyncio.run(scenario())
+        self.assertEqual(order, ["a1", "a2", "b1", "a3"])
+        self.assertEqual(active, 0)
+
+    def test_concurrency_is_bounded(self):
+        async def scenario():
+            limiter = FairLimiter(limit=2, per_session=1)
+            running, peak = 0, 0
+
+            async def ask(session_id):
+                nonlocal running, peak
+                async with limiter.slot(session_id):
+                    running += 1
+                    peak = max(peak, running)
+                    await asyncio.sleep(0.01)
+                    running -= 1
+
+            await asyncio.gather(*(ask(f"s{i % 3}") for i in range(9)))
+            return peak
+
+        self.assertEqual(asyncio.run(scenario()), 2)
+
+    def test_cancelled_waiter_gives_up_its_place(self):
+        async def scenario():
+            limiter = FairLimiter(limit=1)
+            await limiter.acquire("a")
+            waiter = asyncio.ensure_future(limiter.acquire("b"))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.sleep(0)
+            limiter.release("a")
+            return limiter.active, limiter.waiting
+
+        self.assertEqual(asyncio.run(scenario()), (0, 0))
+
+    def test_answer_is_streamed_from_the_loop(self):
+        docs = [Document(page_content="Entropy measures disorder.", metadata={"source": "a.pdf"})]
+        vectorstore = FAISS.from_documents(docs, DeterministicFakeEmbedding(size=8))
+        llm = FakeListChatModel(responses=["Disorder."])
+        runner = QueryRunner(limit=2)
+        logs = []
+
+        async def answer(log):
+            log("started")
+            async for piece in astream_answer(vectorstore, "What is entropy?", llm, RetrievalConfig(top_k=1)):
+                yield piece
+
+        spans = []
+        pieces = list(runner.stream(
+            "session", answer, log=lambda message, status="info": logs.append(message), timing=spans.append
+        ))
+
+        self.assertEqual("".join(pieces), "Disorder.")
+        self.assertEqual(logs, ["started"])
+        # Stage timings of the loop reach the session like log messages
+        self.assertEqual([span.name for span in spans], ["query_wait", "embed_question", "retrieve", "generate"])
+        self.assertEqual(runner.stats(), {"running": 0, "waiting": 0, "background": 0})
+
+    def test_background_work_does_not_hold_up_the_next_answer(self):
+        runner = QueryRunner(limit=1, per_session=1, background_limit=1)
+        started, finish = threading.Event(), threading.Event()
+
+        async def summarize():
+            started.set()
+            await asyncio.to_thread(finish.wait, 5)
+            return "summary"
+
+        async def answer(log):
+            yield "answer"
+
+        summary = runner.submit("session", summarize())
+        started.wait(5)
+        self.assertEqual(runner.stats(), {"running": 0, "waiting": 0, "background": 1})
+        self.assertEqual(list(runner.stream("session", answer, log=no_log, timing=lambda span: None)), ["answer"])
+        finish.set()
+        self.assertEqual(summary.result(5), "summary")
+        self.assertEqual(runner.stats()["background"], 0)
+
+    def test_errors_reach_the_script_thread(self):
+        runner = QueryRunner(limit=1)
+
+        async def answer(log):
+            raise ValueError("quota")
+            yield
+
+        with self.assertRaises(ValueError):
+            list(runner.stream("session", answer))
+        self.assertEqual(runner.stats()["running"], 0)
+
+class TestAnswerCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = AnswerCache(threshold=0.9, ttl_seconds=60, max_entries=2, clock=self.clock)
+
+    def test_similar_question_in_same_namespace_hits(self):
+        self.cache.put(("docs", "model"), [1.0, 0.0], "answer", latency=2.0)
+
+        self.assertEqual(self.cache.get(("docs", "model"), [0.99, 0.05]).answer, "answer")
+        self.assertIsNone(self.cache.get(("docs", "model"), [0.0, 1.0]))
+        self.assertIsNone(self.cache.get(("other docs", "model"), [1.0, 0.0]))
+        self.assertEqual((self.cache.hits, self.cache.misses, self.cache.saved_seconds), (1, 2, 2.0))
+
+    def test_entries_expire_and_are_evicted(self):
+        self.cache.put(("docs", "model"), [1.0, 0.0], "old", latency=1.0)
+        self.clock.now = 61
+        self.assertIsNone(self.cache.get(("docs", "model"), [1.0, 0.0]))
+
+        for i, vector in enumerate([[1.0, 0.0], [0.0, 1.0], [-1.0, 0.0]]):
+            self.cache.put(("docs", "model"), vector, f"answer {i}", latency=1.0)
+        self.assertIsNone(self.cache.get(("docs", "model"), [1.0, 0.0]))
+        self.assertEqual(self.cache.get(("docs", "model"), [-1.0, 0.0]).answer, "answer 2")
+
+    def test_repeated_question_skips_generation(self):
+        vectorstore = FAISS.from_texts(["Mitochondria make ATP."], DeterministicFakeEmbedding(size=8))
+        llm = FakeListChatModel(responses=["They make ATP."])
+        cache = AnswerCache()
+        question = "What do mitochondria do?"
+
+        first = "".join(collect(astream_cached_answer(vectorstore, question, llm, ("docs", "fake"), cache=cache, log=no_log)))
+        with patch.object(FakeListChatModel, "astream", side_effect=AssertionError("LLM called")):
+            second = "".join(collect(astream_cached_answer(vectorstore, question, llm, ("docs", "fake"), cache=cache, log=no_log)))
+
+        self.assertEqual(first, second)
+        self.assertEqual(cache.hits, 1)
+
+class TestClientRegistry(unittest.TestCase):
+    def test_clients_are_reused_per_model_and_settings(self):
+        self.assertIs(get_chat_model("gemini-2.0-flash", temperature=0.9), get_chat_model("gemini-2.0-flash", temperature=0.9))
+        self.assertIsNot(get_chat_model("gemini-2.0-flash", temperature=0.9), get_chat_model("gemini-2.0-flash", temperature=0.2))
+        self.assertIs(get_embedding_model("gemini-embedding-001"), get_embedding_model("gemini-embedding-001"))
+
+class FakeClock:
+    """Manually advanced clock whose sleep just moves time forward."""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class QuotaLimitedEmbeddings(CountingEmbeddings):
+    """Fake embedder that rejects its first request with a quota error."""
+    failures: int = 1
+    batches: list = []
+
+    def embed_documents(self, texts):
+        if self.failures:
+            self.failures -= 1
+            raise Exception("429 Resource has been exhausted (e.g. check quota).")
+        self.batches.append(list(texts))
+        return super().embed_documents(texts)
+
+class TestEmbeddingScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = TokenBucket(60, capacity=1, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_batches_keep_order_and_report_progress(self):
+        fake = QuotaLimitedEmbeddings(size=8, failures=0, batches=[])
+        progress = []
+        scheduled = ScheduledEmbeddings(fake, batch_size=2, max_concurrency=3, bucket=self.bucket,
+                                        on_progress=lambda done, total: progress.append((done, total)))
+        texts = [f"chunk {i}" for i in range(5)]
+
+        vectors = scheduled.embed_documents(texts)
+
+        self.assertEqual(vectors, DeterministicFakeEmbedding(size=8).embed_documents(texts))
+        self.assertEqual(sorted(len(batch) for batch in fake.batches), [1, 2, 2])
+        self.assertEqual(progress[-1], (5, 5))
+
+    def test_quota_errors_are_retried_with_backoff(self):
+        fake = QuotaLimitedEmbeddings(size=8, failures=2, batches=[])
+        scheduled = ScheduledEmbeddings(fake, batch_size=10, bucket=self.bucket, backoff_seconds=5)
+
+        vectors = scheduled.embed_documents(["alpha", "beta"])
+
+        self.assertEqual(len(vectors), 2)
+        self.assertEqual(scheduled.retries, 2)
+        self.assertGreaterEqual(self.clock.now, 15)
+
+    def test_other_errors_are_not_retried(self):
+        fake = MagicMock()
+        fake.embed_documents.side_effect = ValueError("bad input")
+        scheduled = ScheduledEmbeddings(fake, bucket=self.bucket)
+
+        with self.assertRaises(ValueError):
+            scheduled.embed_documents(["alpha"])
+        self.assertEqual(fake.embed_documents.call_count, 1)
+
+    def test_bucket_paces_requests(self):
+        for _ in range(3):
+            self.bucket.acquire()
+
+        self.assertAlmostEqual(self.clock.now, 2.0)
+
+    def test_questions_do_not_wait_for_document_batches(self):
+        self.bucket.pause(60)
+        threads = []
+
+        class SyncOnlyEmbeddings(DeterministicFakeEmbedding):
+            def embed_query(self, text):
+                threads.append(threading.current_thread().name)
+                return super().embed_query(text)
+
+        scheduled = ScheduledEmbeddings(SyncOnlyEmbeddings(size=8), bucket=self.bucket)
+        cached = CachedEmbeddings(scheduled, "fake-model", EmbeddingCache(":memory:"))
+
+        vector = asyncio.run(cached.aembed_query("What is entropy?"))
+
+        self.assertEqual(vector, DeterministicFakeEmbedding(size=8).embed_query("What is entropy?"))
+        self.assertEqual(self.clock.now, 0)
+        # Sync-only clients get their own threads, not the loop's default executor
+        self.assertTrue(threads[0].startswith("embed-query"))
+
+    def test_question_bucket_waits_on_the_loop(self):
+        query_bucket = TokenBucket(600, capacity=1)
+        scheduled = ScheduledEmbeddings(DeterministicFakeEmbedding(size=8), bucket=self.bucket, query_bucket=query_bucket)
+
+        async def ask_twice():
+            start = time.monotonic()
+            await asyncio.gather(scheduled.aembed_query("a"), scheduled.aembed_query("b"))
+            return time.monotonic() - start
+
+        self.assertGreaterEqual(asyncio.run(ask_twice()), 0.09)
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
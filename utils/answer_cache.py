@@ -0,0 +1,120 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.95
+DEFAULT_TTL_SECONDS = 60 * 60
+DEFAULT_MAX_ENTRIES = 1000
+
+
+class CachedAnswer:
+    """An answer together with what it cost to generate."""
+
+    def __init__(self, namespace: tuple, vector: np.ndarray, answer: str, latency: float, created: float):
+        self.namespace = namespace
+        self.vector = vector
+        self.answer = answer
+        self.latency = latency
+        self.created = created
+
+
+class AnswerCache:
+    """
+    Cache of generated answers looked up by question similarity.
+
+    Answers are grouped by namespace, normally the document set hash and model
+    name, so they are only reused for the same PDFs and LLM. A question hits
+    when the cosine similarity of its embedding to a cached question reaches
+    `threshold`. Entries expire after `ttl_seconds` and the least recently used
+    ones are evicted beyond `max_entries`.
+    """
+
+    def __init__(
+        self,
+        threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        clock=time.monotonic
+    ):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._entries = OrderedDict()
+        self._namespaces = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        ids = self._namespaces[entry.namespace]
+        ids.discard(entry_id)
+        if not ids:
+            del self._namespaces[entry.namespace]
+
+    def get(self, namespace: tuple, vector: list):
+        """
+        Finds the cached answer to the most similar question in a namespace.
+
+        Args:
+            namespace (tuple): E.g. `(document set hash, model name)`.
+            vector (list): Embedding of the new question.
+
+        Returns:
+            CachedAnswer: Best match at or above the threshold, or None.
+        """
+        query = _normalize(vector)
+        with self._lock:
+            now = self.clock()
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._namespaces.get(namespace, ())):
+                entry = self._entries[entry_id]
+                if now - entry.created > self.ttl_seconds:
+                    self._remove(entry_id)
+                    continue
+                score = float(np.dot(entry.vector, query))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            entry = self._entries[best_id]
+            self.hits += 1
+            self.saved_seconds += entry.latency
+            return entry
+
+    def put(self, namespace: tuple, vector: list, answer: str, latency: float):
+        """
+        Stores a generated answer.
+
+        Args:
+            namespace (tuple): E.g. `(document set hash, model name)`.
+            vector (list): Embedding of the question.
+            answer (str): Generated answer.
+            latency (float): Seconds it took to produce the answer.
+        """
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = CachedAnswer(namespace, _normalize(vector), answer, latency, self.clock())
+            self._namespaces.setdefault(namespace, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+
+def _normalize(vector: list) -> np.ndarray:
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array)
+    return array / norm if norm else array
@@ -0,0 +1,58 @@
+import threading
+from pathlib import Path
+
+from utils.logs import add_to_log
+
+# Text of files read so far, with the modification time and size they had
+_assets = {}
+_assets_lock = threading.Lock()
+
+
+def read_asset(path) -> str:
+    """
+    Reads a static text file, once per server process.
+
+    The file is read again only when its modification time or size changed,
+    so edits show up without a restart while reruns skip the read.
+
+    Args:
+        path (Path or str): File to read.
+
+    Returns:
+        str: File content.
+
+    Raises:
+        OSError: If the file cannot be read.
+    """
+    path = Path(path)
+    stat = path.stat()
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _assets.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    text = path.read_text(encoding="utf-8")
+    with _assets_lock:
+        _assets[path] = (signature, text)
+    return text
+
+
+def load_css(path: Path = Path('static/styles.css')) -> str:
+    """
+    Loads a CSS stylesheet from a local file.
+
+    Args:
+        path (Path): Path to the CSS file (default: 'static/styles.css').
+
+    Returns:
+        str: The content of the CSS file if successfully loaded, otherwise an empty string.
+    """
+    try:
+        if not path.is_file():
+            add_to_log(f"❗Error loading stylesheet: {path} does not exist.", "error")
+            return ""
+        return read_asset(path)
+    except FileNotFoundError:
+        add_to_log("❗Error loading stylesheet: File not found.", "error")
+    except Exception:
+        add_to_log("❗Error loading stylesheet.", "error")
+    return ""
@@ -1,6 +1,15 @@
+import streamlit as st
 from streamlit import session_state as sst
 from streamlit_chat import message
 from utils.logs import add_to_log
+from utils.metrics import add_timing
+from utils.memory import ConversationMemory
+
+# Session state of the answer being generated, see `start_answer`
+ANSWER_KEYS = ("pending_answer", "pending_answer_cursor", "pending_answer_span_cursor")
+# Most recent messages drawn on each rerun, and how many more each "show earlier" adds
+CHAT_WINDOW = 20
+CHAT_PAGE_SIZE = 20
     
 def initialize_chat_history():
   """
@@ -13,16 +22,37 @@ def initialize_chat_history():
       'content': "Hi! I'm AskNotes.ai. Ask me anything about the uploaded PDF!"
     }
   ]
+  sst["chat_window"] = CHAT_WINDOW
+  sst["conversation_memory"] = ConversationMemory()
   add_to_log("Chat History Initialized.", "success")
 
+def show_earlier_messages():
+  """
+  Widens the chat window by one page of older messages.
+  """
+  sst.chat_window = sst.get("chat_window", CHAT_WINDOW) + CHAT_PAGE_SIZE
+
 def show_chat(messages: list):
   """
-  Display chat messages stored in session state.
+  Display the most recent chat messages stored in session state.
+
+  Only the last `sst.chat_window` messages are drawn; older ones stay collapsed
+  behind a button that loads them a page at a time. Each message is keyed by
+  its position in the history, so unchanged messages keep their component
+  across reruns instead of being created again.
 
   Args:
       messages (list): List of messages in the chat history.
   """
-  for i, msg in enumerate(messages):
+  start = max(0, len(messages) - sst.get("chat_window", CHAT_WINDOW))
+  if start > 0:
+    st.button(
+      f"Show earlier messages ({start} hidden)",
+      on_click=show_earlier_messages,
+      use_container_width=True
+    )
+  for i in range(start, len(messages)):
+    msg = messages[i]
     message(
       message=msg['content'], 
       is_user=msg['role'] == 'user', 
@@ -46,8 +76,71 @@ def add_to_chat(role, content):
   )
   add_to_log("Message Added to Chat History..")
   
+  # Same key `show_chat` gives it on the next rerun, so the component is reused
   message(
     message=content, 
-    is_user=(role == 'user')
+    is_user=(role == 'user'),
+    key=str(len(sst.chat_history) - 1)
   )
   add_to_log("Displaying Message..")
+
+def start_answer(answer):
+  """
+  Keeps the answer this session is waiting for, for `finish_answer` to poll.
+
+  Args:
+      answer (PendingAnswer): Answer being generated on the query loop.
+  """
+  sst.pending_answer = answer
+  sst.pending_answer_cursor = 0
+  sst.pending_answer_span_cursor = 0
+
+def show_partial_answer():
+  """
+  Display the part of the pending answer generated so far.
+  """
+  answer = sst.get("pending_answer")
+  if answer is None:
+    return
+  content = answer.text
+  if content:
+    st.markdown(content + "▌")
+  else:
+    st.caption("Generating response...")
+
+def finish_answer():
+  """
+  Forwards the log messages and stage timings of this session's pending answer
+  and, once it is complete, adds it to the chat history. Runs in the script thread.
+
+  Returns:
+      PendingAnswer: The finished answer, or None if there is none or it is not done yet.
+  """
+  answer = sst.get("pending_answer")
+  if answer is None:
+    return None
+  messages, sst.pending_answer_cursor = answer.messages_since(sst.pending_answer_cursor)
+  for text, status in messages:
+    add_to_log(text, status)
+  spans, sst.pending_answer_span_cursor = answer.spans_since(sst.pending_answer_span_cursor)
+  for span in spans:
+    add_timing(span)
+  if not answer.done:
+    return None
+
+  for key in ANSWER_KEYS:
+    del sst[key]
+  if answer.error is None:
+    add_to_log("Response streamed.")
+    add_to_chat("ai", answer.text)
+  return answer
+
+def cancel_answer():
+  """
+  Stops generating the answer this session is waiting for.
+  """
+  answer = sst.get("pending_answer")
+  if answer is not None:
+    answer.cancel()
+    for key in ANSWER_KEYS:
+      sst.pop(key, None)
@@ -0,0 +1,34 @@
+import streamlit as st
+from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+
+GEMINI_API_KEY = st.secrets['GEMINI_API_KEY']
+
+@st.cache_resource
+def get_chat_model(model: str, temperature: float = 0.9) -> ChatGoogleGenerativeAI:
+    """
+    Returns the Gemini chat client for a model and settings, creating it on first use.
+    Clients are shared across reruns and sessions so their connections are reused.
+
+    Args:
+        model (str): Gemini model name.
+        temperature (float, optional): Sampling temperature. Defaults to 0.9.
+
+    Returns:
+        ChatGoogleGenerativeAI: Shared chat client.
+    """
+    return ChatGoogleGenerativeAI(model=model, temperature=temperature, google_api_key=GEMINI_API_KEY)
+
+@st.cache_resource
+def get_embedding_model(model: str, transport: str = "rest") -> GoogleGenerativeAIEmbeddings:
+    """
+    Returns the Gemini embedding client for a model, creating it on first use.
+    Clients are shared across reruns and sessions so their connections are reused.
+
+    Args:
+        model (str): Gemini embedding model name.
+        transport (str, optional): API transport. Defaults to "rest".
+
+    Returns:
+        GoogleGenerativeAIEmbeddings: Shared embedding client.
+    """
+    return GoogleGenerativeAIEmbeddings(model=model, transport=transport, google_api_key=GEMINI_API_KEY)
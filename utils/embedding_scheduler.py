@@ -0,0 +1,190 @@
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_BATCH_SIZE = 100  # Gemini accepts at most 100 texts per batch request
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_REQUESTS_PER_MINUTE = 15
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_SECONDS = 2.0
+# Threads embedding questions for clients without a native async API, kept apart
+# from the event loop's default executor that runs index searches
+QUERY_EMBEDDING_WORKERS = 8
+_query_pool = ThreadPoolExecutor(max_workers=QUERY_EMBEDDING_WORKERS, thread_name_prefix="embed-query")
+
+
+def is_quota_error(error: Exception) -> bool:
+    """
+    Tells whether an embedding error was caused by rate limiting or an exhausted quota.
+
+    Args:
+        error (Exception): Error raised by the embedding client.
+
+    Returns:
+        bool: True for HTTP 429 / RESOURCE_EXHAUSTED style errors.
+    """
+    while error is not None:
+        if type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+            return True
+        message = str(error).lower()
+        if "429" in message or "resource_exhausted" in message or "resource has been exhausted" in message or "quota" in message:
+            return True
+        error = error.__cause__
+    return False
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket that paces requests to a per-minute budget.
+
+    `acquire` blocks until a request may be sent, `aacquire` waits for it on the
+    event loop instead. `pause` stops all callers for a while, which is how a
+    quota error from one batch slows down every batch.
+    """
+
+    def __init__(self, requests_per_minute: float, capacity: float = None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, requests_per_minute / 4)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self._updated = clock()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take(self) -> float:
+        # Takes a token if there is one, otherwise tells how long to wait for it
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Blocks until one request token is available and takes it."""
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            self.sleep(wait)
+
+    async def aacquire(self):
+        """Waits on the event loop, without holding a thread, until a token is available and takes it."""
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Holds back every caller for `seconds` and empties the bucket.
+
+        Args:
+            seconds (float): How long no request may be sent.
+        """
+        with self._lock:
+            now = self.clock()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self.tokens = 0
+            self._updated = now
+
+
+class ScheduledEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that sends chunks in batches, several batches at a time,
+    while keeping to a requests-per-minute budget.
+
+    Quota errors are retried with exponential backoff, during which the shared
+    token bucket is paused for all batches. Progress is reported through
+    `on_progress(done, total)`, always from the calling thread so it can update
+    Streamlit elements.
+
+    Questions are embedded one at a time and never wait behind document batches:
+    they are paced by `query_bucket` if one is given, and not at all otherwise.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        backoff_seconds: float = DEFAULT_BACKOFF_SECONDS,
+        bucket: TokenBucket = None,
+        sleep=time.sleep,
+        on_progress=None,
+        query_bucket: TokenBucket = None
+    ):
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.bucket = bucket or TokenBucket(requests_per_minute, sleep=sleep)
+        self.on_progress = on_progress
+        self.query_bucket = query_bucket
+        self.retries = 0
+
+    def _embed_batch(self, batch: list) -> list:
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                return self.embeddings.embed_documents(batch)
+            except Exception as e:
+                if not is_quota_error(e) or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff_seconds * (2 ** attempt) * (1 + random.random() / 2)
+                self.bucket.pause(delay)
+                self.retries += 1
+                attempt += 1
+
+    def embed_documents(self, texts: list) -> list:
+        batches = [texts[start:start + self.batch_size] for start in range(0, len(texts), self.batch_size)]
+        if not batches:
+            return []
+
+        results = [None] * len(batches)
+        done = 0
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+            futures = {executor.submit(self._embed_batch, batch): index for index, batch in enumerate(batches)}
+            try:
+                for future in as_completed(futures):
+                    index = futures[future]
+                    results[index] = future.result()
+                    done += len(batches[index])
+                    if self.on_progress:
+                        self.on_progress(done, len(texts))
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        return [vector for batch_vectors in results for vector in batch_vectors]
+
+    def embed_query(self, text: str) -> list:
+        if self.query_bucket is not None:
+            self.query_bucket.acquire()
+        return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> list:
+        if self.query_bucket is not None:
+            await self.query_bucket.aacquire()
+        if type(self.embeddings).aembed_query is not Embeddings.aembed_query:
+            return await self.embeddings.aembed_query(text)
+        # The client has no async API; its blocking call gets a thread of our own
+        return await asyncio.get_running_loop().run_in_executor(_query_pool, self.embeddings.embed_query, text)
@@ -0,0 +1,211 @@
+import math
+import threading
+import weakref
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ["auto", "flat", "ivf", "hnsw"]
+VECTOR_CODECS = ["float32", "float16", "pq"]
+RECALL_LEVELS = ["fast", "balanced", "accurate"]
+# Below this many chunks exact search is fast enough and needs no training
+AUTO_IVF_MIN_CHUNKS = 20000
+# Training points k-means wants per centroid before it warns about quality
+TRAINING_POINTS_PER_CENTROID = 39
+HNSW_NEIGHBORS = 32
+# Share of IVF lists scanned and HNSW candidate list size per recall level
+IVF_PROBE_FRACTION = {"fast": 0.01, "balanced": 0.05, "accurate": 0.2}
+HNSW_EF_SEARCH = {"fast": 16, "balanced": 64, "accurate": 256}
+
+# Search parameters live on the index, so each shared index gets a lock for changing them
+_recall_locks = weakref.WeakKeyDictionary()
+_recall_locks_lock = threading.Lock()
+
+
+def resolve_index_type(index_type: str, n_vectors: int) -> str:
+    """
+    Picks the index structure for a number of chunks.
+
+    Args:
+        index_type (str): One of `INDEX_TYPES`.
+        n_vectors (int): Number of chunks the index will hold.
+
+    Returns:
+        str: "flat", "ivf" or "hnsw".
+    """
+    if index_type != "auto":
+        return index_type
+    return "ivf" if n_vectors >= AUTO_IVF_MIN_CHUNKS else "flat"
+
+
+def get_index_type(index: faiss.Index) -> str:
+    """
+    Tells which structure an existing index has.
+
+    Args:
+        index (faiss.Index): FAISS index.
+
+    Returns:
+        str: "flat", "ivf" or "hnsw".
+    """
+    if faiss.try_extract_index_ivf(index) is not None:
+        return "ivf"
+    if isinstance(faiss.downcast_index(index), faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def supports_removal(index: faiss.Index) -> bool:
+    """HNSW graphs cannot drop vectors, they have to be rebuilt instead."""
+    return get_index_type(index) != "hnsw"
+
+
+def _pq_layout(dim: int, n_vectors: int) -> tuple:
+    # Sub-vectors of about 8 dimensions, and no more centroids than the data can train
+    subquantizers = max(m for m in range(1, max(dim // 8, 1) + 1) if dim % m == 0)
+    nbits = int(math.log2(max(n_vectors // TRAINING_POINTS_PER_CENTROID, 2)))
+    return subquantizers, min(max(nbits, 1), 8)
+
+
+def get_factory_string(index_type: str, codec: str, n_vectors: int, dim: int) -> str:
+    """
+    Describes the FAISS index to build for a set of chunks.
+
+    Args:
+        index_type (str): One of `INDEX_TYPES`.
+        codec (str): One of `VECTOR_CODECS`, how the vectors are stored.
+        n_vectors (int): Number of chunks the index is trained on.
+        dim (int): Embedding dimension.
+
+    Returns:
+        str: `faiss.index_factory` description.
+    """
+    index_type = resolve_index_type(index_type, n_vectors)
+    subquantizers, nbits = _pq_layout(dim, n_vectors)
+    if index_type == "hnsw":
+        # HNSW product quantizers always use 8 bit codes, which need 256 training points
+        if codec == "pq" and n_vectors >= 256:
+            return f"HNSW{HNSW_NEIGHBORS}_PQ{subquantizers}"
+        if codec == "float32":
+            return f"HNSW{HNSW_NEIGHBORS}"
+        return f"HNSW{HNSW_NEIGHBORS}_SQfp16"
+
+    storage = {"float32": "Flat", "float16": "SQfp16", "pq": f"PQ{subquantizers}x{nbits}"}[codec]
+    if index_type == "ivf":
+        nlist = max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // TRAINING_POINTS_PER_CENTROID))
+        return f"IVF{nlist},{storage}"
+    return storage
+
+
+def train_index(vectors: list, index_type: str = "auto", codec: str = "float32") -> faiss.Index:
+    """
+    Creates an empty index of the requested type, trained on the given vectors.
+
+    Args:
+        vectors (list): Embeddings of all chunks the index is built for.
+        index_type (str, optional): One of `INDEX_TYPES`. Defaults to "auto".
+        codec (str, optional): One of `VECTOR_CODECS`. Defaults to "float32".
+
+    Returns:
+        faiss.Index: Index ready for `add`.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    index = faiss.index_factory(vectors.shape[1], get_factory_string(index_type, codec, len(vectors), vectors.shape[1]))
+    if not index.is_trained:
+        index.train(vectors)
+    return index
+
+
+def vector_nbytes(index: faiss.Index) -> int:
+    """
+    Estimates the memory held by an index's vectors, graph links included.
+
+    Args:
+        index (faiss.Index): FAISS index.
+
+    Returns:
+        int: Approximate size in bytes.
+    """
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        links = index.ntotal * HNSW_NEIGHBORS * 2 * 4
+        return vector_nbytes(index.storage) + links
+    return index.ntotal * getattr(index, "code_size", index.d * 4)
+
+
+def _recall_lock(index: faiss.Index) -> threading.Lock:
+    with _recall_locks_lock:
+        lock = _recall_locks.get(index)
+        if lock is None:
+            lock = _recall_locks[index] = threading.Lock()
+        return lock
+
+
+def _recall_setting(index: faiss.Index, recall: str) -> tuple:
+    # Object holding the index's search parameter, its name and the value for `recall`
+    index_type = get_index_type(index)
+    if index_type == "ivf":
+        params = faiss.extract_index_ivf(index)
+        return params, "nprobe", max(1, math.ceil(params.nlist * IVF_PROBE_FRACTION[recall]))
+    if index_type == "hnsw":
+        return faiss.downcast_index(index).hnsw, "efSearch", HNSW_EF_SEARCH[recall]
+    return None, None, None
+
+
+def set_recall(index: faiss.Index, recall: str = "balanced"):
+    """
+    Applies a recall level to an approximate index before searching it.
+
+    The index's lock is only taken when the level actually changes, and searches
+    run without it. A search racing a session that switches the level uses either
+    setting, which only shifts its recall a little. Flat indexes are exact and
+    are left alone.
+
+    Args:
+        index (faiss.Index): FAISS index about to be searched.
+        recall (str, optional): One of `RECALL_LEVELS`. Defaults to "balanced".
+    """
+    params, name, value = _recall_setting(index, recall)
+    if params is not None and getattr(params, name) != value:
+        with _recall_lock(index):
+            setattr(params, name, value)
+
+
+def search_rows(index: faiss.Index, vectors: np.ndarray, k: int, rows: np.ndarray, recall: str = "balanced") -> tuple:
+    """
+    Searches only some rows of an index, e.g. the chunks of one PDF.
+
+    The rows are passed to FAISS as an ID selector, so the nearest `k` of them are
+    found however many other vectors are closer. Flat product quantizer indexes
+    cannot take a selector; they are scanned in full and the other rows dropped.
+
+    Args:
+        index (faiss.Index): FAISS index to search.
+        vectors (np.ndarray): Query vectors, one per row.
+        k (int): Results per query.
+        rows (np.ndarray): Row IDs to search, as int64.
+        recall (str, optional): One of `RECALL_LEVELS`. Defaults to "balanced".
+
+    Returns:
+        tuple: `(distances, row IDs)` like `index.search`, padded with -1.
+    """
+    if isinstance(faiss.downcast_index(index), faiss.IndexPQ):
+        distances, ids = index.search(vectors, index.ntotal)
+        keep = np.isin(ids, rows)
+        found_d = np.full((len(vectors), k), np.inf, dtype=np.float32)
+        found_i = np.full((len(vectors), k), -1, dtype=np.int64)
+        for query in range(len(vectors)):
+            hits = np.flatnonzero(keep[query])[:k]
+            found_d[query, :len(hits)] = distances[query, hits]
+            found_i[query, :len(hits)] = ids[query, hits]
+        return found_d, found_i
+
+    selector = faiss.IDSelectorBatch(rows)
+    _, name, value = _recall_setting(index, recall)
+    if name == "nprobe":
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=value)
+    elif name == "efSearch":
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=value)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    return index.search(vectors, k, params=params)
@@ -0,0 +1,255 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.metrics import forward_spans
+
+DEFAULT_WORKERS = 2
+
+
+class JobCancelled(Exception):
+    """Raised inside a job once every session waiting for it has cancelled."""
+
+
+class IndexPreview:
+    """
+    Searchable snapshot of the part of an index built so far.
+
+    Published by the worker after every batch and never changed afterwards, so
+    sessions can search it while the build goes on.
+    """
+
+    def __init__(self, vectorstore, lexical, pages_indexed: int, pages_total: int):
+        self.vectorstore = vectorstore
+        self.lexical = lexical
+        self.pages_indexed = pages_indexed
+        self.pages_total = pages_total
+
+    @property
+    def fraction(self) -> float:
+        return self.pages_indexed / self.pages_total if self.pages_total else 0.0
+
+    @property
+    def note(self) -> str:
+        """Tells the reader of an answer how much of the PDFs it is based on."""
+        return (f"Searched {self.pages_indexed} of {self.pages_total} pages ({self.fraction:.0%}), "
+                f"the rest of your PDFs is still being indexed.")
+
+
+class IndexJob:
+    """
+    Handle on an index build running in the background.
+
+    The worker reports progress and log messages through the handle; sessions
+    poll it from their script thread, because the worker must not touch session
+    state or draw anything. Several sessions can wait for the same job, and it
+    is only cancelled once all of them have given up on it. Stage timings are
+    kept for the sessions like log messages. Fresh indexes are
+    built in batches, and the part built so far is kept in `preview`.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.status = "running"
+        self.stage = "Queued"
+        self.files_parsed = 0
+        self.files_total = 0
+        self.chunks_embedded = 0
+        self.chunks_indexed = 0
+        self.chunks_total = 0
+        self.preview = None
+        self.result = None
+        self.error = None
+        self.messages = []
+        self.spans = []
+        self.skipped_files = []
+        self.subscribers = 1
+        self._result_taken = False
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @property
+    def fraction(self) -> float:
+        """Rough share of the work finished, parsing and embedding weighted equally."""
+        parsed = self.files_parsed / self.files_total if self.files_total else 0.0
+        embedded = self.chunks_embedded / self.chunks_total if self.chunks_total else 0.0
+        return min(1.0, (parsed + embedded) / 2)
+
+    def log(self, message: str, status: str = "info"):
+        """
+        Queues a message for the backend activity log of the waiting sessions.
+
+        Args:
+            message (str): Log message.
+            status (str, optional): "info", "success" or "error". Defaults to "info".
+        """
+        with self._lock:
+            self.messages.append((message, status))
+
+    def messages_since(self, cursor: int) -> tuple:
+        """
+        Returns the messages a session has not seen yet.
+
+        Args:
+            cursor (int): Number of messages the session already read.
+
+        Returns:
+            tuple: `(messages, new cursor)`.
+        """
+        with self._lock:
+            return self.messages[cursor:], len(self.messages)
+
+    def record_span(self, span):
+        """
+        Keeps a finished stage timing for the timings panel of the waiting sessions.
+
+        Args:
+            span (Span): Finished span.
+        """
+        with self._lock:
+            self.spans.append(span)
+
+    def spans_since(self, cursor: int) -> tuple:
+        """
+        Returns the stage timings a session has not seen yet.
+
+        Args:
+            cursor (int): Number of spans the session already read.
+
+        Returns:
+            tuple: `(spans, new cursor)`.
+        """
+        with self._lock:
+            return self.spans[cursor:], len(self.spans)
+
+    def embedded(self, done: int, total: int):
+        """Embedding progress callback for the current batch; also where a cancelled job stops."""
+        self.chunks_embedded = self.chunks_indexed + done
+        self.raise_if_cancelled()
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled(self.key)
+
+    def subscribe(self) -> bool:
+        """
+        Adds a waiting session, unless the job is already finishing or cancelled.
+
+        Returns:
+            bool: Whether the session can wait for this job.
+        """
+        with self._lock:
+            if self.done or self.cancelled:
+                return False
+            self.subscribers += 1
+            return True
+
+    def cancel(self):
+        """Withdraws one session's interest; the last one to leave stops the job."""
+        with self._lock:
+            self.subscribers -= 1
+            if self.subscribers <= 0 and not self.done:
+                self._cancelled.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Blocks until the job has finished.
+
+        Args:
+            timeout (float, optional): Seconds to wait at most.
+
+        Returns:
+            bool: Whether the job finished.
+        """
+        return self._done.wait(timeout)
+
+    def take_result(self, acquire):
+        """
+        Hands the built index to a waiting session. The first session gets the
+        job's own lease, later ones take a new reference via `acquire`.
+
+        Args:
+            acquire (callable): Called with the job key for every session after the first.
+
+        Returns:
+            IndexLease: Lease for the session, or None if the job built nothing.
+        """
+        with self._lock:
+            if not self._result_taken:
+                if self.result is None:
+                    return None
+                # The job no longer holds the lease, so it is released with the session
+                self._result_taken = True
+                lease, self.result = self.result, None
+                return lease
+        return acquire(self.key)
+
+    def _finish(self, status: str, result=None, error: Exception = None):
+        self.status = status
+        self.result = result
+        self.error = error
+        # The finished index replaces the preview
+        self.preview = None
+        self._done.set()
+
+
+class IndexJobManager:
+    """
+    Runs index builds on a small thread pool, one job per document set.
+
+    Submitting a key that is already being built returns the running job
+    instead of starting another one.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="index-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, build) -> IndexJob:
+        """
+        Starts a build, or joins the running build of the same key.
+
+        Args:
+            key (str): Document set hash identifying the build.
+            build (callable): Called with the `IndexJob` in a worker thread; returns the result.
+
+        Returns:
+            IndexJob: Handle to poll and cancel.
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.subscribe():
+                return job
+            job = IndexJob(key)
+            self._jobs[key] = job
+        self._executor.submit(self._run, job, build)
+        return job
+
+    def _run(self, job: IndexJob, build):
+        try:
+            job.raise_if_cancelled()
+            with forward_spans(job.record_span):
+                result = build(job)
+            job._finish("done", result=result)
+        except JobCancelled:
+            job._finish("cancelled")
+        except Exception as e:
+            job._finish("failed", error=e)
+        finally:
+            with self._lock:
+                if self._jobs.get(job.key) is job:
+                    del self._jobs[job.key]
+
+    def running(self) -> int:
+        """Number of builds queued or in progress."""
+        with self._lock:
+            return len(self._jobs)
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import uuid
+from pathlib import Path
+
+import faiss
+from langchain_community.vectorstores import FAISS
+
+from utils.lexical import BM25Index
+
+INDEX_DIR = Path(".cache/indexes")
+DEFAULT_MAX_SAVED_INDEXES = 50
+
+
+def get_document_set_hash(file_keys, settings: str = "") -> str:
+    """
+    Hashes a set of uploaded files together with the settings used to index them.
+
+    The hash does not depend on upload order, so the same PDFs always map to the
+    same saved index.
+
+    Args:
+        file_keys (iterable): Keys of the files, see `vectorstore.get_file_key`.
+        settings (str, optional): Embedding model and chunking settings. Defaults to "".
+
+    Returns:
+        str: Hex SHA-256 digest identifying the document set.
+    """
+    digest = hashlib.sha256(settings.encode("utf-8"))
+    for key in sorted(file_keys):
+        digest.update(b"\0" + key.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def save_index(set_hash: str, vectorstore: FAISS, file_ids: dict, lexical: BM25Index, index_dir: Path = None):
+    """
+    Writes a FAISS index, its docstore, keyword index and the per-file document IDs to disk.
+
+    Files are written to a temporary directory that is then renamed into place,
+    so a concurrent reader never sees a half-written index.
+
+    Args:
+        set_hash (str): Document set hash from `get_document_set_hash`.
+        vectorstore (FAISS): Vectorstore to save.
+        file_ids (dict): Document IDs of each indexed file.
+        lexical (BM25Index): Keyword index over the same chunks.
+        index_dir (Path, optional): Root directory of saved indexes. Defaults to INDEX_DIR.
+    """
+    index_dir = Path(index_dir or INDEX_DIR)
+    target = index_dir / set_hash
+    if target.exists():
+        return
+    staging = index_dir / f".{set_hash}.{uuid.uuid4().hex}"
+    staging.mkdir(parents=True)
+    try:
+        faiss.write_index(vectorstore.index, str(staging / "index.faiss"))
+        with open(staging / "docstore.pkl", "wb") as f:
+            pickle.dump((vectorstore.docstore, vectorstore.index_to_docstore_id), f)
+        with open(staging / "lexical.pkl", "wb") as f:
+            pickle.dump(lexical, f)
+        with open(staging / "file_ids.json", "w", encoding="utf-8") as f:
+            json.dump(file_ids, f)
+        os.replace(staging, target)
+    except OSError:
+        # Another process saved the same document set first
+        if not target.exists():
+            raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def load_index(set_hash: str, embeddings, index_dir: Path = None):
+    """
+    Loads a saved index. The FAISS data is read fully into memory: faiss can only
+    memory-map the inverted lists of IVF indexes, and those could then not be
+    copied for incremental updates. The `SharedIndexStore` memory budget bounds
+    how many loaded indexes stay in RAM instead.
+
+    Args:
+        set_hash (str): Document set hash from `get_document_set_hash`.
+        embeddings (Embeddings): Embedding function used for queries.
+        index_dir (Path, optional): Root directory of saved indexes. Defaults to INDEX_DIR.
+
+    Returns:
+        tuple: `(FAISS, file_ids, BM25Index)`, or `(None, None, None)` if the set was never saved.
+    """
+    path = Path(index_dir or INDEX_DIR) / set_hash
+    if not (path / "file_ids.json").is_file():
+        return None, None, None
+    index = faiss.read_index(str(path / "index.faiss"))
+    # Only files written by `save_index` in our own cache directory are unpickled
+    with open(path / "docstore.pkl", "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    with open(path / "file_ids.json", encoding="utf-8") as f:
+        file_ids = json.load(f)
+    if (path / "lexical.pkl").is_file():
+        with open(path / "lexical.pkl", "rb") as f:
+            lexical = pickle.load(f)
+    else:
+        # Saved before keyword search existed, rebuild it from the chunks
+        lexical = BM25Index.from_documents(list(docstore._dict.values()), list(docstore._dict))
+    # Record the access so pruning keeps recently used indexes
+    os.utime(path)
+    vectorstore = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id
+    )
+    return vectorstore, file_ids, lexical
+
+
+def prune_indexes(max_indexes: int = DEFAULT_MAX_SAVED_INDEXES, index_dir: Path = None):
+    """
+    Deletes the least recently used saved indexes beyond `max_indexes`.
+
+    Args:
+        max_indexes (int, optional): Number of indexes to keep. Defaults to DEFAULT_MAX_SAVED_INDEXES.
+        index_dir (Path, optional): Root directory of saved indexes. Defaults to INDEX_DIR.
+    """
+    index_dir = Path(index_dir or INDEX_DIR)
+    if not index_dir.is_dir():
+        return
+    saved = [path for path in index_dir.iterdir() if path.is_dir() and not path.name.startswith(".")]
+    saved.sort(key=lambda path: path.stat().st_mtime, reverse=True)
+    for path in saved[max_indexes:]:
+        shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,128 @@
+import math
+import re
+from collections import Counter
+
+# Words and codes such as "CS101" or "H2O", compared case-insensitively
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list:
+    """
+    Splits text into lowercase terms for lexical matching.
+
+    Args:
+        text (str): Text to split.
+
+    Returns:
+        list: Terms in order of appearance.
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    Inverted index over chunk texts scored with Okapi BM25.
+
+    Complements vector search with exact term matches like formula names and
+    course codes. Chunks are added and removed by their docstore ID so the index
+    can follow incremental vectorstore updates.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.doc_lengths = {}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    @classmethod
+    def from_documents(cls, docs: list, ids: list):
+        """
+        Builds an index from chunk documents.
+
+        Args:
+            docs (list): Chunk documents.
+            ids (list): Docstore ID of each chunk.
+
+        Returns:
+            BM25Index: Index over the chunks.
+        """
+        index = cls()
+        index.add(docs, ids)
+        return index
+
+    def copy(self):
+        """
+        Copies the index so it can be modified without touching a shared one.
+
+        Returns:
+            BM25Index: Independent copy.
+        """
+        index = BM25Index(self.k1, self.b)
+        index.postings = {term: dict(docs) for term, docs in self.postings.items()}
+        index.doc_lengths = dict(self.doc_lengths)
+        index.total_length = self.total_length
+        return index
+
+    def add(self, docs: list, ids: list):
+        """
+        Indexes chunk documents.
+
+        Args:
+            docs (list): Chunk documents.
+            ids (list): Docstore ID of each chunk.
+        """
+        for doc_id, doc in zip(ids, docs):
+            terms = tokenize(doc.page_content)
+            self.doc_lengths[doc_id] = len(terms)
+            self.total_length += len(terms)
+            for term, count in Counter(terms).items():
+                self.postings.setdefault(term, {})[doc_id] = count
+
+    def remove(self, ids: list):
+        """
+        Removes chunks from the index.
+
+        Args:
+            ids (list): Docstore IDs of the chunks to remove.
+        """
+        removed = {doc_id for doc_id in ids if doc_id in self.doc_lengths}
+        if not removed:
+            return
+        for doc_id in removed:
+            self.total_length -= self.doc_lengths.pop(doc_id)
+        for term in list(self.postings):
+            docs = self.postings[term]
+            for doc_id in removed.intersection(docs):
+                del docs[doc_id]
+            if not docs:
+                del self.postings[term]
+
+    def search(self, query: str, k: int = 4) -> list:
+        """
+        Ranks chunks by BM25 score for a query.
+
+        Args:
+            query (str): Search text.
+            k (int, optional): Number of results, None for every matching chunk. Defaults to 4.
+
+        Returns:
+            list: `(doc_id, score)` tuples, best match first.
+        """
+        if not self.doc_lengths:
+            return []
+        count = len(self.doc_lengths)
+        average_length = self.total_length / count or 1
+        scores = Counter()
+        for term in set(tokenize(query)):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc_id, tf in docs.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / average_length)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores.most_common(k)
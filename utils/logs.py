@@ -1,6 +1,14 @@
+from collections import deque
+from itertools import islice
 from streamlit import session_state as sst
 from datetime import datetime
 
+LOG_LEVELS = ["info", "success", "error"]
+# Entries kept per session; older ones are dropped as new ones arrive
+LOG_CAPACITY = 1000
+# Entries drawn per rerun, newest first
+LOG_DISPLAY_LIMIT = 100
+
 def get_timestamp():
   """Generates and returns a timestamp for the current time
 
@@ -9,33 +17,85 @@ def get_timestamp():
   """
   return datetime.now().strftime("%H:%M:%S")
 
+class LogBuffer:
+  """
+  Fixed-capacity ring buffer of log entries.
+
+  Appending is O(1) and drops the oldest entry once `capacity` is reached.
+  Iteration yields the newest entry first.
+  """
+
+  def __init__(self, capacity: int = LOG_CAPACITY):
+    self.entries = deque(maxlen=capacity)
+    self.dropped = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __iter__(self):
+    return reversed(self.entries)
+
+  def append(self, entry: dict):
+    """
+    Adds an entry, dropping the oldest one if the buffer is full.
+
+    Args:
+        entry (dict): Log entry with "time", "status" and "message".
+    """
+    if len(self.entries) == self.entries.maxlen:
+      self.dropped += 1
+    self.entries.append(entry)
+
+  def newest(self, limit: int = LOG_DISPLAY_LIMIT, levels=None) -> list:
+    """
+    Returns the newest entries, optionally only those of some levels.
+
+    Args:
+        limit (int, optional): Maximum number of entries. Defaults to LOG_DISPLAY_LIMIT.
+        levels (list, optional): Statuses to keep. Defaults to all.
+
+    Returns:
+        list: Entries, newest first.
+    """
+    entries = iter(self)
+    if levels is not None:
+      entries = (entry for entry in entries if entry.get("status") in levels)
+    return list(islice(entries, limit))
+
 def initialize_log():
   """
-  Initializes log message list
+  Initializes the log buffer
   """
-  sst["log"] = [{
+  sst["log"] = LogBuffer()
+  sst.log.append({
     "time" : get_timestamp(),
     "status" : "info",
     "message" : "Displaying background activity.."
-  }]
+  })
 
-def display_log(logs:list):
+def display_log(logs: LogBuffer, levels=None, limit: int = LOG_DISPLAY_LIMIT):
   """
-  Display a log message in the sidebar when `show_bts` is active.
+  Display the newest log messages in the sidebar when `show_bts` is active.
+  Only up to `limit` entries are drawn, so reruns stay fast however long the session.
 
   Args:
-      logs (list): List of log messages
+      logs (LogBuffer): Buffer of log messages
+      levels (list, optional): Statuses to show. Defaults to all.
+      limit (int, optional): Maximum entries drawn. Defaults to LOG_DISPLAY_LIMIT.
   """
-  for log_msg in logs:
+  shown = logs.newest(limit, levels)
+  for log_msg in shown:
     if log_msg.get('status') == "info":
       sst.container.caption(f":orange[[{log_msg.get('time')}]] {log_msg.get('message')}")
     elif log_msg.get('status') == "success":
       sst.container.caption(f":orange[[{log_msg.get('time')}]] :green[{log_msg.get('message')}]")
     elif log_msg.get('status') == "error":
       sst.container.caption(f":orange[[{log_msg.get('time')}]] :red[{log_msg.get('message')}]")
+  if len(shown) == limit or logs.dropped:
+    sst.container.caption(":grey[Older entries not shown]")
 
 def add_to_log(message:str, status="info"):
-  """Adds message to List of log messages
+  """Adds message to the log buffer
 
   Args:
       message (str): log message
@@ -43,13 +103,13 @@ def add_to_log(message:str, status="info"):
   """
   # Check if show_bts exists in session state, default to False if not
   show_bts = getattr(sst, 'show_bts', False)
-  
+
   if show_bts:
     log_entry = {
       "time" : get_timestamp(),
       "status" : status,
       "message" : message
     }
-    sst.log.insert(0, log_entry)
+    sst.log.append(log_entry)
     sst.container.caption(f":orange[[now]] :grey-background[{message}]")
   print(f"[{get_timestamp()}] : {message}")
@@ -0,0 +1,177 @@
+import threading
+
+from utils.retrieval import RetrievalConfig, estimate_tokens
+
+# Context windows of the selectable models, as listed in the model picker
+MODEL_CONTEXT_TOKENS = {
+    "gemini-2.0-flash-lite": 1_000_000,
+    "gemini-2.0-flash": 1_000_000,
+    "gemini-2.5-flash-lite": 1_000_000,
+    "gemini2.5-flash": 1_000_000,
+}
+DEFAULT_MODEL_CONTEXT_TOKENS = 32_000
+# Room kept free for the prompt template and the answer
+PROMPT_OVERHEAD_TOKENS = 500
+ANSWER_TOKENS = 8192
+# Exchanges kept word for word before they are folded into the summary
+RECENT_TURNS = 3
+SUMMARY_TOKENS = 300
+SUMMARY_PROMPT = (
+    "Update the summary of a conversation between a student and an assistant answering "
+    "questions about the student's PDFs. Keep the topics, facts and answers the student may "
+    "refer back to, in at most {words} words.\n\n"
+    "Current summary:\n{summary}\n\nNew messages:\n{messages}\n\nUpdated summary:"
+)
+
+
+def format_message(message: dict) -> str:
+    """
+    Renders a chat history message as a line of the conversation.
+
+    Args:
+        message (dict): Message with "role" and "content".
+
+    Returns:
+        str: "User: ..." or "Assistant: ...".
+    """
+    speaker = "User" if message["role"] == "user" else "Assistant"
+    return f"{speaker}: {message['content']}"
+
+
+def history_budget(model: str, config: RetrievalConfig, question: str) -> int:
+    """
+    Tokens the conversation may take up in the prompt for a model. The configured
+    budget is lowered when the model's context window could not hold it next to
+    the PDF context, the question and the answer.
+
+    Args:
+        model (str): Gemini model name.
+        config (RetrievalConfig): Settings with the context and history budgets.
+        question (str): User question.
+
+    Returns:
+        int: Token budget for the conversation.
+    """
+    window = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_MODEL_CONTEXT_TOKENS)
+    room = window - config.context_tokens - estimate_tokens(question) - PROMPT_OVERHEAD_TOKENS - ANSWER_TOKENS
+    return max(0, min(config.history_tokens, room))
+
+
+class ConversationMemory:
+    """
+    Conversation context for follow-up questions at a bounded prompt size.
+
+    The last `recent_turns` exchanges are kept word for word; older messages are
+    folded into a running summary by the LLM, only the new ones each time, in
+    the background. What goes into a prompt is cut to a token budget, keeping
+    the newest messages. Summaries are written on the query loop, so their log
+    messages wait in the memory until the session's script thread takes them.
+    """
+
+    def __init__(self, recent_turns: int = RECENT_TURNS, summary_tokens: int = SUMMARY_TOKENS):
+        self.recent_turns = recent_turns
+        self.summary_tokens = summary_tokens
+        self.summary = ""
+        # Messages of the history already folded into the summary
+        self.summarized = 0
+        self._summarizing = False
+        self._messages = []
+        self._lock = threading.Lock()
+
+    def log(self, message: str, status: str = "info"):
+        """
+        Queues a message for the session's backend activity log.
+
+        Args:
+            message (str): Log message.
+            status (str, optional): "info", "success" or "error". Defaults to "info".
+        """
+        with self._lock:
+            self._messages.append((message, status))
+
+    def take_messages(self) -> list:
+        """
+        Returns the queued log messages and forgets them. Runs in the script thread.
+
+        Returns:
+            list: `(message, status)` pairs, oldest first.
+        """
+        with self._lock:
+            messages, self._messages = self._messages, []
+        return messages
+
+    def pending(self, history: list) -> list:
+        """
+        Returns the messages that have left the recent window but are not summarised yet.
+
+        Args:
+            history (list): Messages of the conversation, oldest first.
+
+        Returns:
+            list: Messages to fold into the summary.
+        """
+        with self._lock:
+            return history[self.summarized:max(self.summarized, len(history) - 2 * self.recent_turns)]
+
+    def context(self, history: list, budget: int) -> str:
+        """
+        Builds the conversation text for a prompt: the summary of older messages
+        followed by the newer ones word for word, as many as fit the budget.
+        Messages whose summary is still being written are quoted instead.
+
+        Args:
+            history (list): Messages of the conversation, oldest first.
+            budget (int): Token budget.
+
+        Returns:
+            str: Conversation text, empty if there is none or nothing fits.
+        """
+        with self._lock:
+            summary, summarized = self.summary, self.summarized
+        lines = []
+        if summary and estimate_tokens(summary) <= budget:
+            budget -= estimate_tokens(summary)
+        else:
+            summary = ""
+        for message in reversed(history[summarized:]):
+            line = format_message(message)
+            budget -= estimate_tokens(line)
+            if budget < 0:
+                break
+            lines.append(line)
+        lines.reverse()
+        if summary:
+            lines.insert(0, f"Summary of the earlier conversation: {summary}")
+        return "\n".join(lines)
+
+    async def asummarize(self, llm, history: list):
+        """
+        Folds the messages that left the recent window into the summary. Only one
+        summary is written at a time; messages arriving meanwhile wait for the next
+        call. Failures are logged, see `take_messages`, and the messages stay
+        quoted as they are.
+
+        Args:
+            llm (BaseChatModel): Chat model writing the summary.
+            history (list): Messages of the conversation, oldest first.
+        """
+        messages = self.pending(history)
+        with self._lock:
+            if self._summarizing or not messages:
+                return
+            self._summarizing = True
+            summary, end = self.summary, self.summarized + len(messages)
+        try:
+            response = await llm.ainvoke(SUMMARY_PROMPT.format(
+                words=self.summary_tokens * 3 // 4,
+                summary=summary or "(none yet)",
+                messages="\n".join(format_message(message) for message in messages)
+            ))
+            with self._lock:
+                self.summary = response.content.strip()
+                self.summarized = end
+        except Exception as e:
+            self.log(f"Unable to summarize conversation - {e}", "error")
+        finally:
+            with self._lock:
+                self._summarizing = False
@@ -0,0 +1,345 @@
+import atexit
+import bisect
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import ContextDecorator, contextmanager
+from datetime import datetime, timezone
+
+import streamlit as st
+from streamlit import session_state as sst
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# Optional exports: every span as a JSON line, and the aggregates in Prometheus text format
+METRICS_FILE = st.secrets.get("METRICS_FILE", "")
+METRICS_PROMETHEUS_FILE = st.secrets.get("METRICS_PROMETHEUS_FILE", "")
+# Seconds between writes of the metrics files; spans are buffered in between
+METRICS_FLUSH_SECONDS = float(st.secrets.get("METRICS_FLUSH_SECONDS", 10))
+# Upper bounds of the duration histogram buckets, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RECENT_SPANS = 200
+SESSION_SPANS = 50
+
+
+class Span:
+    """Timing of one run of a pipeline stage, with item counts and the error it raised."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = datetime.now(timezone.utc)
+        self.duration = 0.0
+        self.counts = {}
+        self.error = None
+
+    def count(self, item: str, amount: int = 1):
+        """
+        Adds to an item count, e.g. pages parsed or tokens generated.
+
+        Args:
+            item (str): What is counted.
+            amount (int, optional): How many. Defaults to 1.
+        """
+        self.counts[item] = self.counts.get(item, 0) + amount
+
+    def fail(self, error: Exception):
+        """
+        Marks the span as failed by an error that was handled inside the stage.
+
+        Args:
+            error (Exception): The handled error.
+        """
+        self.error = f"{type(error).__name__}: {error}"
+
+    def to_dict(self) -> dict:
+        return {
+            "stage": self.name,
+            "started": self.started.isoformat(timespec="milliseconds"),
+            "duration_ms": round(self.duration * 1000, 3),
+            "counts": dict(self.counts),
+            "error": self.error,
+        }
+
+
+class _StageStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.counts = {}
+
+
+class MetricsRegistry:
+    """
+    Process-wide aggregate of stage timings.
+
+    Keeps per-stage call, error and item totals plus a duration histogram, and
+    the most recent spans for inspection.
+    """
+
+    def __init__(self, recent: int = RECENT_SPANS):
+        self.recent = deque(maxlen=recent)
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, span: Span):
+        """
+        Adds a finished span to the aggregates.
+
+        Args:
+            span (Span): Finished span.
+        """
+        with self._lock:
+            stats = self._stages.setdefault(span.name, _StageStats())
+            stats.calls += 1
+            stats.errors += span.error is not None
+            stats.seconds += span.duration
+            bucket = bisect.bisect_left(DURATION_BUCKETS, span.duration)
+            if bucket < len(DURATION_BUCKETS):
+                stats.buckets[bucket] += 1
+            for item, amount in span.counts.items():
+                stats.counts[item] = stats.counts.get(item, 0) + amount
+            self.recent.append(span)
+
+    def summary(self) -> list:
+        """
+        Summarises every stage for display.
+
+        Returns:
+            list: One dict per stage with calls, errors, mean duration and item totals.
+        """
+        with self._lock:
+            return [
+                {
+                    "stage": name,
+                    "calls": stats.calls,
+                    "errors": stats.errors,
+                    "mean_ms": round(stats.seconds / stats.calls * 1000, 1),
+                    **stats.counts,
+                }
+                for name, stats in sorted(self._stages.items())
+            ]
+
+    def to_prometheus(self) -> str:
+        """
+        Renders the aggregates in the Prometheus text exposition format.
+
+        Returns:
+            str: Metrics text, ready to be scraped or dropped into a textfile collector.
+        """
+        lines = [
+            "# HELP asknotes_stage_duration_seconds Duration of pipeline stages.",
+            "# TYPE asknotes_stage_duration_seconds histogram",
+        ]
+        errors = ["# HELP asknotes_stage_errors_total Pipeline stage runs that raised an error.", "# TYPE asknotes_stage_errors_total counter"]
+        items = ["# HELP asknotes_stage_items_total Items processed by pipeline stages.", "# TYPE asknotes_stage_items_total counter"]
+        with self._lock:
+            for name, stats in sorted(self._stages.items()):
+                cumulative = 0
+                for bound, observed in zip(DURATION_BUCKETS, stats.buckets):
+                    cumulative += observed
+                    lines.append(f'asknotes_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'asknotes_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {stats.calls}')
+                lines.append(f'asknotes_stage_duration_seconds_sum{{stage="{name}"}} {stats.seconds}')
+                lines.append(f'asknotes_stage_duration_seconds_count{{stage="{name}"}} {stats.calls}')
+                errors.append(f'asknotes_stage_errors_total{{stage="{name}"}} {stats.errors}')
+                for item, amount in sorted(stats.counts.items()):
+                    items.append(f'asknotes_stage_items_total{{stage="{name}",item="{item}"}} {amount}')
+        return "\n".join(lines + errors + items) + "\n"
+
+
+# Module-level rather than `st.cache_resource`, so background workers can record too
+_metrics = MetricsRegistry()
+# Where spans of background work for a session go, see `forward_spans`
+_span_sink = contextvars.ContextVar("span_sink", default=None)
+
+
+def get_metrics() -> MetricsRegistry:
+    """
+    Returns the metrics registry shared by every session of this server process.
+
+    Returns:
+        MetricsRegistry: Process-wide registry.
+    """
+    return _metrics
+
+
+class MetricsExporter:
+    """
+    Writes finished spans and the current aggregates to the configured metrics files.
+
+    Spans are buffered and written by a background thread every `interval`
+    seconds, and once more when the process exits, so timing a stage never
+    waits for the disk. Export failures are printed and otherwise ignored.
+    """
+
+    def __init__(self, interval: float = METRICS_FLUSH_SECONDS):
+        self.interval = interval
+        self.registry = None
+        self._pending = []
+        self._thread = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def add(self, span: Span, registry: MetricsRegistry):
+        """
+        Buffers a span for the next write.
+
+        Args:
+            span (Span): Finished span.
+            registry (MetricsRegistry): Registry the span was recorded in.
+        """
+        if not (METRICS_FILE or METRICS_PROMETHEUS_FILE):
+            return
+        with self._lock:
+            self._pending.append(span)
+            self.registry = registry
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="metrics-export", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered spans and, if any, the aggregates of their registry."""
+        with self._lock:
+            spans, self._pending = self._pending, []
+            registry = self.registry
+        if not spans:
+            return
+        with self._write_lock:
+            try:
+                if METRICS_FILE:
+                    with open(METRICS_FILE, "a", encoding="utf-8") as f:
+                        f.writelines(json.dumps(span.to_dict()) + "\n" for span in spans)
+                if METRICS_PROMETHEUS_FILE:
+                    # Written atomically so a scraper never reads half a file
+                    directory = os.path.dirname(os.path.abspath(METRICS_PROMETHEUS_FILE))
+                    with tempfile.NamedTemporaryFile("w", dir=directory, delete=False, encoding="utf-8") as f:
+                        f.write(registry.to_prometheus())
+                    os.replace(f.name, METRICS_PROMETHEUS_FILE)
+            except OSError as e:
+                print(f"Unable to export metrics - {e}")
+
+
+_exporter = MetricsExporter()
+
+
+def flush_metrics():
+    """Writes the spans buffered for export right away instead of at the next interval."""
+    _exporter.flush()
+
+
+@contextmanager
+def forward_spans(sink):
+    """
+    Hands the spans finished in the block to `sink`, for work a background thread
+    or the query loop does for a session. The sink passes them on to the session's
+    script thread, which keeps them with `add_timing`. Applies to the current
+    thread or asyncio task and to the threads it starts with `asyncio.to_thread`.
+
+    Args:
+        sink (callable): Called with every finished `Span`; must not touch session state.
+    """
+    token = _span_sink.set(sink)
+    try:
+        yield
+    finally:
+        _span_sink.reset(token)
+
+
+def add_timing(span: Span):
+    """
+    Keeps a span in this session's recent timings. Runs in the script thread.
+
+    Args:
+        span (Span): Finished span.
+    """
+    if "timings" not in sst:
+        sst.timings = deque(maxlen=SESSION_SPANS)
+    sst.timings.appendleft(span)
+
+
+class timed(ContextDecorator):
+    """
+    Times a pipeline stage, as a context manager or a decorator.
+
+    The span is recorded in the process-wide registry and buffered for export. It is also
+    kept in `sst.timings` for the backend activity panel, directly when run by a
+    session's script thread, or through the sink of `forward_spans` when run in
+    the background for a session. Other background work only records it globally.
+
+    Example:
+        with timed("parse") as span:
+            span.count("pages", len(pages))
+    """
+
+    def __init__(self, name: str, registry: MetricsRegistry = None):
+        self.name = name
+        self.registry = registry
+        self.span = None
+
+    def _recreate_cm(self):
+        # Each decorated call gets its own span
+        return timed(self.name, self.registry)
+
+    def __enter__(self) -> Span:
+        self.span = Span(self.name)
+        self._start = time.perf_counter()
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.duration = time.perf_counter() - self._start
+        if exc_type is not None and issubclass(exc_type, Exception):
+            self.span.fail(exc)
+        registry = self.registry or get_metrics()
+        registry.record(self.span)
+        _exporter.add(self.span, registry)
+        sink = _span_sink.get()
+        if sink is not None:
+            sink(self.span)
+        elif get_script_run_ctx(suppress_warning=True) is not None:
+            add_timing(self.span)
+        return False
+
+
+def display_timings():
+    """
+    Shows this session's recent stage timings and the process-wide totals,
+    with a download of the totals in Prometheus text format.
+    """
+    spans = sst.get("timings", ())
+    if not spans:
+        st.caption("No timings recorded yet.")
+        return
+    st.dataframe(
+        [
+            {
+                "stage": span.name,
+                "ms": round(span.duration * 1000, 1),
+                "counts": ", ".join(f"{item}={amount}" for item, amount in span.counts.items()),
+                "error": span.error or "",
+            }
+            for span in spans
+        ],
+        hide_index=True,
+        use_container_width=True
+    )
+    registry = get_metrics()
+    with st.expander("Server totals"):
+        st.dataframe(registry.summary(), hide_index=True, use_container_width=True)
+    st.download_button(
+        "Download metrics (Prometheus)",
+        data=registry.to_prometheus(),
+        file_name="asknotes_metrics.prom",
+        mime="text/plain",
+        use_container_width=True
+    )
@@ -0,0 +1,182 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from langchain_core.documents import Document
+from pypdf import PdfReader
+
+PAGES_PER_TASK = 50
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def _extract_pages(reader: PdfReader, start: int, stop: int) -> list:
+    labels = reader.page_labels
+    return [
+        ((reader.pages[number].extract_text(extraction_mode="plain") or "").strip(), labels[number])
+        for number in range(start, stop)
+    ]
+
+
+def _extract_page_range(data: bytes, start: int, stop: int) -> list:
+    # Runs in a worker process, so it only gets picklable arguments
+    return _extract_pages(PdfReader(BytesIO(data)), start, stop)
+
+
+def _to_documents(pages: list, source: str, total_pages: int) -> list:
+    return [
+        Document(
+            page_content=text,
+            metadata={
+                "source": source,
+                "total_pages": total_pages,
+                "page": page_number,
+                "page_label": label,
+            }
+        )
+        for page_number, (text, label) in enumerate(pages)
+    ]
+
+
+def read_pdf_pages(data: bytes, source: str) -> list:
+    """
+    Extracts the text of every page of a PDF held in memory.
+
+    Produces the same page documents as `PyPDFLoader` without writing the file
+    to disk first.
+
+    Args:
+        data (bytes): Raw PDF content, e.g. `UploadedFile.getvalue()`.
+        source (str): Name recorded as the `source` of each page.
+
+    Returns:
+        list: One `Document` per page, in page order.
+    """
+    reader = PdfReader(BytesIO(data))
+    total_pages = len(reader.pages)
+    return _to_documents(_extract_pages(reader, 0, total_pages), source, total_pages)
+
+
+def get_process_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Returns the process pool used for parsing, creating it on first use.
+
+    The pool lives for the whole server process so workers are only spawned once.
+
+    Args:
+        workers (int): Number of worker processes.
+
+    Returns:
+        ProcessPoolExecutor: Shared parsing pool.
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False, cancel_futures=True)
+            # Spawned workers avoid forking the threaded Streamlit server
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _pool_workers = workers
+        return _pool
+
+
+def _discard_process_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def iter_many_pdf_pages(files: list, workers: int = 1, pages_per_task: int = PAGES_PER_TASK):
+    """
+    Extracts the pages of several PDFs, yielding each file as soon as it is parsed.
+
+    With more than one worker, every file is cut into ranges of `pages_per_task`
+    pages, and the ranges of all files are submitted to the process pool up front,
+    so no worker waits for a large file to finish. The ranges of a file are
+    reassembled in page order. A failing file does not affect the others, and
+    stopping the iteration cancels the ranges not started yet.
+
+    Args:
+        files (list): `(data, source)` tuples of raw PDF bytes and file name.
+        workers (int, optional): Worker processes; 1 or less parses serially. Defaults to 1.
+        pages_per_task (int, optional): Pages parsed per worker task. Defaults to PAGES_PER_TASK.
+
+    Yields:
+        tuple: Position of the file in `files`, and its page documents or the exception raised while parsing it.
+    """
+    if workers <= 1:
+        for index, (data, source) in enumerate(files):
+            try:
+                yield index, read_pdf_pages(data, source)
+            except Exception as e:
+                yield index, e
+        return
+
+    pool = get_process_pool(workers)
+    plans, failed, owners = {}, [], {}
+    for index, (data, source) in enumerate(files):
+        try:
+            total_pages = len(PdfReader(BytesIO(data)).pages)
+            futures = [
+                pool.submit(_extract_page_range, data, start, min(start + pages_per_task, total_pages))
+                for start in range(0, total_pages, pages_per_task)
+            ]
+        except Exception as e:
+            failed.append((index, e))
+            continue
+        plans[index] = (source, total_pages, futures)
+        owners.update((future, index) for future in futures)
+
+    try:
+        yield from failed
+        for index, (source, total_pages, futures) in list(plans.items()):
+            if not futures:
+                del plans[index]
+                yield index, _to_documents([], source, total_pages)
+        for future in as_completed(owners):
+            index = owners[future]
+            if index not in plans:
+                # The file already failed on another of its ranges
+                continue
+            source, total_pages, futures = plans[index]
+            try:
+                future.result()
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    # A crashed worker poisons the pool, start a new one next time
+                    _discard_process_pool()
+                del plans[index]
+                yield index, e
+                continue
+            if all(future.done() for future in futures):
+                del plans[index]
+                pages = [page for future in futures for page in future.result()]
+                yield index, _to_documents(pages, source, total_pages)
+    finally:
+        for future in owners:
+            future.cancel()
+
+
+def read_many_pdf_pages(files: list, workers: int = 1, pages_per_task: int = PAGES_PER_TASK) -> list:
+    """
+    Extracts the pages of several PDFs, optionally across a process pool.
+    See `iter_many_pdf_pages`.
+
+    Args:
+        files (list): `(data, source)` tuples of raw PDF bytes and file name.
+        workers (int, optional): Worker processes; 1 or less parses serially. Defaults to 1.
+        pages_per_task (int, optional): Pages parsed per worker task. Defaults to PAGES_PER_TASK.
+
+    Returns:
+        list: For each file, in order, its page documents or the exception raised while parsing it.
+    """
+    results = [None] * len(files)
+    for index, result in iter_many_pdf_pages(files, workers, pages_per_task):
+        results[index] = result
+    return results
@@ -0,0 +1,360 @@
+import asyncio
+import re
+import time
+
+import streamlit as st
+from langchain.chains.question_answering.stuff_prompt import PROMPT_SELECTOR
+from langchain_community.vectorstores import FAISS
+
+from utils.answer_cache import AnswerCache
+from utils.index_jobs import IndexPreview
+from utils.lexical import BM25Index
+from utils.retrieval import RetrievalConfig, estimate_tokens, fit_to_budget, retrieve, retrieve_many
+from utils.logs import add_to_log
+from utils.metrics import timed
+
+ANSWER_CACHE_THRESHOLD = float(st.secrets.get("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_TTL_SECONDS = float(st.secrets.get("ANSWER_CACHE_TTL_SECONDS", 3600))
+ANSWER_CACHE_MAX_ENTRIES = int(st.secrets.get("ANSWER_CACHE_MAX_ENTRIES", 1000))
+# Parts a question is split into for the "sub_queries" fan-out, besides the question itself
+MAX_SUB_QUERIES = 3
+DECOMPOSE_PROMPT = (
+    "Split the question below into at most {limit} short, self-contained search queries, "
+    "one for each distinct thing it asks about. Write one query per line, without numbering "
+    "or any other text. If it only asks about one thing, write it once.\n\nQuestion: {question}"
+)
+CONDENSE_PROMPT = (
+    "Rewrite the follow-up question below as a standalone search query for the student's PDFs. "
+    "Replace words like \"it\" or \"that part\" with what they refer to in the conversation. "
+    "Write only the query.\n\nConversation:\n{conversation}\n\nFollow-up question: {question}\n\nStandalone query:"
+)
+# Words a question uses to point back at the conversation; others are searched as asked
+FOLLOW_UP_PATTERN = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|he|she|him|her|his|former|latter|"
+    r"above|previous|earlier|same|again|else|more)\b",
+    re.IGNORECASE
+)
+
+
+@st.cache_resource
+def get_answer_cache() -> AnswerCache:
+    """
+    Creates the answer cache shared by every session of this server process.
+
+    Returns:
+        AnswerCache: Process-wide answer cache.
+    """
+    return AnswerCache(ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES)
+
+
+def build_messages(
+    llm,
+    question: str,
+    docs: list,
+    context_tokens: int = RetrievalConfig.context_tokens,
+    conversation: str = ""
+) -> list:
+    """
+    Builds the prompt `VectorStoreIndexWrapper.query` would send for these chunks,
+    keeping the context within a token budget. The conversation so far, if any,
+    goes before the question so follow-ups can refer back to it.
+
+    Args:
+        llm (BaseLanguageModel): Model the prompt is meant for.
+        question (str): User question.
+        docs (list): Retrieved chunk documents, best match first.
+        context_tokens (int, optional): Token budget for the chunk texts. Defaults to RetrievalConfig.context_tokens.
+        conversation (str, optional): Conversation context from `ConversationMemory.context`.
+
+    Returns:
+        list: Chat messages stuffed with the chunk texts.
+    """
+    context = "\n\n".join(doc.page_content for doc in fit_to_budget(docs, context_tokens))
+    if conversation:
+        question = f"Conversation so far:\n{conversation}\n\nFollow-up question: {question}"
+    return PROMPT_SELECTOR.get_prompt(llm).format_messages(context=context, question=question)
+
+
+def parse_sub_queries(text: str, question: str, limit: int = MAX_SUB_QUERIES) -> list:
+    """
+    Reads the search queries an LLM split a question into.
+
+    Args:
+        text (str): LLM response, one query per line.
+        question (str): Original question, always searched as well.
+        limit (int, optional): Maximum number of sub-queries. Defaults to MAX_SUB_QUERIES.
+
+    Returns:
+        list: The question followed by up to `limit` distinct sub-queries.
+    """
+    queries = [question]
+    for line in text.splitlines():
+        # Drops list markers like "-", "*" or "2." the model adds anyway
+        query = re.sub(r"^\s*(?:[-*•]|\d+[.)])\s*", "", line).strip()
+        if query and query.lower() not in (seen.lower() for seen in queries):
+            queries.append(query)
+        if len(queries) > limit:
+            break
+    return queries
+
+
+async def adecompose_question(llm, question: str, limit: int = MAX_SUB_QUERIES) -> list:
+    """
+    Asks the LLM to split a question into search queries for its distinct parts.
+
+    Args:
+        llm (BaseChatModel): Chat model doing the split.
+        question (str): User question.
+        limit (int, optional): Maximum number of sub-queries. Defaults to MAX_SUB_QUERIES.
+
+    Returns:
+        list: The question followed by its sub-queries.
+    """
+    with timed("decompose") as span:
+        response = await llm.ainvoke(DECOMPOSE_PROMPT.format(limit=limit, question=question))
+        queries = parse_sub_queries(response.content, question, limit)
+        span.count("queries", len(queries))
+    return queries
+
+
+def refers_back(question: str) -> bool:
+    """
+    Tells whether a question seems to lean on the conversation, like "what does it
+    mean?" or "and the second?", and so needs a standalone query to search for.
+
+    Args:
+        question (str): User question.
+
+    Returns:
+        bool: Whether the question should be condensed before searching.
+    """
+    return len(question.split()) <= 3 or FOLLOW_UP_PATTERN.search(question) is not None
+
+
+async def acondense_question(llm, question: str, conversation: str) -> str:
+    """
+    Asks the LLM to turn a follow-up question into a standalone search query, so
+    retrieval finds the chunks about what the conversation is about.
+
+    Args:
+        llm (BaseChatModel): Chat model doing the rewrite.
+        question (str): Follow-up question.
+        conversation (str): Conversation context from `ConversationMemory.context`.
+
+    Returns:
+        str: Standalone query, or the question itself if the LLM gave none.
+    """
+    with timed("condense"):
+        response = await llm.ainvoke(CONDENSE_PROMPT.format(conversation=conversation, question=question))
+    return response.content.strip() or question
+
+
+async def aretrieve(
+    vectorstore: FAISS,
+    question: str,
+    llm,
+    config: RetrievalConfig = RetrievalConfig(),
+    question_vector: list = None,
+    lexical: BM25Index = None,
+    sources: list = None
+) -> list:
+    """
+    Finds the chunks for a question, fanning out into several searches when
+    `config.fan_out` asks for it: one per PDF in `sources`, or one per part of
+    the question as split by the LLM. The searches run in parallel and their
+    results are merged; the context budget is applied when the prompt is built.
+
+    Args:
+        vectorstore (FAISS): Vectorstore of the uploaded PDFs.
+        question (str): User question.
+        llm (BaseChatModel): Chat model used to split the question.
+        config (RetrievalConfig, optional): Retrieval settings. Defaults to RetrievalConfig().
+        question_vector (list, optional): Embedding of the question, if already computed.
+        lexical (BM25Index, optional): Keyword index for hybrid search.
+        sources (list, optional): Names of the uploaded PDFs.
+
+    Returns:
+        list: Relevant chunk documents, best match first.
+    """
+    embeddings = vectorstore.embedding_function
+    if config.fan_out == "sub_queries":
+        if question_vector is None:
+            # Splitting the question and embedding it are independent, so they overlap
+            queries, question_vector = await asyncio.gather(
+                adecompose_question(llm, question), embeddings.aembed_query(question)
+            )
+        else:
+            queries = await adecompose_question(llm, question)
+        vectors = [question_vector, *await asyncio.gather(*(embeddings.aembed_query(query) for query in queries[1:]))]
+        return await asyncio.to_thread(retrieve_many, vectorstore, list(zip(queries, vectors)), config, lexical)
+
+    if question_vector is None:
+        with timed("embed_question"):
+            question_vector = await embeddings.aembed_query(question)
+    if config.fan_out == "files" and sources and len(sources) > 1:
+        return await asyncio.to_thread(retrieve_many, vectorstore, [(question, question_vector)], config, lexical, sources)
+    return await asyncio.to_thread(retrieve, vectorstore, question, config, question_vector, lexical)
+
+
+async def astream_answer(
+    vectorstore: FAISS,
+    question: str,
+    llm,
+    config: RetrievalConfig = RetrievalConfig(),
+    question_vector: list = None,
+    lexical: BM25Index = None,
+    sources: list = None,
+    conversation: str = "",
+    search_query: str = None,
+    rewrite_llm=None
+):
+    """
+    Answers a question about the uploaded PDFs, yielding the answer as it is
+    generated. Runs on the shared query loop: the question is embedded and the
+    answer generated with the clients' async APIs, and the CPU-bound index search
+    runs in worker threads so it does not stall the loop. See `aretrieve` for
+    fanning out over several PDFs. Follow-up questions that `refers_back` to the
+    conversation are searched for as the standalone query from `acondense_question`,
+    and answered with the conversation.
+
+    Args:
+        vectorstore (FAISS): Vectorstore of the uploaded PDFs.
+        question (str): User question.
+        llm (BaseChatModel): Chat model generating the answer.
+        config (RetrievalConfig, optional): Retrieval settings. Defaults to RetrievalConfig().
+        question_vector (list, optional): Embedding of the query searched for, if already computed.
+        lexical (BM25Index, optional): Keyword index for hybrid search.
+        sources (list, optional): Names of the uploaded PDFs.
+        conversation (str, optional): Conversation context for follow-up questions.
+        search_query (str, optional): Query to search for, if the question was already condensed.
+        rewrite_llm (BaseChatModel, optional): Chat model condensing and splitting the
+            question, ideally at temperature 0. Defaults to `llm`.
+
+    Yields:
+        str: Consecutive pieces of the answer text.
+    """
+    rewrite_llm = rewrite_llm or llm
+    if search_query is None:
+        search_query = question
+        if conversation and refers_back(question):
+            search_query = await acondense_question(rewrite_llm, question, conversation)
+            if search_query != question:
+                question_vector = None
+    with timed("retrieve") as span:
+        docs = await aretrieve(vectorstore, search_query, rewrite_llm, config, question_vector, lexical, sources)
+        span.count("chunks", len(docs))
+    messages = build_messages(llm, question, docs, config.context_tokens, conversation)
+    with timed("generate") as span:
+        span.count("prompt_tokens", sum(estimate_tokens(message.content) for message in messages))
+        pieces = []
+        async for chunk in llm.astream(messages):
+            if chunk.content:
+                pieces.append(chunk.content)
+                yield chunk.content
+        span.count("answer_tokens", estimate_tokens("".join(pieces)))
+
+
+async def astream_cached_answer(
+    vectorstore: FAISS,
+    question: str,
+    llm,
+    namespace: tuple,
+    config: RetrievalConfig = RetrievalConfig(),
+    cache: AnswerCache = None,
+    lexical: BM25Index = None,
+    log=add_to_log,
+    sources: list = None,
+    conversation: str = "",
+    rewrite_llm=None
+):
+    """
+    Answers a question, reusing the cached answer of a near-identical earlier question.
+
+    The question is embedded once; the vector serves both the cache lookup and
+    retrieval. Newly generated answers are cached once they are complete.
+    Follow-ups that `refers_back` to the conversation are condensed first and
+    cached under their standalone query, so they hit answers to the same question
+    asked outright or in another conversation.
+    On the query loop `cache` must be given and `log` must not touch session state.
+
+    Args:
+        vectorstore (FAISS): Vectorstore of the uploaded PDFs.
+        question (str): User question.
+        llm (BaseChatModel): Chat model generating the answer.
+        namespace (tuple): Document set hash and model name the answer is valid for.
+        config (RetrievalConfig, optional): Retrieval settings. Defaults to RetrievalConfig().
+        cache (AnswerCache, optional): Cache to use. Defaults to the process-wide cache.
+        lexical (BM25Index, optional): Keyword index for hybrid search.
+        log (callable, optional): Where log messages go. Defaults to add_to_log.
+        sources (list, optional): Names of the uploaded PDFs.
+        conversation (str, optional): Conversation context for follow-up questions.
+        rewrite_llm (BaseChatModel, optional): Chat model condensing and splitting the
+            question, ideally at temperature 0. Defaults to `llm`.
+
+    Yields:
+        str: Consecutive pieces of the answer text.
+    """
+    if cache is None:
+        cache = get_answer_cache()
+    rewrite_llm = rewrite_llm or llm
+    search_query = question
+    if conversation and refers_back(question):
+        search_query = await acondense_question(rewrite_llm, question, conversation)
+    with timed("embed_question"):
+        question_vector = await vectorstore.embedding_function.aembed_query(search_query)
+    namespace = (*namespace, config)
+    cached = cache.get(namespace, question_vector)
+    if cached is not None:
+        log(
+            f"Answer cache hit: saved {cached.latency:.1f}s "
+            f"(hit rate {cache.hit_rate:.0%}, {cache.saved_seconds:.1f}s saved in total)", "success"
+        )
+        yield cached.answer
+        return
+
+    log(f"Answer cache miss (hit rate {cache.hit_rate:.0%})")
+    start = time.monotonic()
+    pieces = []
+    async for piece in astream_answer(
+        vectorstore, question, llm, config, question_vector, lexical, sources, conversation, search_query, rewrite_llm
+    ):
+        pieces.append(piece)
+        yield piece
+    cache.put(namespace, question_vector, "".join(pieces), time.monotonic() - start)
+
+
+async def astream_preview_answer(
+    preview: IndexPreview,
+    question: str,
+    llm,
+    config: RetrievalConfig = RetrievalConfig(),
+    log=add_to_log,
+    sources: list = None,
+    conversation: str = "",
+    rewrite_llm=None
+):
+    """
+    Answers a question from the part of the PDFs indexed so far, ending with a note
+    on how much of them was searched. Such answers are not cached, since they
+    would be incomplete once the whole index is built.
+
+    Args:
+        preview (IndexPreview): Snapshot of the index being built.
+        question (str): User question.
+        llm (BaseChatModel): Chat model generating the answer.
+        config (RetrievalConfig, optional): Retrieval settings. Defaults to RetrievalConfig().
+        log (callable, optional): Where log messages go. Defaults to add_to_log.
+        sources (list, optional): Names of the uploaded PDFs.
+        conversation (str, optional): Conversation context for follow-up questions.
+        rewrite_llm (BaseChatModel, optional): Chat model condensing and splitting the question. Defaults to `llm`.
+
+    Yields:
+        str: Consecutive pieces of the answer text.
+    """
+    log(f"Answering from partial index ({preview.fraction:.0%} of pages)")
+    async for piece in astream_answer(
+        preview.vectorstore, question, llm, config, lexical=preview.lexical, sources=sources,
+        conversation=conversation, rewrite_llm=rewrite_llm
+    ):
+        yield piece
+    yield f"\n\n({preview.note})"
@@ -0,0 +1,376 @@
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from utils.logs import add_to_log
+from utils.metrics import add_timing, forward_spans, timed
+
+# Questions answered at once across all sessions, and per session
+QUERY_CONCURRENCY = int(st.secrets.get("QUERY_CONCURRENCY", 16))
+QUERIES_PER_SESSION = int(st.secrets.get("QUERIES_PER_SESSION", 1))
+# Background LLM work, like conversation summaries, run at once across all sessions
+BACKGROUND_CONCURRENCY = int(st.secrets.get("BACKGROUND_CONCURRENCY", 4))
+
+
+class FairLimiter:
+    """
+    Bounds how many queries run at once, in total and per session.
+
+    Sessions waiting for a slot take turns: whenever a slot frees up it goes to
+    the session that has waited longest, and a session with more queries queued
+    goes to the back of the line after each one. Only used from the event loop.
+    """
+
+    def __init__(self, limit: int = QUERY_CONCURRENCY, per_session: int = QUERIES_PER_SESSION):
+        self.limit = limit
+        self.per_session = per_session
+        self.active = 0
+        self._active = {}
+        self._waiting = OrderedDict()
+
+    @property
+    def waiting(self) -> int:
+        """Number of queries waiting for a slot."""
+        return sum(len(futures) for futures in self._waiting.values())
+
+    async def acquire(self, session_id: str):
+        """
+        Waits for a slot for one query of a session.
+
+        Args:
+            session_id (str): Session asking the question.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(session_id, deque()).append(future)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted just as the query was cancelled
+                self.release(session_id)
+            else:
+                self._withdraw(session_id, future)
+            raise
+
+    def release(self, session_id: str):
+        """
+        Frees the slot of a finished query and hands it to the next session in line.
+
+        Args:
+            session_id (str): Session whose query finished.
+        """
+        self.active -= 1
+        self._active[session_id] -= 1
+        if not self._active[session_id]:
+            del self._active[session_id]
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, session_id: str):
+        """Holds a slot for the duration of the block."""
+        await self.acquire(session_id)
+        try:
+            yield
+        finally:
+            self.release(session_id)
+
+    def _withdraw(self, session_id: str, future: asyncio.Future):
+        futures = self._waiting.get(session_id)
+        if futures is not None and future in futures:
+            futures.remove(future)
+            if not futures:
+                del self._waiting[session_id]
+
+    def _dispatch(self):
+        granted = True
+        while granted and self.active < self.limit:
+            granted = False
+            for session_id in list(self._waiting):
+                if self.active >= self.limit:
+                    return
+                if self._active.get(session_id, 0) >= self.per_session:
+                    continue
+                futures = self._waiting.pop(session_id)
+                futures.popleft().set_result(None)
+                self.active += 1
+                self._active[session_id] = self._active.get(session_id, 0) + 1
+                granted = True
+                if futures:
+                    # Its next query waits behind the other sessions
+                    self._waiting[session_id] = futures
+
+
+class PendingAnswer:
+    """
+    Handle on an answer being generated on the query loop.
+
+    The loop adds answer pieces, log messages and stage timings as they come in;
+    sessions poll it from their script thread, because the loop must not touch
+    session state, the way they poll an `IndexJob`.
+    """
+
+    def __init__(self):
+        self.pieces = []
+        self.messages = []
+        self.spans = []
+        self.error = None
+        self._future = None
+        self._done = False
+        self._changed = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    @property
+    def text(self) -> str:
+        """Answer text generated so far."""
+        with self._changed:
+            return "".join(self.pieces)
+
+    def _add(self, items: list, item):
+        with self._changed:
+            items.append(item)
+            self._changed.notify_all()
+
+    def _finish(self, error: Exception = None):
+        with self._changed:
+            self.error = error
+            self._done = True
+            self._changed.notify_all()
+
+    def pieces_since(self, cursor: int) -> tuple:
+        """
+        Returns the answer pieces a reader has not seen yet.
+
+        Args:
+            cursor (int): Number of pieces already read.
+
+        Returns:
+            tuple: `(pieces, new cursor)`.
+        """
+        with self._changed:
+            return self.pieces[cursor:], len(self.pieces)
+
+    def messages_since(self, cursor: int) -> tuple:
+        """
+        Returns the log messages a session has not seen yet.
+
+        Args:
+            cursor (int): Number of messages the session already read.
+
+        Returns:
+            tuple: `(messages, new cursor)`.
+        """
+        with self._changed:
+            return self.messages[cursor:], len(self.messages)
+
+    def spans_since(self, cursor: int) -> tuple:
+        """
+        Returns the stage timings a session has not seen yet.
+
+        Args:
+            cursor (int): Number of spans the session already read.
+
+        Returns:
+            tuple: `(spans, new cursor)`.
+        """
+        with self._changed:
+            return self.spans[cursor:], len(self.spans)
+
+    def wait(self, seen: int, timeout: float = None) -> bool:
+        """
+        Blocks until the answer has more than `seen` pieces, messages and spans, or is done.
+
+        Args:
+            seen (int): Pieces, messages and spans already read, together.
+            timeout (float, optional): Seconds to wait at most.
+
+        Returns:
+            bool: Whether there is something new.
+        """
+        with self._changed:
+            return self._changed.wait_for(
+                lambda: self._done or len(self.pieces) + len(self.messages) + len(self.spans) > seen, timeout
+            )
+
+    def cancel(self):
+        """Stops generating the answer, e.g. when the session no longer wants it."""
+        if self._future is not None:
+            self._future.cancel()
+
+
+class QueryRunner:
+    """
+    Runs the async query pipeline of every session on one event loop thread.
+
+    Retrieval and generation await the network instead of each holding a thread,
+    and a `FairLimiter` bounds how many answers are generated at once. `start`
+    hands back a `PendingAnswer` the session polls for pieces, log messages and
+    stage timings, so no script thread waits for the network.
+    Background work has its own limiter, so it never holds up a session's next answer.
+    """
+
+    def __init__(
+        self,
+        limit: int = QUERY_CONCURRENCY,
+        per_session: int = QUERIES_PER_SESSION,
+        background_limit: int = BACKGROUND_CONCURRENCY
+    ):
+        self.loop = asyncio.new_event_loop()
+        self.limiter = FairLimiter(limit, per_session)
+        # One piece of background work per session at a time
+        self.background = FairLimiter(background_limit, 1)
+        self._thread = threading.Thread(target=self.loop.run_forever, name="query-loop", daemon=True)
+        self._thread.start()
+
+    def start(self, session_id: str, make_answer) -> PendingAnswer:
+        """
+        Starts answering a question on the event loop and returns at once.
+
+        Args:
+            session_id (str): Session asking the question.
+            make_answer (callable): Called on the loop with a log function; returns an
+                async iterator of answer pieces.
+
+        Returns:
+            PendingAnswer: Handle to poll and cancel.
+        """
+        answer = PendingAnswer()
+
+        async def run():
+            try:
+                with forward_spans(lambda span: answer._add(answer.spans, span)):
+                    with timed("query_wait"):
+                        await self.limiter.acquire(session_id)
+                    try:
+                        async for piece in make_answer(
+                            lambda message, status="info": answer._add(answer.messages, (message, status))
+                        ):
+                            answer._add(answer.pieces, piece)
+                    finally:
+                        self.limiter.release(session_id)
+            except asyncio.CancelledError:
+                answer._finish()
+                raise
+            except Exception as e:
+                answer._finish(e)
+            else:
+                answer._finish()
+
+        answer._future = asyncio.run_coroutine_threadsafe(run(), self.loop)
+        return answer
+
+    def stream(self, session_id: str, make_answer, log=add_to_log, timing=add_timing):
+        """
+        Answers a question on the event loop, yielding the answer in the calling thread.
+        Stopping the iteration cancels the query. Blocks the calling thread while
+        it waits, so scripts use `start` and poll instead; meant for tools like the benchmark.
+
+        Args:
+            session_id (str): Session asking the question.
+            make_answer (callable): Called on the loop with a log function; returns an
+                async iterator of answer pieces.
+            log (callable, optional): Where log messages go in the calling thread. Defaults to add_to_log.
+            timing (callable, optional): Where stage timings go in the calling thread. Defaults to add_timing.
+
+        Yields:
+            str: Consecutive pieces of the answer text.
+        """
+        answer = self.start(session_id, make_answer)
+        pieces = messages = spans = 0
+        try:
+            while True:
+                answer.wait(pieces + messages + spans)
+                done = answer.done
+                new_messages, messages = answer.messages_since(messages)
+                for message, status in new_messages:
+                    log(message, status)
+                new_spans, spans = answer.spans_since(spans)
+                for span in new_spans:
+                    timing(span)
+                new_pieces, pieces = answer.pieces_since(pieces)
+                yield from new_pieces
+                if done:
+                    if answer.error is not None:
+                        raise answer.error
+                    return
+        finally:
+            answer.cancel()
+
+    def submit(self, session_id: str, coroutine):
+        """
+        Runs background LLM work of a session on the loop without waiting for it.
+        The work waits for a slot of the background limiter, which sessions take
+        turns on like answers do, and does not delay the session's next answer.
+
+        Args:
+            session_id (str): Session the work is done for.
+            coroutine (coroutine): Work to run; it must not touch session state.
+
+        Returns:
+            concurrent.futures.Future: Its eventual result.
+        """
+        async def run():
+            async with self.background.slot(session_id):
+                return await coroutine
+
+        return asyncio.run_coroutine_threadsafe(run(), self.loop)
+
+    def stats(self) -> dict:
+        """
+        Reports how busy the query loop is.
+
+        Returns:
+            dict: Running and waiting queries, and running background work.
+        """
+        return {"running": self.limiter.active, "waiting": self.limiter.waiting, "background": self.background.active}
+
+
+@st.cache_resource
+def get_query_runner() -> QueryRunner:
+    """
+    Starts the query event loop once per server process.
+
+    Returns:
+        QueryRunner: Runner shared by every session.
+    """
+    return QueryRunner(QUERY_CONCURRENCY, QUERIES_PER_SESSION, BACKGROUND_CONCURRENCY)
+
+
+def _session_id() -> str:
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx is not None else "local"
+
+
+def run_query(make_answer) -> PendingAnswer:
+    """
+    Starts answering a question for this session on the shared query loop. The
+    script does not wait for the answer; it polls the returned handle instead.
+
+    Args:
+        make_answer (callable): Called with a log function; returns an async iterator of answer pieces.
+
+    Returns:
+        PendingAnswer: Handle to poll and cancel.
+    """
+    return get_query_runner().start(_session_id(), make_answer)
+
+
+def run_in_background(coroutine):
+    """
+    Runs background LLM work for this session on the shared query loop, within
+    the background limit, without waiting for it.
+
+    Args:
+        coroutine (coroutine): Work to run; it must not touch session state.
+
+    Returns:
+        concurrent.futures.Future: Its eventual result.
+    """
+    return get_query_runner().submit(_session_id(), coroutine)
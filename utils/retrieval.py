@@ -0,0 +1,338 @@
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from utils.faiss_index import search_rows, set_recall
+from utils.lexical import BM25Index
+
+SEARCH_TYPES = ["similarity", "mmr", "similarity_score_threshold"]
+# "files" searches every PDF separately, "sub_queries" every part of a split-up question
+FAN_OUT_MODES = ["off", "files", "sub_queries"]
+# Rough size of a token in characters, good enough for budgeting prompts
+CHARS_PER_TOKEN = 4
+# Damping constant of reciprocal rank fusion, 60 is the value from the original paper
+RRF_K = 60
+# Searches of one fanned-out question run in parallel; FAISS releases the GIL while searching
+SEARCH_WORKERS = 8
+_search_pool = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+
+
+@dataclass(frozen=True)
+class RetrievalConfig:
+    """
+    Settings for chunking the PDFs and for picking the chunks sent to the LLM.
+
+    Chunking and `top_k` default to what `VectorstoreIndexCreator` and `.query()`
+    used to do. Retrieval itself differs by default: vector results are fused with
+    a BM25 keyword search (`hybrid`), and up to `history_tokens` of the
+    conversation are sent along for follow-up questions.
+    """
+    chunk_size: int = 1000
+    chunk_overlap: int = 0
+    top_k: int = 4
+    search_type: str = "similarity"
+    fetch_k: int = 20
+    score_threshold: float = 0.5
+    context_tokens: int = 4000
+    history_tokens: int = 1000
+    hybrid: bool = True
+    index_type: str = "auto"
+    vector_codec: str = "float32"
+    recall: str = "balanced"
+    fan_out: str = "off"
+
+    @property
+    def index_settings(self) -> str:
+        """Part of the config that changes the contents of the index."""
+        return f"{self.chunk_size}:{self.chunk_overlap}:{self.index_type}:{self.vector_codec}"
+
+
+@lru_cache(maxsize=16)
+def get_text_splitter(chunk_size: int, chunk_overlap: int) -> RecursiveCharacterTextSplitter:
+    """
+    Returns the text splitter for the given chunking settings.
+
+    Args:
+        chunk_size (int): Maximum characters per chunk.
+        chunk_overlap (int): Characters shared by consecutive chunks.
+
+    Returns:
+        RecursiveCharacterTextSplitter: Splitter for these settings.
+    """
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of tokens in a text.
+
+    Args:
+        text (str): Text to measure.
+
+    Returns:
+        int: Approximate token count.
+    """
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = RRF_K) -> list:
+    """
+    Merges several rankings of document IDs into one.
+
+    Each ID scores `1 / (k + rank)` per ranking it appears in, so IDs ranked
+    well by several searches rise to the top without comparing raw scores.
+
+    Args:
+        rankings (list): Lists of document IDs, best match first.
+        k (int, optional): Damping constant. Defaults to RRF_K.
+
+    Returns:
+        list: Document IDs, best fused score first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def _vector_search(vectorstore: FAISS, question_vector: list, config: RetrievalConfig, k: int) -> list:
+    fetch_k = max(config.fetch_k, k)
+    if config.search_type == "mmr":
+        return vectorstore.max_marginal_relevance_search_by_vector(question_vector, k=k, fetch_k=fetch_k)
+    if config.search_type == "similarity_score_threshold":
+        relevance = vectorstore._select_relevance_score_fn()
+        scored = vectorstore.similarity_search_with_score_by_vector(question_vector, k=k)
+        return [doc for doc, distance in scored if relevance(distance) >= config.score_threshold]
+    return vectorstore.similarity_search_by_vector(question_vector, k=k)
+
+
+class _RowsIndex:
+    # Index whose searches only see some of its rows, for the search methods of FAISS
+    def __init__(self, index, rows: np.ndarray, recall: str):
+        self._index = index
+        self._rows = rows
+        self._recall = recall
+
+    def search(self, vectors, k: int):
+        return search_rows(self._index, vectors, k, self._rows, self._recall)
+
+    def __getattr__(self, name):
+        return getattr(self._index, name)
+
+
+def _rows_by_source(vectorstore: FAISS, sources: list) -> dict:
+    rows = {source: [] for source in sources}
+    for row, doc_id in vectorstore.index_to_docstore_id.items():
+        doc = vectorstore.docstore.search(doc_id)
+        if isinstance(doc, Document) and doc.metadata.get("source") in rows:
+            rows[doc.metadata["source"]].append(row)
+    return {source: np.asarray(ids, dtype=np.int64) for source, ids in rows.items()}
+
+
+def _restrict(vectorstore: FAISS, rows: np.ndarray, recall: str) -> FAISS:
+    # Shallow copy sharing the docstore, searching only the given rows
+    restricted = copy.copy(vectorstore)
+    restricted.index = _RowsIndex(vectorstore.index, rows, recall)
+    return restricted
+
+
+def _split_by_source(docs, sources: list, k: int) -> dict:
+    # Best `k` of each PDF from one ranking, instead of searching again for each PDF
+    rankings = {source: [] for source in sources}
+    unfilled = len(rankings)
+    for doc in docs:
+        ranking = rankings.get(doc.metadata.get("source")) if isinstance(doc, Document) else None
+        if ranking is None or len(ranking) == k:
+            continue
+        ranking.append(doc)
+        unfilled -= len(ranking) == k
+        if not unfilled:
+            break
+    return rankings
+
+
+def _search(
+    vectorstore: FAISS,
+    question: str,
+    question_vector: list,
+    config: RetrievalConfig,
+    lexical: BM25Index = None,
+    dense: list = None,
+    keyword: list = None
+) -> list:
+    # Callers apply the recall level to the index and may pass rankings they already have
+    if not config.hybrid or not lexical:
+        if dense is not None:
+            return dense[:config.top_k]
+        return _vector_search(vectorstore, question_vector, config, config.top_k)
+
+    candidates = max(config.fetch_k, config.top_k)
+    if dense is None:
+        dense = _vector_search(vectorstore, question_vector, config, candidates)
+    if keyword is None:
+        keyword = [doc_id for doc_id, _ in lexical.search(question, candidates)]
+    docs = {doc.id: doc for doc in dense}
+    fused = []
+    for doc_id in reciprocal_rank_fusion([list(docs), keyword]):
+        doc = docs.get(doc_id) or vectorstore.docstore.search(doc_id)
+        # Skips IDs the keyword index knows but the vectorstore no longer has
+        if isinstance(doc, Document):
+            fused.append(doc)
+        if len(fused) == config.top_k:
+            break
+    return fused
+
+
+def _search_files(
+    vectorstore: FAISS,
+    question: str,
+    question_vector: list,
+    sources: list,
+    config: RetrievalConfig,
+    lexical: BM25Index = None
+) -> list:
+    # Every PDF gets its own vector search over only its chunks, in parallel, so
+    # a PDF far from the question still yields its best chunks. The keyword
+    # ranking covers every chunk already and is split by PDF.
+    hybrid = config.hybrid and lexical
+    k = max(config.fetch_k, config.top_k) if hybrid else config.top_k
+    keyword = {}
+    if hybrid:
+        ranked = (vectorstore.docstore.search(doc_id) for doc_id, _ in lexical.search(question, None))
+        keyword = {
+            source: [doc.id for doc in docs]
+            for source, docs in _split_by_source(ranked, sources, k).items()
+        }
+    rows = _rows_by_source(vectorstore, sources)
+    dense = dict(zip(sources, _search_pool.map(
+        lambda source: _vector_search(_restrict(vectorstore, rows[source], config.recall), question_vector, config, k),
+        sources
+    )))
+    return [
+        _search(vectorstore, question, question_vector, config, lexical, dense[source], keyword.get(source))
+        for source in sources
+    ]
+
+
+def retrieve(
+    vectorstore: FAISS,
+    question: str,
+    config: RetrievalConfig = RetrievalConfig(),
+    question_vector: list = None,
+    lexical: BM25Index = None
+) -> list:
+    """
+    Finds the chunks most relevant to a question using the configured search.
+
+    With `config.hybrid` and a keyword index, the vector search and a BM25 search
+    each fetch `fetch_k` candidates and their rankings are merged with reciprocal
+    rank fusion, so exact terms the embedding misses still surface.
+
+    Args:
+        vectorstore (FAISS): Vectorstore of the uploaded PDFs.
+        question (str): User question.
+        config (RetrievalConfig, optional): Retrieval settings. Defaults to RetrievalConfig().
+        question_vector (list, optional): Embedding of the question, if already computed.
+        lexical (BM25Index, optional): Keyword index over the same chunks.
+
+    Returns:
+        list: Relevant chunk documents, best match first.
+    """
+    if question_vector is None:
+        question_vector = vectorstore.embedding_function.embed_query(question)
+
+    set_recall(vectorstore.index, config.recall)
+    return _search(vectorstore, question, question_vector, config, lexical)
+
+
+def merge_results(results: list, limit: int) -> list:
+    """
+    Fuses the results of several searches with reciprocal rank fusion, keeping
+    each chunk once. The best chunk of every search comes before the second best
+    of any, so no single search crowds out the others.
+
+    Args:
+        results (list): Lists of chunk documents, best match first.
+        limit (int): Maximum number of chunks.
+
+    Returns:
+        list: Chunk documents, best fused rank first.
+    """
+    docs = {}
+    for result in results:
+        for doc in result:
+            docs.setdefault(doc.id, doc)
+    ranking = reciprocal_rank_fusion([[doc.id for doc in result] for result in results])
+    return [docs[doc_id] for doc_id in ranking[:limit]]
+
+
+def retrieve_many(
+    vectorstore: FAISS,
+    questions: list,
+    config: RetrievalConfig = RetrievalConfig(),
+    lexical: BM25Index = None,
+    sources: list = None
+) -> list:
+    """
+    Searches for several phrasings of a question, or for one question in each of
+    several PDFs, and merges the results. Searches run in parallel, and searches
+    in separate PDFs share one vector search, so fanning out costs about as long
+    as a single search.
+
+    Args:
+        vectorstore (FAISS): Vectorstore of the uploaded PDFs.
+        questions (list): `(query text, query vector)` of each search.
+        config (RetrievalConfig, optional): Retrieval settings. Defaults to RetrievalConfig().
+        lexical (BM25Index, optional): Keyword index over the same chunks.
+        sources (list, optional): PDF names to search separately, for every query.
+
+    Returns:
+        list: Up to `top_k` chunks per search, deduplicated, best fused rank first.
+    """
+    set_recall(vectorstore.index, config.recall)
+    if sources:
+        results = [
+            result
+            for question, vector in questions
+            for result in _search_files(vectorstore, question, vector, sources, config, lexical)
+        ]
+    else:
+        results = list(_search_pool.map(
+            lambda query: _search(vectorstore, query[0], query[1], config, lexical), questions
+        ))
+    return merge_results(results, config.top_k * len(results))
+
+
+def fit_to_budget(docs: list, max_tokens: int) -> list:
+    """
+    Keeps the best chunks that fit into the context token budget.
+
+    Chunks are taken in ranking order; the first chunk that does not fit is cut
+    down to the remaining budget and later chunks are dropped.
+
+    Args:
+        docs (list): Chunk documents, best match first.
+        max_tokens (int): Context token budget.
+
+    Returns:
+        list: Chunk documents that fit the budget.
+    """
+    kept = []
+    remaining = max_tokens
+    for doc in docs:
+        tokens = estimate_tokens(doc.page_content)
+        if tokens <= remaining:
+            kept.append(doc)
+            remaining -= tokens
+            continue
+        if remaining > 0:
+            kept.append(doc.model_copy(update={"page_content": doc.page_content[:remaining * CHARS_PER_TOKEN]}))
+        break
+    return kept
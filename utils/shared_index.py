@@ -0,0 +1,186 @@
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+
+import faiss
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+from utils.faiss_index import vector_nbytes
+from utils.lexical import BM25Index
+
+DEFAULT_MEMORY_BUDGET_BYTES = 1024 * 1024 * 1024
+
+
+def estimate_nbytes(vectorstore: FAISS) -> int:
+    """
+    Estimates the memory held by a vectorstore's vectors and chunk texts.
+
+    Args:
+        vectorstore (FAISS): Vectorstore to measure.
+
+    Returns:
+        int: Approximate size in bytes.
+    """
+    text_bytes = sum(len(doc.page_content) for doc in vectorstore.docstore._dict.values())
+    return vector_nbytes(vectorstore.index) + text_bytes
+
+
+def clone_vectorstore(vectorstore: FAISS) -> FAISS:
+    """
+    Copies a vectorstore so it can be modified without touching a shared one.
+
+    Args:
+        vectorstore (FAISS): Vectorstore to copy.
+
+    Returns:
+        FAISS: Independent copy backed by an in-memory FAISS index.
+    """
+    return FAISS(
+        embedding_function=vectorstore.embedding_function,
+        index=faiss.clone_index(vectorstore.index),
+        docstore=InMemoryDocstore(dict(vectorstore.docstore._dict)),
+        index_to_docstore_id=dict(vectorstore.index_to_docstore_id)
+    )
+
+
+class IndexLease:
+    """
+    A session's reference to an index in the `SharedIndexStore`.
+
+    The reference is released when `release` is called or, at the latest, when
+    the lease is garbage collected together with the session state holding it.
+    Garbage collection can run in any thread, even one holding the store's lock,
+    so the finalizer only queues the release for the store to apply later.
+    """
+
+    def __init__(self, store, set_hash: str, vectorstore: FAISS, file_ids: dict, lexical: BM25Index):
+        self.set_hash = set_hash
+        self.vectorstore = vectorstore
+        self.file_ids = file_ids
+        self.lexical = lexical
+        self._store = store
+        self._finalizer = weakref.finalize(self, store._released.append, set_hash)
+
+    def release(self):
+        """Drops this reference; calling it again has no effect."""
+        if self._finalizer.detach() is not None:
+            self._store.release(self.set_hash)
+
+
+class _Entry:
+    def __init__(self, vectorstore: FAISS, file_ids: dict, lexical: BM25Index):
+        self.vectorstore = vectorstore
+        self.file_ids = file_ids
+        self.lexical = lexical
+        self.nbytes = estimate_nbytes(vectorstore)
+        self.refcount = 0
+        self.last_used = time.monotonic()
+
+
+class SharedIndexStore:
+    """
+    Process-wide store of vectorstores keyed by document set hash.
+
+    Sessions uploading the same documents share one read-only index instead of
+    each holding a copy. Indexes no session references any more are evicted,
+    least recently used first, once the memory budget is exceeded.
+    """
+
+    def __init__(self, memory_budget_bytes: int = DEFAULT_MEMORY_BUDGET_BYTES):
+        self.memory_budget_bytes = memory_budget_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Hashes of garbage collected leases, applied by the next caller holding the lock
+        self._released = deque()
+
+    def _lease(self, set_hash: str) -> IndexLease:
+        entry = self._entries[set_hash]
+        entry.refcount += 1
+        entry.last_used = time.monotonic()
+        self._entries.move_to_end(set_hash)
+        return IndexLease(self, set_hash, entry.vectorstore, entry.file_ids, entry.lexical)
+
+    def acquire(self, set_hash: str):
+        """
+        Takes a reference to a stored index.
+
+        Args:
+            set_hash (str): Document set hash.
+
+        Returns:
+            IndexLease: Lease on the index, or None if it is not in the store.
+        """
+        with self._lock:
+            self._drain()
+            if set_hash not in self._entries:
+                return None
+            lease = self._lease(set_hash)
+            self._evict()
+            return lease
+
+    def publish(self, set_hash: str, vectorstore: FAISS, file_ids: dict, lexical: BM25Index) -> IndexLease:
+        """
+        Adds an index to the store and takes a reference to it. If another session
+        published the same document set first, its index is used instead.
+
+        Args:
+            set_hash (str): Document set hash.
+            vectorstore (FAISS): Index that must not be modified afterwards.
+            file_ids (dict): Document IDs of each indexed file.
+            lexical (BM25Index): Keyword index over the same chunks.
+
+        Returns:
+            IndexLease: Lease on the stored index.
+        """
+        with self._lock:
+            self._drain()
+            if set_hash not in self._entries:
+                self._entries[set_hash] = _Entry(vectorstore, file_ids, lexical)
+            lease = self._lease(set_hash)
+            self._evict()
+            return lease
+
+    def release(self, set_hash: str):
+        """
+        Drops one reference to an index and evicts unreferenced indexes over budget.
+
+        Args:
+            set_hash (str): Document set hash.
+        """
+        self._released.append(set_hash)
+        with self._lock:
+            self._drain()
+            self._evict()
+
+    def _drain(self):
+        while self._released:
+            entry = self._entries.get(self._released.popleft())
+            if entry is not None and entry.refcount > 0:
+                entry.refcount -= 1
+
+    def _evict(self):
+        total = sum(entry.nbytes for entry in self._entries.values())
+        for set_hash in list(self._entries):
+            if total <= self.memory_budget_bytes:
+                break
+            entry = self._entries[set_hash]
+            if entry.refcount == 0:
+                total -= entry.nbytes
+                del self._entries[set_hash]
+
+    def stats(self) -> dict:
+        """
+        Summarises the store for the backend activity log.
+
+        Returns:
+            dict: Number of indexes, live references and estimated bytes held.
+        """
+        with self._lock:
+            self._drain()
+            return {
+                "indexes": len(self._entries),
+                "references": sum(entry.refcount for entry in self._entries.values()),
+                "nbytes": sum(entry.nbytes for entry in self._entries.values()),
+            }
@@ -1,4 +1,5 @@
 import streamlit as st
+from utils.assets import read_asset
 
 def base_ui():
     st_config()
@@ -35,6 +36,4 @@ def navbar():
     )
 
 def promo():
-    with open("./static/sidebar.html", "r", encoding="UTF-8") as sidebar_file:
-        sidebar_html = sidebar_file.read()
-    st.html(sidebar_html)
\ No newline at end of file
+    st.html(read_asset("./static/sidebar.html"))
\ No newline at end of file
@@ -1,78 +1,93 @@
-import streamlit as st
 from streamlit import session_state as sst
-from datetime import datetime
-from io import BytesIO
-from pathlib import Path
-import json, os
+import json
 from utils.logs import add_to_log
 
+# File name and MIME type of each chat export format
+EXPORT_FORMATS = {
+    "JSON": ("chat_history.json", "application/json"),
+    "JSONL": ("chat_history.jsonl", "application/jsonl"),
+    "Markdown": ("chat_history.md", "text/markdown"),
+    "TXT": ("chat_history.txt", "text/plain"),
+}
+TXT_SEPARATOR = "\n\n--------------------------------------------------------------\n\n"
+
+def _speaker(msg: dict) -> str:
+    return 'User' if msg['role'] == 'user' else 'AI'
+
+def _render_message(format_type: str, msg: dict, first: bool) -> str:
+    if format_type == "JSON":
+        item = "\n".join("    " + line for line in json.dumps(msg, indent=4).split("\n"))
+        return ("\n" if first else ",\n") + item
+    if format_type == "JSONL":
+        return json.dumps(msg) + "\n"
+    if format_type == "Markdown":
+        return f"**{_speaker(msg)}:**\n\n{msg['content']}\n\n---\n\n"
+    return ("" if first else TXT_SEPARATOR) + f"{_speaker(msg)}: {msg['content']}"
+
+def _wrap(format_type: str, body: str, empty: bool) -> str:
+    if format_type == "JSON":
+        return "[]" if empty else f"[{body}\n]"
+    if format_type == "TXT":
+        return f"Chat History:\n{'=' * 40}\n\n{body}\n\n{'=' * 40}\nEnd of Chat"
+    if format_type == "Markdown":
+        return f"# Chat History\n\n{body}"
+    return body
+
+class ChatExport:
+    """
+    Export files of one chat history, built on demand and cached per history version.
+
+    The history only grows, so each format keeps the rendered text of every
+    message and only renders messages added since the last export.
+    """
+
+    def __init__(self, history: list):
+        self.history = history
+        self.parts = {format_type: [] for format_type in EXPORT_FORMATS}
+        self.files = {}
+
+    def render(self, format_type: str) -> bytes:
+        """
+        Returns the export file for the current history, rebuilding it only if
+        messages were added since it was last built.
+
+        Args:
+            format_type (str): One of `EXPORT_FORMATS`.
+
+        Returns:
+            bytes: UTF-8 encoded file content.
+        """
+        version = len(self.history)
+        cached = self.files.get(format_type)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        parts = self.parts[format_type]
+        for msg in self.history[len(parts):]:
+            parts.append(_render_message(format_type, msg, first=not parts))
+        data = _wrap(format_type, "".join(parts), empty=not parts).encode('utf-8')
+        self.files[format_type] = (version, data)
+        return data
+
 def prepare_download_file(format_type):
   
     """
-    Prepare the chat history file based on the selected format.
+    Prepare the chat history file based on the selected format. Files are
+    cached in `sst.chat_export` until the chat history changes.
 
     Args:
-        format_type (str): 'JSON' or 'TXT'.
+        format_type (str): 'JSON', 'JSONL', 'Markdown' or 'TXT'.
 
     Returns:
         tuple: Tuple containing the file content, file name, and file type.
         
     """
-    if format_type == "JSON":
-      
-        add_to_log("Preparing chat history as JSON...")
-        return BytesIO(json.dumps(sst.chat_history, indent=4).encode('utf-8')), "chat_history.json", "application/json"
-    
-    elif format_type == "TXT":
-      
-        add_to_log("Preparing chat history as TXT...")
-        text_output = "\n\n--------------------------------------------------------------\n\n".join(
-            [
-                f"{'User' if msg['role'] == 'user' else 'AI'}: {msg['content']}"
-                for msg in sst.chat_history
-            ]
-        )
-        text_output = f"Chat History:\n{'=' * 40}\n\n{text_output}\n\n{'=' * 40}\nEnd of Chat"
-        return BytesIO(text_output.encode('utf-8')), "chat_history.txt", "text/plain"
-    
-    return None, None, None
-
-def delete_temp_files(temp_paths: list):
-  """
-  Deletes temporary files created during PDF loading.
-
-  Args:
-      temp_paths (list): Paths of temporary files to delete.
-  """
-  add_to_log("Deleting Temporary files..")
-  for path in temp_paths:
-    try:
-      os.remove(path)
-    except Exception as e:
-      st.warning(f"Failed to delete temp file {path}: {e}")
-      add_to_log("Error: Failed to delete temporary files..", "error")
-  add_to_log("Temporary Files Deleted.", "success")
-
-
-def load_css(path:Path= Path('static/styles.css')) -> str:
-  """
-  Loads a CSS stylesheet from a local file.
-
-  Args:
-      path (Path): Path to the CSS file (default: 'static/styles.css').
+    if format_type not in EXPORT_FORMATS:
+        return None, None, None
 
-  Returns:
-      str: The content of the CSS file if successfully loaded, otherwise an empty string.
-  """
-  # Load CSS stylesheet
-  try:
-    if not path.is_file():
-      add_to_log(f"❗Error loading stylesheet: {path} does not exist.", "error")
-      return ""
-    with open(path) as f:
-        custom_css = f.read()
-    return custom_css
-  except FileNotFoundError:
-    add_to_log("❗Error loading stylesheet: File not found.", "error")
-  except Exception as e:
-    add_to_log("❗Error loading stylesheet.", "error")
+    # A cleared chat is a new history list, which starts a new export
+    if "chat_export" not in sst or sst.chat_export.history is not sst.chat_history:
+        sst.chat_export = ChatExport(sst.chat_history)
+    if sst.chat_export.files.get(format_type, (None,))[0] != len(sst.chat_history):
+        add_to_log(f"Preparing chat history as {format_type}...")
+    file_name, mime_type = EXPORT_FORMATS[format_type]
+    return sst.chat_export.render(format_type), file_name, mime_type
@@ -1,114 +1,590 @@
 import streamlit as st
 from streamlit import session_state as sst
-from langchain.indexes import VectorstoreIndexCreator
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from langchain.indexes.vectorstore import VectorStoreIndexWrapper
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders.pdf import PyPDFLoader
+from utils.clients import get_embedding_model
+from utils.embedding_cache import EmbeddingCache, CachedEmbeddings
+from utils.embedding_scheduler import ScheduledEmbeddings, TokenBucket
+from utils.faiss_index import get_index_type, resolve_index_type, supports_removal, train_index
+from utils.index_jobs import IndexJob, IndexJobManager, IndexPreview
+from utils.index_store import get_document_set_hash, load_index, prune_indexes, save_index
+from utils.shared_index import IndexLease, SharedIndexStore, clone_vectorstore
+from utils.lexical import BM25Index
 from utils.logs import add_to_log
-from utils.utils import delete_temp_files
-import tempfile
+from utils.metrics import add_timing, timed
+from utils.pdf import iter_many_pdf_pages
+from utils.retrieval import RetrievalConfig, get_text_splitter
+import hashlib
+import uuid
+from contextlib import closing
 
-GEMINI_API_KEY = st.secrets['GEMINI_API_KEY']
+EMBEDDING_MODEL = "gemini-embedding-001"
+# Worker processes used to parse PDFs, 1 parses in the script thread
+PARSE_WORKERS = int(st.secrets.get("PARSE_WORKERS", 1))
+PARSE_PAGES_PER_TASK = int(st.secrets.get("PARSE_PAGES_PER_TASK", 50))
+# Embedding request pacing, shared by every session using the same API key
+EMBEDDING_BATCH_SIZE = int(st.secrets.get("EMBEDDING_BATCH_SIZE", 100))
+EMBEDDING_CONCURRENCY = int(st.secrets.get("EMBEDDING_CONCURRENCY", 4))
+EMBEDDING_RPM = float(st.secrets.get("EMBEDDING_RPM", 15))
+# Question embeddings per minute, paced apart from index builds; 0 leaves them unpaced
+QUERY_EMBEDDING_RPM = float(st.secrets.get("QUERY_EMBEDDING_RPM", 0))
+# Chunks embedded per step of a fresh index build; the index is searchable after the first step
+INDEX_BATCH_SIZE = int(st.secrets.get("INDEX_BATCH_SIZE", EMBEDDING_BATCH_SIZE * EMBEDDING_CONCURRENCY))
+# Indexes saved to disk for returning users
+MAX_SAVED_INDEXES = int(st.secrets.get("MAX_SAVED_INDEXES", 50))
+# Memory for indexes shared between sessions that no session uses any more
+SHARED_INDEX_MEMORY_MB = int(st.secrets.get("SHARED_INDEX_MEMORY_MB", 1024))
+# Index builds running at once in the background, across all sessions
+INDEX_WORKERS = int(st.secrets.get("INDEX_WORKERS", 2))
+# Session state of the index job this session waits for
+INDEX_JOB_KEYS = ("index_job", "index_job_cursor", "index_job_span_cursor", "index_job_settings")
+
+@st.cache_resource
+def get_embedding_cache() -> EmbeddingCache:
+    """
+    Opens the on-disk embedding cache once per server process.
+
+    Returns:
+        EmbeddingCache: Cache shared by every session.
+    """
+    return EmbeddingCache()
+
+@st.cache_resource
+def get_embedding_bucket() -> TokenBucket:
+    """
+    Creates the token bucket that paces embedding requests across all sessions.
+
+    Returns:
+        TokenBucket: Bucket allowing `EMBEDDING_RPM` requests per minute.
+    """
+    return TokenBucket(EMBEDDING_RPM)
+
+@st.cache_resource
+def get_query_embedding_bucket():
+    """
+    Creates the token bucket that paces question embeddings across all sessions.
+
+    Returns:
+        TokenBucket: Bucket allowing `QUERY_EMBEDDING_RPM` requests per minute, or None if unpaced.
+    """
+    return TokenBucket(QUERY_EMBEDDING_RPM) if QUERY_EMBEDDING_RPM > 0 else None
+
+@st.cache_resource
+def get_shared_index_store() -> SharedIndexStore:
+    """
+    Creates the index store shared by every session of this server process.
+
+    Returns:
+        SharedIndexStore: Store of vectorstores keyed by document set hash.
+    """
+    return SharedIndexStore(SHARED_INDEX_MEMORY_MB * 1024 * 1024)
+
+@st.cache_resource
+def get_index_job_manager() -> IndexJobManager:
+    """
+    Creates the background pool that builds indexes for every session.
+
+    Returns:
+        IndexJobManager: Process-wide index job manager.
+    """
+    return IndexJobManager(INDEX_WORKERS)
+
+def get_embeddings(on_progress=None) -> CachedEmbeddings:
+    """
+    Creates the Gemini embedding model wrapped in the persistent embedding cache.
+    Cache misses are sent in concurrent, rate-limited batches; questions are paced
+    separately so they never wait for index builds.
+
+    Args:
+        on_progress (callable, optional): Called with `(done, total)` missed chunks after each batch.
+
+    Returns:
+        CachedEmbeddings: Embeddings that only call Gemini for unseen chunks.
+    """
+    scheduled = ScheduledEmbeddings(
+        get_embedding_model(EMBEDDING_MODEL),
+        batch_size=EMBEDDING_BATCH_SIZE,
+        max_concurrency=EMBEDDING_CONCURRENCY,
+        bucket=get_embedding_bucket(),
+        on_progress=on_progress,
+        query_bucket=get_query_embedding_bucket()
+    )
+    return CachedEmbeddings(scheduled, EMBEDDING_MODEL, get_embedding_cache())
+
+def get_file_key(pdf) -> str:
+    """
+    Identifies an uploaded PDF by its name and a hash of its content.
+
+    Args:
+        pdf (UploadedFile): Uploaded PDF.
+
+    Returns:
+        str: Key used to track the vectors belonging to this file.
+    """
+    return f"{pdf.name}:{hashlib.sha256(pdf.getvalue()).hexdigest()[:16]}"
+
+def get_index_settings(config: RetrievalConfig) -> str:
+    """
+    Describes everything besides the files that changes what ends up in the index.
+
+    Args:
+        config (RetrievalConfig): Retrieval settings of the session.
+
+    Returns:
+        str: Embedding model and chunking settings.
+    """
+    return f"{EMBEDDING_MODEL}:{config.index_settings}"
+
+def set_session_index(lease: IndexLease, settings: str):
+    """
+    Makes a shared index the vectorstore of this session, releasing the previous one.
+
+    Args:
+        lease (IndexLease): Lease on the index to use.
+        settings (str): Index settings the index was built with.
+    """
+    previous = sst.get("index_lease")
+    sst.index_lease = lease
+    sst.vectorstore = VectorStoreIndexWrapper(vectorstore=lease.vectorstore)
+    sst.file_ids = lease.file_ids
+    sst.lexical_index = lease.lexical
+    sst.index_hash = lease.set_hash
+    sst.index_settings = settings
+    if previous is not None and previous is not lease:
+        previous.release()
+
+def clear_session_index():
+    """
+    Removes the vectorstore from this session and releases its shared index.
+    """
+    for key in ("vectorstore", "file_ids", "lexical_index", "index_hash", "index_settings"):
+        if key in sst:
+            del sst[key]
+    if "index_lease" in sst:
+        sst.index_lease.release()
+        del sst.index_lease
+
+def start_vectorstore_job():
+    """
+    Starts creating the vectorstore for the PDFs in session state. Indexes are shared
+    by all sessions through the process-wide `SharedIndexStore` and saved to disk
+    under the hash of their document set, so an uploaded set that is already in
+    memory or on disk is reused right away. Otherwise the index is built in the
+    background by `build_vectorstore` and its `IndexJob` is kept in `sst.index_job`
+    until `finish_vectorstore_job` picks up the result; a running job of an
+    earlier upload is cancelled. Sessions uploading the same set share one job.
+    PDFs are chunked with the settings in `sst.retrieval_config`; changing them
+    rebuilds the index.
+
+    Returns:
+        IndexJob: The started or joined job, or None if an index was reused.
+    """
+    add_to_log("Creating Vectorstore..")
+    cancel_vectorstore_job()
+
+    config = sst.get("retrieval_config", RetrievalConfig())
+    settings = get_index_settings(config)
+    # Chunks of an index built with other settings cannot be reused
+    reusable = "vectorstore" in sst and "file_ids" in sst and sst.get("index_settings") == settings
+    indexed = sst.file_ids if reusable else {}
+    current = {get_file_key(pdf): pdf for pdf in sst.pdf_files}
+    set_hash = get_document_set_hash(current, settings)
+    store = get_shared_index_store()
+
+    lease = store.acquire(set_hash) or load_saved_vectorstore(store, set_hash)
+    if lease is not None:
+        set_session_index(lease, settings)
+        stats = store.stats()
+        add_to_log(f"Shared Vectorstore reused ({stats['indexes']} indexes, {stats['references']} sessions)", "success")
+        return None
+
+    kept = {key: ids for key, ids in indexed.items() if key in current}
+    removed_ids = [doc_id for key, ids in indexed.items() if key not in current for doc_id in ids]
+    # The worker only gets plain data, never the uploaded file objects or session state
+    added = [(key, pdf.name, pdf.getvalue()) for key, pdf in current.items() if key not in indexed]
+    base = (sst.vectorstore.vectorstore, sst.lexical_index) if kept else (None, None)
+
+    job_ref = []
+    embeddings = get_embeddings(on_progress=lambda done, total: job_ref[0].embedded(done, total))
+    # Kept by the shared index, so it must not hold on to the job or its lease
+    search_embeddings = get_embeddings()
+
+    def build(job: IndexJob):
+        job_ref.append(job)
+        return build_vectorstore(
+            job, store, set_hash, config, embeddings, added, kept, removed_ids, *base,
+            search_embeddings=search_embeddings
+        )
+
+    job = get_index_job_manager().submit(set_hash, build)
+    sst.index_job = job
+    sst.index_job_cursor = 0
+    sst.index_job_span_cursor = 0
+    sst.index_job_settings = settings
+    return job
+
+def build_vectorstore(
+    job: IndexJob,
+    store: SharedIndexStore,
+    set_hash: str,
+    config: RetrievalConfig,
+    embeddings: CachedEmbeddings,
+    added: list,
+    kept: dict,
+    removed_ids: list,
+    base_vectorstore: FAISS = None,
+    base_lexical: BM25Index = None,
+    search_embeddings: CachedEmbeddings = None
+):
+    """
+    Builds an index in a background worker. The current index is copied and
+    updated: vectors of removed PDFs are deleted and only newly added PDFs are
+    parsed and embedded. Progress and log messages go through `job`, and the job
+    stops between stages and embedding batches once it is cancelled. When no
+    current index can be reused, every embedded batch is published as
+    `job.preview` so questions can be answered before the build has finished.
+
+    Args:
+        job (IndexJob): Handle of this build.
+        store (SharedIndexStore): Process-wide index store the result is published to.
+        set_hash (str): Hash of the document set being built.
+        config (RetrievalConfig): Chunking and index settings.
+        embeddings (CachedEmbeddings): Embeddings reporting progress to `job`.
+        added (list): `(file key, name, data)` of the PDFs to add.
+        kept (dict): Document IDs of the indexed PDFs that stay.
+        removed_ids (list): Document IDs of the PDFs to remove.
+        base_vectorstore (FAISS, optional): Index holding the kept PDFs.
+        base_lexical (BM25Index, optional): Keyword index holding the kept PDFs.
+        search_embeddings (CachedEmbeddings, optional): Embeddings without a progress
+            callback, kept by the published index to embed questions. Defaults to get_embeddings().
+
+    Returns:
+        IndexLease: Lease on the published index, or None if no PDF had text.
+    """
+    if search_embeddings is None:
+        search_embeddings = get_embeddings()
+    with timed("vectorstore"):
+        job.stage = "Parsing PDFs"
+        pages_by_file, job.skipped_files = parse_pdfs(added, job.log, job) if added else ({}, [])
+        if not pages_by_file and not kept:
+            return None
+        job.raise_if_cancelled()
+
+        job.stage = "Embedding chunks"
+        # Shared indexes are read-only, so changes go into a private copy
+        vectorstore = clone_vectorstore(base_vectorstore) if kept else None
+        lexical = base_lexical.copy() if kept else BM25Index()
+        if removed_ids and vectorstore is not None:
+            job.log(f"Removing {len(removed_ids)} chunks of deleted PDF(s) from Vectorstore..")
+            lexical.remove(removed_ids)
+
+        file_ids = dict(kept)
+        docs, ids = [], []
+        for key, pages in pages_by_file.items():
+            file_docs = get_text_splitter(config.chunk_size, config.chunk_overlap).split_documents(pages)
+            if not file_docs:
+                continue
+            file_ids[key] = [str(uuid.uuid4()) for _ in file_docs]
+            docs.extend(file_docs)
+            ids.extend(file_ids[key])
+            job.log(f"Split {key.rsplit(':', 1)[0]} into {len(file_docs)} chunks")
+        # Keyword index for hybrid search, built from the same chunks
+        lexical.add(docs, ids)
+
+        index_type = resolve_index_type(config.index_type, len(lexical))
+        if vectorstore is not None and (
+            get_index_type(vectorstore.index) != index_type
+            or (removed_ids and not supports_removal(vectorstore.index))
+        ):
+            # The index has to be trained anew; kept chunks come from the embedding cache
+            job.log(f"Rebuilding Vectorstore as {index_type} index for {len(lexical)} chunks..")
+            kept_ids = [doc_id for doc_ids in kept.values() for doc_id in doc_ids]
+            docs = [vectorstore.docstore.search(doc_id) for doc_id in kept_ids] + docs
+            ids = kept_ids + ids
+            vectorstore = None
+        elif removed_ids and vectorstore is not None:
+            vectorstore.delete(removed_ids)
+
+        if docs:
+            # Chunks are embedded in page order, in batches shared by all new PDFs
+            texts = [doc.page_content for doc in docs]
+            job.chunks_total = len(texts)
+            pages_total = count_pages(docs)
+            vectors = []
+            with timed("embed") as span:
+                for start in range(0, len(texts), INDEX_BATCH_SIZE):
+                    vectors.extend(embeddings.embed_documents(texts[start:start + INDEX_BATCH_SIZE]))
+                    job.chunks_indexed = job.chunks_embedded = len(vectors)
+                    job.raise_if_cancelled()
+                    # Sessions without an index can already search the chunks embedded so far
+                    if vectorstore is None and len(vectors) < len(texts):
+                        job.preview = build_preview(search_embeddings, docs, ids, vectors, pages_total)
+                span.count("chunks", len(texts))
+                span.count("cache_hits", embeddings.hits)
+            metadatas = [doc.metadata for doc in docs]
+            job.stage = "Building index"
+            with timed("index_build") as span:
+                if vectorstore is None:
+                    vectorstore = FAISS(
+                        embedding_function=search_embeddings,
+                        index=train_index(vectors, index_type, config.vector_codec),
+                        docstore=InMemoryDocstore(),
+                        index_to_docstore_id={}
+                    )
+                vectorstore.add_embeddings(zip(texts, vectors), metadatas=metadatas, ids=ids)
+                span.count("vectors", vectorstore.index.ntotal)
+
+        if vectorstore is None:
+            return None
+        job.stage = "Saving index"
+        lease = store.publish(set_hash, vectorstore, file_ids, lexical)
+        save_vectorstore(lease, job.log)
+        job.log(f"Embedding cache: {embeddings.hits} hits, {embeddings.misses} misses", "info")
+        job.log("Created Vectorstore Successfully..", "success")
+        return lease
+
+def count_pages(docs: list) -> int:
+    """
+    Counts the distinct PDF pages a list of chunks comes from.
+
+    Args:
+        docs (list): Chunk documents.
+
+    Returns:
+        int: Number of pages.
+    """
+    return len({(doc.metadata.get("source"), doc.metadata.get("page")) for doc in docs})
+
+def build_preview(embeddings: CachedEmbeddings, docs: list, ids: list, vectors: list, pages_total: int) -> IndexPreview:
+    """
+    Builds an exact index over the first chunks of a build, the ones already embedded.
+    A new index is built each time, so published previews are never modified.
+
+    Args:
+        embeddings (CachedEmbeddings): Embeddings used to embed questions.
+        docs (list): All chunk documents of the build, in page order.
+        ids (list): Document IDs of `docs`.
+        vectors (list): Embeddings of the first chunks of `docs`.
+        pages_total (int): Pages of all chunks of the build.
+
+    Returns:
+        IndexPreview: Searchable snapshot of the embedded chunks.
+    """
+    indexed = docs[:len(vectors)]
+    vectorstore = FAISS(
+        embedding_function=embeddings,
+        index=train_index(vectors, "flat"),
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={}
+    )
+    vectorstore.add_embeddings(
+        zip([doc.page_content for doc in indexed], vectors),
+        metadatas=[doc.metadata for doc in indexed],
+        ids=ids[:len(vectors)]
+    )
+    lexical = BM25Index.from_documents(indexed, ids[:len(vectors)])
+    return IndexPreview(vectorstore, lexical, count_pages(indexed), pages_total)
+
+def get_index_preview():
+    """
+    Returns the part of this session's index built so far, while the job is running.
+
+    Returns:
+        IndexPreview: Searchable snapshot, or None if there is none yet.
+    """
+    job = sst.get("index_job")
+    return job.preview if job is not None else None
+
+def finish_vectorstore_job() -> bool:
+    """
+    Forwards the log messages and stage timings of this session's index job and,
+    once the job has finished, makes its index the session's vectorstore. Runs in
+    the script thread.
+
+    Returns:
+        bool: Whether the job has finished; True as well if there is no job.
+    """
+    job = sst.get("index_job")
+    if job is None:
+        return True
+    messages, sst.index_job_cursor = job.messages_since(sst.index_job_cursor)
+    for message, status in messages:
+        add_to_log(message, status)
+    spans, sst.index_job_span_cursor = job.spans_since(sst.index_job_span_cursor)
+    for span in spans:
+        add_timing(span)
+    if not job.done:
+        return False
+
+    settings = sst.index_job_settings
+    for key in INDEX_JOB_KEYS:
+        del sst[key]
+    if job.status == "cancelled":
+        return True
+    if job.status == "failed":
+        st.toast("Error creating vectorstore. Try another PDF.", icon="⚠️")
+        add_to_log(f"Error: Unable to create vectorstore - {str(job.error)}", "error")
+        clear_session_index()
+        return True
+
+    lease = job.take_result(get_shared_index_store().acquire)
+    if lease is None:
+        add_to_log("No valid PDFs could be processed", "error")
+        st.toast("Please upload PDFs with readable text content.", icon="⚠️")
+        # Clear PDF files from session state to allow fresh start
+        clear_session_index()
+        return True
+    if job.skipped_files:
+        st.toast("Some PDFs were skipped. Only PDFs with readable text were included.", icon="ℹ️")
+    set_session_index(lease, settings)
+    return True
+
+def cancel_vectorstore_job():
+    """
+    Stops waiting for this session's index job. The build itself is cancelled
+    unless another session is waiting for the same document set.
+    """
+    job = sst.get("index_job")
+    if job is not None:
+        job.cancel()
+        for key in INDEX_JOB_KEYS:
+            sst.pop(key, None)
 
 def get_vectorstore():
     """
-    Creates or retrieves an existing vectorstore from session state.
-    Includes enhanced error handling for PDFs with graphics or no text content.
+    Creates the vectorstore for the PDFs in session state and waits for it.
+    See `start_vectorstore_job`.
 
     Returns:
         Vectorstore object stored in session state.
     """
-    add_to_log("Creating Vectorstore..")
+    job = start_vectorstore_job()
+    if job is not None:
+        with st.spinner("Creating Vectorstore..."):
+            job.wait()
+        finish_vectorstore_job()
+    return sst.get("vectorstore")
+
+def load_saved_vectorstore(store: SharedIndexStore, set_hash: str):
+    """
+    Loads a vectorstore saved to disk into the shared index store.
+    Failures are only logged so the index can be rebuilt instead.
 
-    loader_list, temp_paths = get_loader(sst.pdf_files)
+    Args:
+        store (SharedIndexStore): Process-wide index store.
+        set_hash (str): Hash of the document set.
+
+    Returns:
+        IndexLease: Lease on the loaded index, or None if none was saved.
+    """
     try:
-        with st.spinner("Creating Vectorstore..."):
-            if not loader_list:
-                # Clear PDF files from session state to allow fresh start
-                if "vectorstore" in sst:
-                    del sst.vectorstore
-                return None
-            
-            embeddings = GoogleGenerativeAIEmbeddings(model="gemini-embedding-001", transport="rest", google_api_key=GEMINI_API_KEY)
-            try:
-                sst.vectorstore = VectorstoreIndexCreator(
-                    vectorstore_cls=FAISS, 
-                    embedding=embeddings
-                ).from_loaders(loader_list)
-                add_to_log("Created Vectorstore Successfully..", "success")
-                return sst.vectorstore
-            except Exception as e:
-                st.toast(f"Error creating vectorstore. Try another PDF.", icon="⚠️")
-                add_to_log(f"Error: Unable to create vectorstore - {str(e)}", "error")
-                if "vectorstore" in sst:
-                    del sst.vectorstore
-                return None
+        vectorstore, file_ids, lexical = load_index(set_hash, get_embeddings())
+        if vectorstore is not None:
+            add_to_log("Loaded saved Vectorstore..", "success")
+            return store.publish(set_hash, vectorstore, file_ids, lexical)
     except Exception as e:
-        st.toast("Unexpected error. Please try again with a different PDF.", icon="⚠️")
-        add_to_log(f"Error: {str(e)}", "error")
-        if "vectorstore" in sst:
-            del sst.vectorstore
-        return None
-    finally:
-        delete_temp_files(temp_paths)
+        add_to_log(f"Error: Unable to load saved vectorstore - {str(e)}", "error")
+    return None
+
+def save_vectorstore(lease: IndexLease, log=add_to_log):
+    """
+    Saves a finished vectorstore and its keyword index to disk and prunes old saved
+    indexes. Failures are only logged, the in-memory vectorstore stays usable.
+
+    Args:
+        lease (IndexLease): Lease on the index to save.
+        log (callable, optional): Where messages go. Defaults to add_to_log.
+    """
+    try:
+        save_index(lease.set_hash, lease.vectorstore, lease.file_ids, lease.lexical)
+        prune_indexes(MAX_SAVED_INDEXES)
+        log("Saved Vectorstore to disk.", "success")
+    except Exception as e:
+        log(f"Error: Unable to save vectorstore - {str(e)}", "error")
+
+def parse_pdfs(files: list, log=add_to_log, job: IndexJob = None) -> tuple:
+    """
+    Parses PDFs into page documents straight from their in-memory bytes, without
+    writing temporary files. Every PDF is parsed exactly once. With `PARSE_WORKERS`
+    above 1 the page ranges of all files are parsed in a process pool at once.
+    Runs in background workers too, as long as `log` does not touch session state.
+
+    Args:
+        files (list): `(file key, name, data)` of each PDF.
+        log (callable, optional): Where messages go. Defaults to add_to_log.
+        job (IndexJob, optional): Job to report parsed files to and to stop when cancelled.
+
+    Returns:
+        tuple: Page documents of each PDF with text keyed by file key, and names of the skipped PDFs.
+    """
+    log("Processing PDFs..")
+    parsed = {}
+    if job is not None:
+        job.files_total = len(files)
+
+    with timed("parse") as span:
+        span.count("files", len(files))
+        # Every file is submitted at once and reported as soon as it is parsed;
+        # closing the iterator on cancellation drops the ranges not started yet
+        with closing(iter_many_pdf_pages(
+            [(data, name) for _, name, data in files],
+            workers=PARSE_WORKERS,
+            pages_per_task=PARSE_PAGES_PER_TASK
+        )) as results:
+            for index, pages in results:
+                name = files[index][1]
+                if isinstance(pages, Exception):
+                    log(f"Error loading pages from {name}", "error")
+                # Only keep PDFs that yielded some text
+                elif any(len(page.page_content.strip()) > 0 for page in pages):
+                    span.count("pages", len(pages))
+                    log(f"Successfully processed {name}", "success")
+                else:
+                    pages = None
+                    log(f"No text content found in {name}", "error")
+                parsed[index] = pages
+                if job is not None:
+                    job.files_parsed += 1
+                    job.raise_if_cancelled()
+
+    # Keeps the upload order, whatever order the files finished in
+    pages_by_file = {}
+    skipped = []
+    for index, (key, name, _) in enumerate(files):
+        pages = parsed[index]
+        if pages is None or isinstance(pages, Exception):
+            skipped.append(name)
+        else:
+            pages_by_file[key] = pages
+
+    if pages_by_file:
+        log("PDFs loaded successfully!", "success")
+    return pages_by_file, skipped
 
 def get_loader(pdf_files: list):
     """
-    Creates PDF loaders from uploaded PDFs, saving each file temporarily.
+    Parses uploaded PDFs into page documents in the script thread, see `parse_pdfs`.
     Includes enhanced error handling for PDFs with graphics.
 
     Args:
         pdf_files (list): List of uploaded PDFs.
 
     Returns:
-        list: PDF loaders for processing.
-        list: Temporary file paths for cleanup.
+        dict: Page documents of each readable PDF, keyed by `get_file_key`.
     """
-    add_to_log("Processing PDFs..")
-    pdf_loader_list = []
-    temp_paths = []
-    has_unreadable_pdfs = False
-    
     try:
         with st.spinner("Loading PDFs..."):
-            for pdf in pdf_files:
-                try:
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as f:
-                        f.write(pdf.getvalue())
-                        temp_paths.append(f.name)
-                        # Create loader with enhanced error handling
-                        loader = PyPDFLoader(
-                            f.name,
-                            extract_images=False  # Skip image extraction to avoid errors
-                        )
-                        # Test load to catch any immediate issues
-                        try:
-                            pages = loader.load()
-                            # Only add loader if it successfully extracted text
-                            if any(len(page.page_content.strip()) > 0 for page in pages):
-                                pdf_loader_list.append(loader)
-                                add_to_log(f"Successfully processed {pdf.name}", "success")
-                            else:
-                                has_unreadable_pdfs = True
-                                add_to_log(f"No text content found in {pdf.name}", "error")
-                        except Exception as e:
-                            has_unreadable_pdfs = True
-                            add_to_log(f"Error loading pages from {pdf.name}", "error")
-                except Exception as e:
-                    add_to_log(f"Error processing {pdf.name}", "error")
-                    continue
-            
-            if pdf_loader_list:
-                add_to_log("PDFs loaded successfully!", "success")
-                if has_unreadable_pdfs:
-                    st.toast("Some PDFs were skipped. Only PDFs with readable text were included.", icon="ℹ️")
-                return pdf_loader_list, temp_paths
-            else:
-                add_to_log("No valid PDFs could be processed", "error")
-                st.toast("Please upload PDFs with readable text content.", icon="⚠️")
-                return None, temp_paths
-            
+            pdf_pages, skipped = parse_pdfs([(get_file_key(pdf), pdf.name, pdf.getvalue()) for pdf in pdf_files])
     except Exception as e:
         add_to_log(f"Error: {str(e)}", "error")
         st.toast("Error loading PDFs. Please try again with different files.", icon="⚠️")
-        return None, temp_paths
+        return None
+
+    if pdf_pages:
+        if skipped:
+            st.toast("Some PDFs were skipped. Only PDFs with readable text were included.", icon="ℹ️")
+        return pdf_pages
+    add_to_log("No valid PDFs could be processed", "error")
+    st.toast("Please upload PDFs with readable text content.", icon="⚠️")
+    return None